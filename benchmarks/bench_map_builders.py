@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Compares cloudtools.buildbot.map_builders with the previous implementation,
+which ran every buildermap expression against every pending row.
+
+Usage: python benchmarks/bench_map_builders.py [-n ROWS] [-c CONFIG]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import timeit
+from collections import defaultdict, OrderedDict
+
+from cloudtools.buildbot import map_builders
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), "..", "configs",
+                              "watch_pending.cfg")
+SAMPLE_BUILDERNAMES = [
+    "Linux x86-64 mozilla-central build",
+    "Linux x86-64 mozilla-inbound pgo-build",
+    "Linux x86-64 try build",
+    "Linux mozilla-central leak test build",
+    "Linux x86-64 mozilla-central asan build",
+    "Android 4.0 API15+ mozilla-central build",
+    "Android 4.0 API15+ try build",
+    "WINNT 6.1 x86-64 mozilla-central build",
+    "WINNT 5.2 mozilla-inbound nightly",
+    "WINNT 6.1 x86-64 try build",
+    "Ubuntu VM 12.04 mozilla-inbound opt test mochitest-1",
+    "Ubuntu VM 12.04 x64 mozilla-central debug test reftest",
+    "Ubuntu VM large 12.04 x64 mozilla-central opt test gtest",
+    "Ubuntu ASAN VM 12.04 x64 try opt test crashtest",
+    "Firefox mozilla-central linux64 l10n nightly",
+    "Firefox try win32 l10n",
+    "release-mozilla-beta_firefox_win32_l10n_repack_1/10",
+    "release-mozilla-release-linux64_update_verify_1/6",
+    "release-mozilla-beta_tag_source",
+    "Thunderbird comm-central linux l10n nightly",
+    "graphene_mozilla-central_linux64-debug",
+    "Rev7 MacOSX Yosemite 10.10.5 mozilla-central opt test mochitest-1",
+    "Windows 7 32-bit mozilla-inbound debug test mochitest-2",
+    "b2g_mozilla-central_emulator periodic",
+]
+
+
+def legacy_map_builders(pending, builder_map):
+    """The previous map_builders implementation"""
+    type_map = defaultdict(int)
+    for pending_buildername, _ in pending:
+        for buildername_exp, moz_instance_type in builder_map.items():
+            if re.match(buildername_exp, pending_buildername):
+                type_map[moz_instance_type] += 1
+                break
+    return type_map
+
+
+def make_pending(rows, seed=0):
+    rnd = random.Random(seed)
+    return [(rnd.choice(SAMPLE_BUILDERNAMES), i) for i in range(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", type=int, default=20000,
+                        help="number of pending rows (default: 20000)")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-c", "--config", default=DEFAULT_CONFIG)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        builder_map = json.load(f, object_pairs_hook=OrderedDict)["buildermap"]
+    pending = make_pending(args.rows)
+
+    assert map_builders(pending, builder_map) == \
+        legacy_map_builders(pending, builder_map)
+
+    print "%i pending rows, %i distinct builders, %i expressions" % (
+        len(pending), len(SAMPLE_BUILDERNAMES), len(builder_map))
+    for name, func in [("legacy", legacy_map_builders),
+                       ("map_builders", map_builders)]:
+        best = min(timeit.repeat(lambda: func(pending, builder_map),
+                                 repeat=args.repeat, number=1))
+        print "%-14s %.4fs per cycle" % (name, best)
+
+
+if __name__ == "__main__":
+    main()
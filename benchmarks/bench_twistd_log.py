@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Compares cloudtools.twistd_log.LogActivity with the previous twistd.log
+parsing loop of get_last_activity, which ran re.search and
+strptime/mktime on every line.
+
+Usage: python benchmarks/bench_twistd_log.py [-n LINES] [FILE ...]
+
+Without FILEs a synthetic log of LINES lines is used. Real twistd.log files
+are parsed as a whole, the way a large tail window would be.
+"""
+import argparse
+import random
+import re
+import time
+import timeit
+
+from cloudtools.twistd_log import LogActivity, ACTIVITY_BOOTING, \
+    ACTIVITY_STOPPED
+
+# Chunk size used to feed the streaming parser, about one SSH channel read
+CHUNK_SIZE = 32 * 1024
+SAMPLE_MESSAGES = [
+    "[Broker,client] RunProcess._startCommand",
+    "[Broker,client]  using PTY: False",
+    "[-] sending app-level keepalive",
+    "[Broker,client] SlaveBuilder.commandComplete <buildslave.commands"
+    ".shell.SlaveShellCommand instance at 0x7f>",
+    "[Broker,client] I have a leftover directory 'test-linux64' that is not "
+    "being used by the buildmaster: you can delete it now",
+    "[-] command finished with signal None, exit code 0, elapsedTime: 1.2",
+    "[Broker,client] stopCommand: halting current command",
+    "[-] Server Shut Down.",
+]
+
+
+def legacy_last_activity(stdout, slave_time, uptime):
+    """The parsing loop of the previous get_last_activity"""
+    last_activity = None
+    running_command = False
+    t = time.time()
+    for line in stdout.splitlines():
+        m = re.search(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})", line)
+        if m:
+            t = time.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
+            t = time.mktime(t)
+        else:
+            continue
+        if "RunProcess._startCommand" in line or "using PTY: " in line:
+            running_command = True
+        elif "commandComplete" in line or "stopCommand" in line:
+            running_command = False
+
+        if "Shut Down" in line:
+            if (slave_time - t) > uptime:
+                last_activity = ACTIVITY_BOOTING
+            else:
+                last_activity = ACTIVITY_STOPPED
+        elif "I have a leftover directory" in line:
+            continue
+        elif running_command:
+            last_activity = 0
+        else:
+            last_activity = slave_time - t
+    return last_activity
+
+
+def streaming_last_activity(stdout, slave_time, uptime):
+    activity = LogActivity()
+    for start in xrange(0, len(stdout), CHUNK_SIZE):
+        activity.feed_bytes(stdout[start:start + CHUNK_SIZE])
+    activity.close()
+    return activity.last_activity(slave_time, uptime)
+
+
+def make_log(lines, seed=0):
+    rnd = random.Random(seed)
+    t = time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1))
+    rv = []
+    for _ in range(lines):
+        t += rnd.choice([0, 0, 0, 1, 1, 2, 30])
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        if rnd.random() < 0.1:
+            # Command output without a timestamp
+            rv.append("  output line %i" % rnd.randint(0, 1000))
+        else:
+            rv.append("%s+0000 %s" % (timestamp, rnd.choice(SAMPLE_MESSAGES)))
+    return "\n".join(rv) + "\n", t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--lines", type=int, default=100000,
+                        help="number of synthetic log lines (default: "
+                        "100000)")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("files", nargs="*", help="twistd.log files")
+    args = parser.parse_args()
+
+    logs = []
+    if args.files:
+        for filename in args.files:
+            with open(filename, "rb") as f:
+                logs.append((filename, f.read(), time.time()))
+    else:
+        data, last_time = make_log(args.lines)
+        logs.append(("synthetic", data, last_time + 600))
+
+    for name, data, slave_time in logs:
+        uptime = 3600
+        assert legacy_last_activity(data, slave_time, uptime) == \
+            streaming_last_activity(data, slave_time, uptime)
+        print "%s: %i lines, %i bytes" % (name, data.count("\n"), len(data))
+        for func_name, func in [("legacy", legacy_last_activity),
+                                ("streaming", streaming_last_activity)]:
+            best = min(timeit.repeat(lambda: func(data, slave_time, uptime),
+                                     repeat=args.repeat, number=1))
+            print "%-10s %.4fs, %.0f lines/s" % (
+                func_name, best, data.count("\n") / best)
+
+
+if __name__ == "__main__":
+    main()
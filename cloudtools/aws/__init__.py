@@ -4,14 +4,17 @@ import time
 import calendar
 import iso8601
 import json
-from redo import retrier
+from concurrent.futures import ThreadPoolExecutor
 from boto.ec2 import connect_to_region
 from boto.vpc import VPCConnection
 from boto.s3.connection import S3Connection
-from boto.exception import BotoServerError
-from repoze.lru import lru_cache
+from repoze.lru import lru_cache, LRUCache
 from fabric.api import run
 
+from .fleet import FleetIndex
+from .ratelimit import call_aws, get_region_name, is_transient, \
+    NOT_FOUND, TRANSIENT_CODES
+
 log = logging.getLogger(__name__)
 AMI_CONFIGS_DIR = os.path.join(os.path.dirname(__file__), "../../ami_configs")
 INSTANCE_CONFIGS_DIR = os.path.join(os.path.dirname(__file__), "../../configs")
@@ -21,8 +24,19 @@ DEFAULT_REGIONS = ['us-east-1', 'us-west-2']
 # 'fresh'
 FRESH_INSTANCE_DELAY = 20 * 60
 
+# Terminated instances are not useful and are not fetched by
+# aws_get_all_instances
+LIVE_INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping',
+                        'stopped']
+# Maximum number of regions queried at the same time
+MAX_REGION_WORKERS = 8
+# Instances terminated per TerminateInstances call
+TERMINATE_BATCH_SIZE = 100
+_aws_connections_cache = LRUCache(10)
+_vpc_connections_cache = LRUCache(10)
 
-@lru_cache(10)
+
+@lru_cache(10, cache=_aws_connections_cache)
 def get_aws_connection(region):
     """Connect to an EC2 region. Caches connection objects"""
     return connect_to_region(region)
@@ -34,46 +48,48 @@ def get_s3_connection():
     return S3Connection()
 
 
-@lru_cache(10)
+@lru_cache(10, cache=_vpc_connections_cache)
 def get_vpc(region):
     conn = get_aws_connection(region)
     return VPCConnection(region=conn.region)
 
 
+def invalidate_connections_cache():
+    """Forget cached EC2 and VPC connection objects"""
+    _aws_connections_cache.clear()
+    _vpc_connections_cache.clear()
+
+
 def wait_for_status(obj, attr_name, attr_value, update_method):
     log.debug("waiting for %s availability", obj)
+    region = get_region_name(obj)
     while True:
         try:
-            getattr(obj, update_method)()
-            if getattr(obj, attr_name) == attr_value:
-                break
-            else:
-                time.sleep(1)
-        except:  # noqa: E722
-            log.exception('hit error waiting')
+            # New objects may be not visible yet
+            call_aws(region, update_method, getattr(obj, update_method),
+                     retry_codes=(NOT_FOUND,) + TRANSIENT_CODES)
+        except Exception, e:
+            if not is_transient(e):
+                raise
+            log.warn("%s - error while waiting, retrying: %s", obj, e)
             time.sleep(10)
+            continue
+        if getattr(obj, attr_name) == attr_value:
+            break
+        time.sleep(1)
 
 
 def attach_and_wait_for_volume(volume, aws_dev_name, internal_dev_name,
                                instance_id):
     """Attach a volume to an instance and wait until it is available"""
     wait_for_status(volume, "status", "available", "update")
-    while True:
-        try:
-            volume.attach(instance_id, aws_dev_name)
-            break
-        except:  # noqa: E722
-            log.debug('hit error waiting for volume to be attached')
-            time.sleep(10)
-    while True:
-        try:
-            volume.update()
-            if volume.status == 'in-use':
-                if run('ls %s' % internal_dev_name).succeeded:
-                    break
-        except:  # noqa: E722
-            log.debug('hit error waiting for volume to be attached')
-            time.sleep(10)
+    call_aws(get_region_name(volume), "AttachVolume", volume.attach,
+             instance_id, aws_dev_name,
+             retry_codes=(NOT_FOUND, "IncorrectState") + TRANSIENT_CODES)
+    wait_for_status(volume, "status", "in-use", "update")
+    while not run('ls %s' % internal_dev_name, warn_only=True).succeeded:
+        log.debug('waiting for %s to show up', internal_dev_name)
+        time.sleep(1)
 
 
 def mount_device(device, mount_point):
@@ -103,6 +119,9 @@ def aws_time_to_datetime(t):
 
 
 def aws_get_running_instances(instances, moz_instance_type):
+    if isinstance(instances, FleetIndex):
+        return instances.select(moz_type=moz_instance_type, state='running',
+                                moz_state='ready')
     retval = []
     for i in instances:
         if i.state != 'running':
@@ -119,25 +138,49 @@ def aws_get_running_instances(instances, moz_instance_type):
 _aws_instances_cache = {}
 
 
+def _get_region_instances(region):
+    log.debug("aws_get_all_instances - fetching %s", region)
+    conn = get_aws_connection(region)
+    return conn.get_only_instances(
+        filters={'instance-state-name': LIVE_INSTANCE_STATES})
+
+
 def aws_get_all_instances(regions):
     """
-    Returns a list of all instances in the given regions
+    Returns a list of all non terminated instances in the given regions.
+    Regions missing in the cache are fetched concurrently.
     """
     log.debug("fetching all instances for %s", regions)
-    retval = []
+    missing = []
     for region in regions:
         if region in _aws_instances_cache:
             log.debug("aws_get_all_instances - cache hit for %s", region)
-            retval.extend(_aws_instances_cache[region])
-        else:
-            conn = get_aws_connection(region)
-            region_instances = conn.get_only_instances()
-            log.debug("aws_get_running_instances - caching %s", region)
-            _aws_instances_cache[region] = region_instances
-            retval.extend(region_instances)
+        elif region not in missing:
+            missing.append(region)
+
+    if missing:
+        workers = min(MAX_REGION_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_get_region_instances, missing)
+            for region, region_instances in zip(missing, results):
+                log.debug("aws_get_all_instances - caching %s", region)
+                _aws_instances_cache[region] = region_instances
+
+    retval = []
+    for region in regions:
+        retval.extend(_aws_instances_cache[region])
     return retval
 
 
+def invalidate_instances_cache(regions=None):
+    """Forget cached instances for `regions` (all regions by default)"""
+    if regions is None:
+        _aws_instances_cache.clear()
+        return
+    for region in regions:
+        _aws_instances_cache.pop(region, None)
+
+
 @lru_cache(10)
 def get_user_data_tmpl(moz_instance_type):
     user_data_tmpl = os.path.join(INSTANCE_CONFIGS_DIR,
@@ -150,6 +193,18 @@ def get_user_data_tmpl(moz_instance_type):
 
 
 def aws_filter_instances(instances, state=None, tags=None):
+    if isinstance(instances, FleetIndex):
+        tags = dict(tags or {})
+        criteria = {}
+        if state:
+            criteria["state"] = state
+        for tag, field in [("moz-type", "moz_type"),
+                           ("moz-state", "moz_state")]:
+            if tag in tags:
+                criteria[field] = tags.pop(tag)
+        selected = instances.select(**criteria)
+        return [i for i in selected if not instances.is_loaned(i) and
+                all(i.tags.get(k) == v for k, v in tags.iteritems())]
     retval = []
     for i in instances:
         matched = True
@@ -171,10 +226,14 @@ def aws_filter_instances(instances, state=None, tags=None):
 
 
 def filter_spot_instances(instances):
+    if isinstance(instances, FleetIndex):
+        return instances.select(lifecycle="spot")
     return [i for i in instances if i.spot_instance_request_id]
 
 
 def filter_ondemand_instances(instances):
+    if isinstance(instances, FleetIndex):
+        return instances.select(lifecycle="ondemand")
     return [i for i in instances if i.spot_instance_request_id is None]
 
 
@@ -264,6 +323,38 @@ def get_impaired_instance_ids(region):
     return [i.id for i in impaired]
 
 
+def terminate_instances(instances, batch_size=TERMINATE_BATCH_SIZE):
+    """Terminates instances with one TerminateInstances call per region and
+    batch_size instances. The instances of a failed batch are retried one by
+    one, so one bad instance doesn't keep the others running. Returns the
+    instances which couldn't be terminated."""
+    def terminate(region, conn, batch):
+        try:
+            call_aws(region, "TerminateInstances", conn.terminate_instances,
+                     instance_ids=[i.id for i in batch])
+            return True
+        except Exception:
+            log.warn("%s - cannot terminate %s", region,
+                     ", ".join(i.id for i in batch), exc_info=True)
+            return False
+
+    by_region = {}
+    for i in instances:
+        by_region.setdefault(i.region.name, []).append(i)
+    failed = []
+    for region, region_instances in sorted(by_region.iteritems()):
+        conn = get_aws_connection(region)
+        for start in range(0, len(region_instances), batch_size):
+            batch = region_instances[start:start + batch_size]
+            if terminate(region, conn, batch):
+                continue
+            if len(batch) == 1:
+                failed.extend(batch)
+                continue
+            failed.extend(i for i in batch if not terminate(region, conn, [i]))
+    return failed
+
+
 def get_region_dns_atom(region):
     """Maps AWS regions to region names used by Mozilla in DNS names"""
     mapping = {
@@ -274,18 +365,8 @@ def get_region_dns_atom(region):
     return mapping.get(region)
 
 
-def retry_aws_request(callable, *args, **kwargs):
-    """Calls callable(*args, **kwargs), and sleeps/retries on
-    RequestLimitExceeded errors"""
-    for _ in retrier():
-        try:
-            return callable(*args, **kwargs)
-        except BotoServerError, e:
-            if e.code == 'RequestLimitExceeded':
-                # Try again
-                log.debug("Got RequestLimitExceeded; retrying", exc_info=True)
-                continue
-            # Otherwise re-raise
-            raise
-    else:
-        raise Exception("Exceeded retries")
+def retry_aws_request(action, callable, *args, **kwargs):
+    """Calls callable(*args, **kwargs), a method of a boto connection or EC2
+    object making the `action` EC2 API call, using call_aws"""
+    region = get_region_name(getattr(callable, "im_self", None))
+    return call_aws(region, action, callable, *args, **kwargs)
@@ -9,6 +9,7 @@ from . import AMI_CONFIGS_DIR, wait_for_status, get_aws_connection, \
     get_s3_connection
 
 log = logging.getLogger(__name__)
+_spot_amis_cache = {}
 
 
 def ami_cleanup(mount_point, distro, remove_extra=None):
@@ -98,6 +99,11 @@ def copy_ami(source_ami, region_to_copy):
 
 
 def get_spot_amis(region, tags, name_glob="spot-*", root_device_type=None):
+    cache_key = (region, tuple(sorted(tags.items())), name_glob,
+                 root_device_type)
+    if cache_key in _spot_amis_cache:
+        log.debug("using cached AMIs for %s in %s", tags, region)
+        return _spot_amis_cache[cache_key]
     conn = get_aws_connection(region)
     filters = {"state": "available"}
     for tag, value in tags.iteritems():
@@ -107,7 +113,13 @@ def get_spot_amis(region, tags, name_glob="spot-*", root_device_type=None):
     if root_device_type:
         filters["root-device-type"] = root_device_type
     avail_amis = conn.get_all_images(owners=["self"], filters=filters)
-    return sorted(avail_amis, key=lambda ami: ami.tags.get("moz-created"))
+    amis = sorted(avail_amis, key=lambda ami: ami.tags.get("moz-created"))
+    _spot_amis_cache[cache_key] = amis
+    return amis
+
+
+def invalidate_spot_amis_cache():
+    _spot_amis_cache.clear()
 
 
 def delete_ebs_ami(ami):
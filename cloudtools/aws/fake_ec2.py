@@ -0,0 +1,397 @@
+"""
+In-process fake of the EC2 API subset used by aws_watch_pending.
+
+Region state is loaded from recordings produced by dump_region() and is
+modified by the replayed code, e.g. spot requests and instances are added
+and tagged. Time stamps are shifted by the age of the recording, so
+freshness checks see the same picture they saw when it was made.
+"""
+import calendar
+import fnmatch
+import itertools
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from . import aws_time_to_datetime
+
+INSTANCE_ATTRS = ["id", "state", "tags", "instance_type", "image_id",
+                  "launch_time", "spot_instance_request_id", "placement",
+                  "subnet_id", "private_ip_address", "virtualization_type",
+                  "root_device_type"]
+SPOT_REQUEST_ATTRS = ["id", "state", "tags", "price", "instance_id",
+                      "create_time", "launched_availability_zone"]
+IMAGE_ATTRS = ["id", "name", "state", "tags", "root_device_type",
+               "root_device_name", "virtualization_type"]
+SUBNET_ATTRS = ["id", "vpc_id", "state", "cidr_block", "availability_zone",
+                "available_ip_address_count"]
+PRICE_ATTRS = ["availability_zone", "instance_type", "price", "timestamp"]
+
+
+def _dump(obj, attrs):
+    rv = {}
+    for attr in attrs:
+        value = getattr(obj, attr, None)
+        if isinstance(value, dict):
+            value = dict(value)
+        rv[attr] = value
+    return rv
+
+
+def dump_instance(i):
+    return _dump(i, INSTANCE_ATTRS)
+
+
+def dump_spot_request(r):
+    rv = _dump(r, SPOT_REQUEST_ATTRS)
+    spec = r.launch_specification
+    rv["launch_specification"] = {
+        "instance_type": spec.instance_type,
+        "image_id": spec.image_id,
+        "subnet_id": getattr(spec, "subnet_id", None),
+    }
+    rv["status"] = {"code": r.status.code,
+                    "update_time": r.status.update_time}
+    return rv
+
+
+def dump_image(ami):
+    rv = _dump(ami, IMAGE_ATTRS)
+    rv["block_device_mapping"] = dict(
+        (dev, _dump(bd, ["size", "snapshot_id", "volume_type"]))
+        for dev, bd in ami.block_device_mapping.iteritems())
+    return rv
+
+
+def dump_region(conn, vpc, instances, spot_requests, product_instance_types,
+                start_time):
+    """Returns a JSON serializable snapshot of the region state used by
+    aws_watch_pending. Spot price history is recorded for every (product
+    description, instance type) pair since start_time."""
+    prices = []
+    for product_description, instance_type in product_instance_types:
+        next_token = None
+        while True:
+            page = conn.get_spot_price_history(
+                product_description=product_description,
+                instance_type=instance_type, start_time=start_time,
+                max_results=1000, next_token=next_token)
+            for p in page:
+                entry = _dump(p, PRICE_ATTRS)
+                entry["product_description"] = product_description
+                prices.append(entry)
+            next_token = page.next_token
+            if not next_token:
+                break
+    images = conn.get_all_images(
+        owners=["self"], filters={"state": "available", "tag:Name": "spot-*"})
+    return {
+        "zones": [az.name for az in conn.get_all_zones()],
+        "instances": [dump_instance(i) for i in instances],
+        "spot_requests": [dump_spot_request(r) for r in spot_requests],
+        "spot_prices": prices,
+        "images": [dump_image(ami) for ami in images],
+        "subnets": [_dump(s, SUBNET_ATTRS) for s in vpc.get_all_subnets()],
+    }
+
+
+def format_aws_time(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(t))
+
+
+def _shift(t, delta):
+    if not t:
+        return t
+    d = aws_time_to_datetime(t) + timedelta(seconds=delta)
+    return format_aws_time(calendar.timegm(d.utctimetuple()))
+
+
+def _matches(value, expected):
+    if isinstance(expected, (list, tuple)):
+        return any(_matches(value, e) for e in expected)
+    return value is not None and fnmatch.fnmatchcase(str(value), expected)
+
+
+class FakeObject(object):
+    """Attribute bag standing in for boto objects"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return "%s:%s" % (self.__class__.__name__, getattr(self, "id", None))
+
+    def add_tag(self, key, value=""):
+        self.tags[key] = value
+
+
+class FakeResultSet(list):
+    next_token = None
+
+
+class FakeRegion(object):
+    """State of a single region"""
+
+    def __init__(self, ec2, name, data, delta=0):
+        self.ec2 = ec2
+        self.name = name
+        self.info = FakeObject(name=name)
+        self.connection = FakeConnection(self)
+        self.vpc = FakeVPC(self)
+        self.zones = [FakeObject(name=az) for az in data["zones"]]
+        self.subnets = [FakeObject(**s) for s in data["subnets"]]
+        self.images = []
+        for i in data["images"]:
+            i = dict(i)
+            i["block_device_mapping"] = dict(
+                (dev, FakeObject(**bd))
+                for dev, bd in i["block_device_mapping"].iteritems())
+            self.images.append(FakeObject(region=self.info, **i))
+        self.instances = []
+        for i in data["instances"]:
+            i = dict(i, launch_time=_shift(i["launch_time"], delta))
+            self.add_instance(FakeObject(**i))
+        self.spot_requests = []
+        for r in data["spot_requests"]:
+            r = dict(r, create_time=_shift(r.get("create_time"), delta))
+            r["launch_specification"] = FakeObject(**r["launch_specification"])
+            r["status"] = FakeObject(
+                code=r["status"]["code"],
+                update_time=_shift(r["status"]["update_time"], delta))
+            self.spot_requests.append(FakeObject(region=self.info, **r))
+        self.spot_prices = []
+        for p in data["spot_prices"]:
+            p = dict(p, timestamp=_shift(p["timestamp"], delta))
+            self.spot_prices.append(FakeObject(region=self.info, **p))
+        # AWS returns the most recent price points first
+        self.spot_prices.sort(key=lambda p: p.timestamp, reverse=True)
+
+    def add_instance(self, instance):
+        instance.region = self.info
+        instance.connection = self.connection
+        self.instances.append(instance)
+
+    def find_subnet(self, subnet_id):
+        for s in self.subnets:
+            if s.id == subnet_id:
+                return s
+
+
+class FakeConnection(object):
+
+    def __init__(self, region):
+        self._region = region
+        self.region = region.info
+
+    def _call(self, name):
+        self._region.ec2.count_call(self._region.name, name)
+
+    def get_all_zones(self):
+        self._call("get_all_zones")
+        return list(self._region.zones)
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        self._call("get_only_instances")
+        rv = []
+        for i in self._region.instances:
+            if instance_ids and i.id not in instance_ids:
+                continue
+            if self._instance_matches(i, filters or {}):
+                rv.append(i)
+        return rv
+
+    @staticmethod
+    def _instance_matches(i, filters):
+        for name, value in filters.iteritems():
+            if name == "instance-state-name":
+                actual = i.state
+            elif name == "instance-lifecycle":
+                actual = "spot" if i.spot_instance_request_id else None
+            elif name.startswith("tag:"):
+                actual = i.tags.get(name[4:])
+            else:
+                raise NotImplementedError("Unsupported filter %s" % name)
+            if not _matches(actual, value):
+                return False
+        return True
+
+    def get_all_spot_instance_requests(self, request_ids=None, filters=None):
+        self._call("get_all_spot_instance_requests")
+        rv = []
+        for r in self._region.spot_requests:
+            if request_ids and r.id not in request_ids:
+                continue
+            for name, value in (filters or {}).iteritems():
+                if name != "state":
+                    raise NotImplementedError("Unsupported filter %s" % name)
+                if not _matches(r.state, value):
+                    break
+            else:
+                rv.append(r)
+        return rv
+
+    def get_spot_price_history(self, start_time=None, end_time=None,
+                               instance_type=None, product_description=None,
+                               availability_zone=None, max_results=None,
+                               next_token=None):
+        self._call("get_spot_price_history")
+        if start_time:
+            start_time = aws_time_to_datetime(start_time)
+        matching = [
+            p for p in self._region.spot_prices
+            if (not instance_type or p.instance_type == instance_type) and
+            (not product_description or
+             p.product_description == product_description) and
+            (not availability_zone or
+             p.availability_zone == availability_zone) and
+            (not start_time or aws_time_to_datetime(p.timestamp) >= start_time)
+        ]
+        offset = int(next_token or 0)
+        end = offset + max_results if max_results else len(matching)
+        rv = FakeResultSet(matching[offset:end])
+        if end < len(matching):
+            rv.next_token = str(end)
+        return rv
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self._call("get_all_images")
+        rv = []
+        for ami in self._region.images:
+            if image_ids and ami.id not in image_ids:
+                continue
+            for name, value in (filters or {}).iteritems():
+                if name == "state":
+                    actual = ami.state
+                elif name == "root-device-type":
+                    actual = ami.root_device_type
+                elif name.startswith("tag:"):
+                    actual = ami.tags.get(name[4:])
+                else:
+                    raise NotImplementedError("Unsupported filter %s" % name)
+                if not _matches(actual, value):
+                    break
+            else:
+                rv.append(ami)
+        return rv
+
+    def request_spot_instances(self, price, image_id, count=1,
+                               instance_type=None, network_interfaces=None,
+                               **kwargs):
+        self._call("request_spot_instances")
+        subnet_id = network_interfaces[0].subnet_id \
+            if network_interfaces else None
+        subnet = self._region.find_subnet(subnet_id)
+        now = format_aws_time(time.time())
+        rv = []
+        for _ in range(count):
+            r = FakeObject(
+                id=self._region.ec2.new_id("sir"), state="open", tags={},
+                price=price, instance_id=None, create_time=now,
+                launched_availability_zone=subnet.availability_zone
+                if subnet else None,
+                launch_specification=FakeObject(
+                    instance_type=instance_type, image_id=image_id,
+                    subnet_id=subnet_id),
+                status=FakeObject(code="pending-evaluation", update_time=now),
+                region=self.region)
+            self._region.spot_requests.append(r)
+            self._region.ec2.launches.append(("spot", r))
+            rv.append(r)
+        return rv
+
+    def run_instances(self, image_id, instance_type=None,
+                      network_interfaces=None, **kwargs):
+        self._call("run_instances")
+        subnet_id = network_interfaces[0].subnet_id \
+            if network_interfaces else None
+        subnet = self._region.find_subnet(subnet_id)
+        ami = ([a for a in self._region.images if a.id == image_id] or
+               [None])[0]
+        i = FakeObject(
+            id=self._region.ec2.new_id("i"), state="pending", tags={},
+            instance_type=instance_type, image_id=image_id,
+            launch_time=format_aws_time(time.time()),
+            spot_instance_request_id=None,
+            placement=subnet.availability_zone if subnet else None,
+            subnet_id=subnet_id, private_ip_address=None,
+            virtualization_type=getattr(ami, "virtualization_type", None),
+            root_device_type=getattr(ami, "root_device_type", None))
+        self._region.add_instance(i)
+        self._region.ec2.launches.append(("ondemand", i))
+        return FakeObject(instances=[i])
+
+    def create_tags(self, resource_ids, tags):
+        self._call("create_tags")
+        objects = dict((o.id, o) for o in
+                       self._region.instances + self._region.spot_requests +
+                       self._region.images)
+        for resource_id in resource_ids:
+            objects[resource_id].tags.update(tags)
+
+
+class FakeVPC(object):
+
+    def __init__(self, region):
+        self._region = region
+
+    def get_all_subnets(self, subnet_ids=None):
+        self._region.ec2.count_call(self._region.name, "get_all_subnets")
+        return [s for s in self._region.subnets
+                if not subnet_ids or s.id in subnet_ids]
+
+
+class FakeEC2(object):
+    """Fake EC2 regions loaded from a {region: dump_region() result} dict.
+    `recorded_at` is used to shift time stamps to the current time."""
+
+    def __init__(self, regions, recorded_at=None):
+        delta = time.time() - recorded_at if recorded_at else 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        # (lifecycle, spot request or instance) tuples in launch order
+        self.launches = []
+        self.regions = dict((name, FakeRegion(self, name, data, delta))
+                            for name, data in regions.iteritems())
+
+    def new_id(self, prefix):
+        with self._lock:
+            return "%s-sim%05d" % (prefix, next(self._ids))
+
+    def count_call(self, region, name):
+        with self._lock:
+            self.calls[region, name] += 1
+
+    def connect_to_region(self, region_name, **kwargs):
+        return self.regions[region_name].connection
+
+    def vpc_connection(self, region=None, **kwargs):
+        return self.regions[region.name].vpc
+
+    def decisions(self):
+        """Returns a list of dicts describing the launches"""
+        rv = []
+        for lifecycle, obj in self.launches:
+            if lifecycle == "spot":
+                spec = obj.launch_specification
+                instance_type, image_id, subnet_id = \
+                    spec.instance_type, spec.image_id, spec.subnet_id
+                availability_zone = obj.launched_availability_zone
+            else:
+                instance_type, image_id, subnet_id = \
+                    obj.instance_type, obj.image_id, obj.subnet_id
+                availability_zone = obj.placement
+            rv.append({
+                "id": obj.id,
+                "lifecycle": lifecycle,
+                "region": obj.region.name,
+                "moz_instance_type": obj.tags.get("moz-type"),
+                "name": obj.tags.get("Name"),
+                "instance_type": instance_type,
+                "image_id": image_id,
+                "availability_zone": availability_zone,
+                "subnet_id": subnet_id,
+                "price": getattr(obj, "price", None),
+            })
+        return rv
@@ -0,0 +1,63 @@
+"""
+Per-cycle index of the fleet.
+
+FleetIndex is an immutable sequence of instances, so it can be passed
+wherever a list of instances is expected. The filtering helpers in
+cloudtools.aws use the index when they get one instead of scanning the
+whole fleet.
+"""
+import heapq
+from collections import defaultdict
+
+# Wildcard for FleetIndex.select
+ANY = object()
+
+
+def instance_key(i):
+    """Returns the (moz-type, state, moz-state, lifecycle, region) index key
+    of an instance"""
+    lifecycle = "spot" if i.spot_instance_request_id else "ondemand"
+    return (i.tags.get("moz-type"), i.state, i.tags.get("moz-state"),
+            lifecycle, i.region.name)
+
+
+class FleetIndex(tuple):
+
+    def __new__(cls, instances):
+        return tuple.__new__(cls, instances)
+
+    def __init__(self, instances):
+        # index key -> sorted positions of the matching instances
+        self._positions = defaultdict(list)
+        self._ids_by_ami = defaultdict(set)
+        self.ids = set()
+        self.loaned_ids = set()
+        for pos, i in enumerate(self):
+            self._positions[instance_key(i)].append(pos)
+            self._ids_by_ami[i.image_id].add(i.id)
+            self.ids.add(i.id)
+            if i.tags.get("moz-loaned-to"):
+                self.loaned_ids.add(i.id)
+
+    def select(self, moz_type=ANY, state=ANY, moz_state=ANY, lifecycle=ANY,
+               region=ANY):
+        """Returns a FleetIndex of the instances matching all the given
+        fields, in fleet order. Omitted fields match anything, None matches
+        instances without the tag."""
+        wanted = (moz_type, state, moz_state, lifecycle, region)
+        if ANY not in wanted:
+            positions = [self._positions.get(wanted, [])]
+        else:
+            positions = [
+                p for key, p in self._positions.iteritems()
+                if all(w is ANY or w == k for w, k in zip(wanted, key))]
+        return FleetIndex(self[pos] for pos in heapq.merge(*positions))
+
+    def ids_by_ami(self, image_id):
+        return self._ids_by_ami.get(image_id, set())
+
+    def count_by_ami(self, image_id):
+        return len(self.ids_by_ami(image_id))
+
+    def is_loaned(self, instance):
+        return instance.id in self.loaned_ids
@@ -0,0 +1,121 @@
+"""Long lived view of the fleet for scripts running in daemon mode.
+
+One-shot scripts rely on the per-process caches kept by cloudtools.aws and
+its submodules. A long running process keeps these caches warm between
+cycles and expires every kind of data on its own schedule.
+"""
+import time
+import logging
+from collections import deque
+
+from . import aws_get_all_instances, invalidate_instances_cache
+from .ami import invalidate_spot_amis_cache
+from .spot import get_active_spot_requests, invalidate_spot_requests_cache, \
+    invalidate_spot_prices_cache, invalidate_slave_names_cache
+from .vpc import invalidate_subnets_cache
+from ..slavealloc import invalidate_classified_slaves_cache
+
+log = logging.getLogger(__name__)
+
+# Seconds between refreshes of every kind of data
+DEFAULT_REFRESH_INTERVALS = {
+    "instances": 60,
+    "spot_requests": 30,
+    "spot_prices": 5 * 60,
+    "amis": 10 * 60,
+    "subnets": 5 * 60,
+    "slaves": 10 * 60,
+}
+# Maximum number of seconds a launch is considered in flight, i.e. not yet
+# visible as a running and ready instance
+LAUNCH_GRACE = 5 * 60
+
+_invalidators = {
+    "instances": invalidate_instances_cache,
+    "spot_requests": invalidate_spot_requests_cache,
+    "spot_prices": invalidate_spot_prices_cache,
+    "amis": invalidate_spot_amis_cache,
+    "subnets": invalidate_subnets_cache,
+    "slaves": invalidate_classified_slaves_cache,
+}
+
+
+class Inventory(object):
+    """Tracks when cached fleet data was last fetched and which launches are
+    still in flight"""
+
+    def __init__(self, regions, refresh_intervals=None,
+                 launch_grace=LAUNCH_GRACE):
+        self.regions = regions
+        self.refresh_intervals = dict(DEFAULT_REFRESH_INTERVALS)
+        if refresh_intervals:
+            self.refresh_intervals.update(refresh_intervals)
+        self.launch_grace = launch_grace
+        self._last_refresh = {}
+        # (timestamp, moz_instance_type, instance or spot request id)
+        self._launches = deque()
+
+    def stale(self, now=None):
+        """Returns a set of data kinds which need to be refreshed"""
+        if now is None:
+            now = time.time()
+        retval = set()
+        for kind, interval in self.refresh_intervals.iteritems():
+            last = self._last_refresh.get(kind)
+            if last is None or now - last >= interval:
+                retval.add(kind)
+        return retval
+
+    def refresh(self, force=False, now=None):
+        """Expires stale caches and refetches instances and spot requests.
+        Returns a set of refreshed data kinds"""
+        if now is None:
+            now = time.time()
+        if force:
+            kinds = set(self.refresh_intervals)
+        else:
+            kinds = self.stale(now)
+        if "instances" in kinds:
+            # Available slave names are calculated using both instances and
+            # spot requests, refresh them together
+            kinds.add("spot_requests")
+            invalidate_slave_names_cache()
+        if "subnets" in kinds:
+            # Refreshing subnets resets the IP ledger, which subtracts the
+            # open spot requests from the fresh IP counts
+            kinds.add("spot_requests")
+        for kind in sorted(kinds):
+            log.debug("refreshing %s", kind)
+            _invalidators[kind]()
+            self._last_refresh[kind] = now
+
+        if "instances" in kinds:
+            aws_get_all_instances(self.regions)
+        if "spot_requests" in kinds:
+            for region in self.regions:
+                get_active_spot_requests(region)
+        return kinds
+
+    def record_launches(self, moz_instance_type, resource_ids, now=None):
+        """Records launched instance or spot request ids"""
+        if now is None:
+            now = time.time()
+        for resource_id in resource_ids:
+            self._launches.append((now, moz_instance_type, resource_id))
+
+    def in_flight(self, moz_instance_type, instances=(), now=None):
+        """Returns the number of instances of moz_instance_type launched within
+        the last launch_grace seconds which are not in `instances` yet, by
+        instance or spot request id"""
+        if now is None:
+            now = time.time()
+        while self._launches and \
+                now - self._launches[0][0] > self.launch_grace:
+            self._launches.popleft()
+        landed = set()
+        for i in instances:
+            landed.add(i.id)
+            if i.spot_instance_request_id:
+                landed.add(i.spot_instance_request_id)
+        return sum(1 for _, t, resource_id in self._launches
+                   if t == moz_instance_type and resource_id not in landed)
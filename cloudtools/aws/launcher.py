@@ -0,0 +1,90 @@
+"""
+Concurrent instance launches.
+
+Callers decide what to launch serially, so names, subnet IPs and limits are
+accounted for before anything is submitted, and hand the API calls over to
+a Launcher. Launches of different moz-types, regions and availability
+zones then run in parallel, throttled by cloudtools.aws.ratelimit.
+"""
+import logging
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+log = logging.getLogger(__name__)
+
+# Number of launches run in parallel
+LAUNCH_WORKERS = 16
+
+
+class Launcher(object):
+    """Runs launch functions on a thread pool. Launch functions return the
+    number of started instances, results are summed up per key. They can
+    also record the ids of the launched resources."""
+
+    def __init__(self, max_workers=LAUNCH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._started = Counter()
+        self._launched = defaultdict(list)
+        self._gave_up = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, key, func, *args, **kwargs):
+        future = self._executor.submit(func, *args, **kwargs)
+        with self._lock:
+            self._futures[future] = key
+        return future
+
+    def record(self, key, count):
+        """Records instances started without submitting a launch, e.g. in
+        dry run mode"""
+        with self._lock:
+            self._started[key] += count
+
+    def record_launched(self, key, resource_id):
+        """Records the id of a launched instance or spot request"""
+        with self._lock:
+            self._launched[key].append(resource_id)
+
+    def pop_launched(self):
+        """Returns the ids recorded by record_launched per key and resets
+        them"""
+        with self._lock:
+            launched, self._launched = self._launched, defaultdict(list)
+        return launched
+
+    def give_up(self, scope):
+        """Makes gave_up(scope) true, used by launch functions to skip the
+        remaining launches after a fatal error"""
+        with self._lock:
+            self._gave_up.add(scope)
+
+    def gave_up(self, scope):
+        with self._lock:
+            return scope in self._gave_up
+
+    def wait(self):
+        """Waits for the submitted launches. Returns a Counter of started
+        instances per key and resets it."""
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in as_completed(futures):
+            try:
+                started = future.result()
+            except Exception:
+                log.warn("Cannot start", exc_info=True)
+                continue
+            self.record(futures[future], started)
+        with self._lock:
+            started, self._started = self._started, Counter()
+        return started
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,269 @@
+"""
+Client side rate limiting and retries of AWS API calls.
+
+EC2 throttles API requests per account, region and action. Calls made
+through call_aws() wait for a slot in three token buckets shared by all
+threads:
+
+ * a global bucket, which sets the overall request rate target,
+ * a per region budget, which halves its rate every time EC2 answers with
+   RequestLimitExceeded and slowly recovers on success,
+ * a per (region, action) bucket following the EC2 limits of the action.
+
+Throttled calls are retried with jittered exponential backoff, so that
+concurrent callers don't retry in lockstep. get_throttle_stats() returns
+how many calls were throttled and retried and how long they waited.
+"""
+import fnmatch
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+from collections import Counter
+
+from boto.exception import BotoServerError
+
+log = logging.getLogger(__name__)
+
+# action -> (sustained requests per second, burst size), following the EC2
+# API throttling defaults
+DEFAULT_RATE_LIMITS = {
+    "RequestSpotInstances": (5, 200),
+    "RunInstances": (2, 1000),
+    "CreateTags": (5, 200),
+}
+# Used for actions missing in the limits above
+DEFAULT_RATE_LIMIT = (20, 100)
+# Request rate target over all regions and actions
+GLOBAL_RATE_LIMIT = (50, 200)
+# Per region budget. The rate is halved on RequestLimitExceeded, down to
+# MIN_REGION_RATE, and grows by REGION_RATE_STEP on every successful call.
+REGION_RATE_LIMIT = (25, 200)
+MIN_REGION_RATE = 0.5
+REGION_RATE_STEP = 0.1
+
+# Error codes meaning that we are calling too fast
+THROTTLING_CODES = ("RequestLimitExceeded", "Throttling")
+# Matches the errors returned for resources which are not visible yet
+NOT_FOUND = "*.NotFound"
+# Error codes of transient server side failures
+TRANSIENT_CODES = ("InternalError", "InternalFailure", "ServiceUnavailable",
+                   "Unavailable")
+# Exponential backoff, in seconds
+BACKOFF_BASE = 2
+BACKOFF_CAP = 30
+MAX_TRIES = 10
+
+_rate_limits = dict(DEFAULT_RATE_LIMITS)
+_buckets = {}
+_buckets_lock = threading.Lock()
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Allows `burst` back to back calls, then `rate` calls per second.
+
+    Callers reserve a slot under the lock and sleep outside of it, so a
+    single bucket can be shared by many threads."""
+
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        # The time the next call would be scheduled at if there was no burst
+        self._next_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return 1.0 / self.interval
+
+    def reserve(self):
+        """Reserves a slot. Returns the number of seconds to wait for it"""
+        with self._lock:
+            now = time.time()
+            next_at = max(self._next_at, now)
+            self._next_at = next_at + self.interval
+        return max(0, next_at - now - (self.burst - 1) * self.interval)
+
+    def acquire(self):
+        """Waits for a slot. Returns the time spent waiting"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """A token bucket which slows down when told to, additive increase and
+    multiplicative decrease style"""
+
+    def __init__(self, rate, burst, min_rate, step):
+        super(AdaptiveTokenBucket, self).__init__(rate, burst)
+        self.max_rate = rate
+        self.max_burst = burst
+        self.min_rate = min_rate
+        self.step = step
+
+    def _set_rate(self, rate):
+        with self._lock:
+            self.interval = 1.0 / rate
+            # No bursts until we are back at full speed
+            self.burst = self.max_burst if rate >= self.max_rate else 1
+
+    def slow_down(self):
+        self._set_rate(max(self.min_rate, self.rate / 2))
+        log.debug("slowing down to %.2f requests/s", self.rate)
+
+    def speed_up(self):
+        if self.rate < self.max_rate:
+            self._set_rate(min(self.max_rate, self.rate + self.step))
+
+
+def set_rate_limits(limits):
+    """Overrides the default per action limits. `limits` maps API actions to
+    {"rate": requests per second, "burst": burst size} dicts"""
+    global _rate_limits
+    _rate_limits = dict(DEFAULT_RATE_LIMITS)
+    for action, limit in (limits or {}).iteritems():
+        _rate_limits[action] = (limit["rate"], limit["burst"])
+    reset_token_buckets()
+
+
+def reset_token_buckets():
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def _get_bucket(key, factory):
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = factory()
+        return _buckets[key]
+
+
+def get_token_bucket(region, action):
+    return _get_bucket(
+        ("action", region, action),
+        lambda: TokenBucket(*_rate_limits.get(action, DEFAULT_RATE_LIMIT)))
+
+
+def get_region_budget(region):
+    return _get_bucket(
+        ("region", region),
+        lambda: AdaptiveTokenBucket(*REGION_RATE_LIMIT,
+                                    min_rate=MIN_REGION_RATE,
+                                    step=REGION_RATE_STEP))
+
+
+def get_global_budget():
+    return _get_bucket(("global",),
+                       lambda: TokenBucket(*GLOBAL_RATE_LIMIT))
+
+
+def _count(**values):
+    with _stats_lock:
+        _stats.update(values)
+
+
+def get_throttle_stats():
+    """Returns a dict with the number of calls, throttled calls, retries and
+    the seconds spent waiting for rate limits and backing off"""
+    with _stats_lock:
+        rv = dict.fromkeys(["calls", "throttled", "retries", "wait_seconds",
+                            "backoff_seconds"], 0)
+        rv.update(_stats)
+        return rv
+
+
+def reset_throttle_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def log_throttle_stats():
+    stats = get_throttle_stats()
+    log.info("AWS API: %(calls)i calls, %(throttled)i throttled, "
+             "%(retries)i retries, %(wait_seconds).1fs waiting for rate "
+             "limits, %(backoff_seconds).1fs backing off", stats)
+
+
+def report_throttle_stats(graphite_logger=None, prefix="aws_api"):
+    """Logs the throttle stats, adds them to `graphite_logger` if given and
+    resets them"""
+    log_throttle_stats()
+    if graphite_logger:
+        for name, value in get_throttle_stats().iteritems():
+            graphite_logger.add("%s.%s" % (prefix, name), value)
+    reset_throttle_stats()
+
+
+def throttle(region, action):
+    """Waits until `action` can be called in `region`"""
+    delay = 0
+    for bucket in (get_global_budget(), get_region_budget(region),
+                   get_token_bucket(region, action)):
+        delay += bucket.acquire()
+    if delay > 0:
+        log.debug("%s %s throttled for %.2fs", region, action, delay)
+        _count(wait_seconds=delay)
+    return delay
+
+
+def backoff_delay(attempt):
+    """Returns how long to sleep before retry number `attempt` (starting
+    with 0): half of the exponential delay plus up to the other half at
+    random"""
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def _matches(code, patterns):
+    return any(fnmatch.fnmatchcase(code or "", p) for p in patterns)
+
+
+def is_transient(e):
+    """Returns True for server side and network errors, which are worth
+    retrying"""
+    if isinstance(e, BotoServerError):
+        return e.status >= 500 or _matches(e.code, TRANSIENT_CODES)
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+
+def call_aws(region, action, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) once rate limits allow calling `action`
+    in `region`. Retries throttled calls and calls failing with one of the
+    `retry_codes` keyword argument error codes (shell patterns) up to
+    `max_tries` times."""
+    retry_codes = kwargs.pop("retry_codes", ())
+    max_tries = kwargs.pop("max_tries", MAX_TRIES)
+    for attempt in range(max_tries):
+        throttle(region, action)
+        _count(calls=1)
+        try:
+            rv = func(*args, **kwargs)
+        except BotoServerError, e:
+            if e.code in THROTTLING_CODES:
+                _count(throttled=1)
+                get_region_budget(region).slow_down()
+            elif not _matches(e.code, retry_codes):
+                raise
+            if attempt == max_tries - 1:
+                raise
+            delay = backoff_delay(attempt)
+            log.debug("%s %s: %s; retrying in %.2fs", region, action, e.code,
+                      delay)
+            _count(retries=1, backoff_seconds=delay)
+            time.sleep(delay)
+            continue
+        get_region_budget(region).speed_up()
+        return rv
+
+
+def get_region_name(obj):
+    """Returns the region of a boto connection or EC2 object"""
+    region = getattr(obj, "region", None) or \
+        getattr(getattr(obj, "connection", None), "region", None)
+    return getattr(region, "name", None)
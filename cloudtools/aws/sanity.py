@@ -7,8 +7,11 @@ import logging
 import urllib2
 import socket
 import calendar
+import threading
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from cloudtools.aws import parse_aws_time
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
 
 log = logging.getLogger(__name__)
 
@@ -17,6 +20,14 @@ BUILDAPI_URL_JSON = "http://buildapi.pvt.build.mozilla.org/buildapi/recent/" \
 BUILDAPI_URL = "http://buildapi.pvt.build.mozilla.org/buildapi/recent/" \
     "{slave_name}"
 
+# Seconds to wait for buildapi
+BUILDAPI_TIMEOUT = 5
+# Number of buildapi requests in flight
+BUILDAPI_WORKERS = 16
+# Seconds the buildapi results are reused for
+BUILDAPI_CACHE_TTL = 30 * 60
+BUILDAPI_CACHE_VERSION = 1
+
 SLAVE_TAGS = ('try-linux64', 'tst-linux32', 'tst-linux64', 'tst-emulator64',
               'bld-linux64', 'av-linux64')
 
@@ -75,6 +86,141 @@ def timedelta_to_time_string(timeout):
     return time_string
 
 
+def fetch_last_job_endtime(slave_name, timeout=BUILDAPI_TIMEOUT):
+    """gets the last endtime of slave_name from buildapi. Returns
+       (endtime, fetched): endtime is None if no job ended, fetched is False
+       if buildapi could not be reached"""
+    url = BUILDAPI_URL_JSON.format(slave_name=slave_name)
+    endtime = None
+    try:
+        json_data = urllib2.urlopen(url, timeout=timeout)
+        data = json.load(json_data)
+        try:
+            endtime = max([job['endtime'] for job in data])
+            log.debug("{slave}: max endtime: {endtime}".format(
+                slave=slave_name, endtime=endtime))
+        except TypeError:
+            # somehow endtime is not set
+            # ignore and use None
+            log.debug("{slave}: endtime is not set".format(slave=slave_name))
+        except ValueError:
+            # no jobs completed, ignore
+            log.debug("{slave}: no jobs completed".format(slave=slave_name))
+    except urllib2.HTTPError as error:
+        log.debug('http error {0}, url: {1}'.format(error.code, url))
+        return None, False
+    except urllib2.URLError as error:
+        # in python < 2.7 this exception intercepts timeouts
+        log.debug('url: {0} - error {1}'.format(url, error.reason))
+        return None, False
+    # in python > 2.7, timeout is a socket.timeout exception
+    except socket.timeout as error:
+        log.debug('connection timed out, url: {0}'.format(url))
+        return None, False
+    return endtime, True
+
+
+class BuildapiCache(object):
+    """last job endtimes by slave name, shared by all the Slave objects of a
+       report and optionally kept in a json file. Entries older than ttl
+       seconds are fetched again. Entries loaded from the file may miss the
+       latest jobs, Slave only uses them when they can't make it lazy.
+       Failed lookups are remembered for the lifetime of the cache only, so
+       that an unreachable buildapi is asked once per slave and run"""
+    def __init__(self, filename=None, ttl=BUILDAPI_CACHE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # slave name -> (endtime, fetch time)
+        self._entries = {}
+        self._failed = set()
+        # slaves fetched during the lifetime of the cache
+        self._fresh = set()
+        if filename:
+            self.load()
+
+    def load(self):
+        """loads the cache file, ignoring missing or corrupted files"""
+        entries = load_versioned_json(
+            self.filename, BUILDAPI_CACHE_VERSION, 'slaves',
+            lambda d: dict((name, tuple(entry))
+                           for name, entry in d.iteritems()))
+        if entries is not None:
+            self._entries = entries
+
+    def save(self):
+        """writes the entries which are not expired to the cache file"""
+        if not self.filename:
+            return
+        now = time.time()
+        with self._lock:
+            slaves = dict((name, list(entry))
+                          for name, entry in self._entries.iteritems()
+                          if now - entry[1] < self.ttl)
+        save_versioned_json(self.filename, BUILDAPI_CACHE_VERSION, 'slaves',
+                            slaves)
+
+    def __contains__(self, slave_name):
+        with self._lock:
+            entry = self._entries.get(slave_name)
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def get(self, slave_name):
+        """returns the cached endtime, None if unknown, expired or if the
+           slave has no ended job"""
+        if slave_name not in self:
+            return None
+        with self._lock:
+            return self._entries[slave_name][0]
+
+    def set(self, slave_name, endtime):
+        with self._lock:
+            self._entries[slave_name] = (endtime, time.time())
+            self._failed.discard(slave_name)
+            self._fresh.add(slave_name)
+
+    def is_fresh(self, slave_name):
+        """returns True if the slave was fetched during the lifetime of the
+           cache, not loaded from the file"""
+        with self._lock:
+            return slave_name in self._fresh
+
+    def set_failed(self, slave_name):
+        """remembers, in memory only, that buildapi had no answer"""
+        with self._lock:
+            self._failed.add(slave_name)
+
+    def has_failed(self, slave_name):
+        with self._lock:
+            return slave_name in self._failed
+
+    def fetch(self, slave_names, workers=BUILDAPI_WORKERS,
+              timeout=BUILDAPI_TIMEOUT, refetch=()):
+        """fetches the slaves which are not cached yet, and the `refetch`
+           ones which were loaded from the file, `workers` at a time.
+           Failed lookups are not retried"""
+        refetch = set(refetch)
+        slave_names = sorted(set(
+            n for n in slave_names
+            if n not in ('tmp', None) and not self.has_failed(n) and
+            (n not in self or (n in refetch and not self.is_fresh(n)))))
+        if not slave_names:
+            return
+        log.debug('fetching %s slaves from buildapi', len(slave_names))
+        executor = ThreadPoolExecutor(
+            max_workers=min(workers, len(slave_names)))
+        try:
+            results = executor.map(
+                lambda n: fetch_last_job_endtime(n, timeout), slave_names)
+            for slave_name, (endtime, fetched) in zip(slave_names, results):
+                if fetched:
+                    self.set(slave_name, endtime)
+                else:
+                    self.set_failed(slave_name)
+        finally:
+            executor.shutdown(wait=True)
+
+
 def launch_time_to_epoch(launch_time):
     """converts a lunch_time into a timestamp"""
     return calendar.timegm(
@@ -352,6 +498,10 @@ class AWSInstance(object):
 
 class Slave(AWSInstance):
     """AWS slave"""
+    def __init__(self, instance, events_dir=None, buildapi_cache=None):
+        super(Slave, self).__init__(instance, events_dir)
+        self.buildapi_cache = buildapi_cache
+
     def when_last_job_ended(self):
         """converts get_last_job_endtime into a human readable format"""
         last_job = self.get_last_job_endtime()
@@ -360,43 +510,43 @@ class Slave(AWSInstance):
             last_job = timedelta_to_time_string(delta)
         return last_job
 
-    def get_last_job_endtime(self, timeout=5):
-        """gets the last endtime from buildapi"""
+    def get_last_job_endtime(self, timeout=BUILDAPI_TIMEOUT):
+        """gets the last endtime from the buildapi cache, or from buildapi"""
         # discard tmp and None instances as they are not on buildapi
-        if self.get_name in ['tmp', None]:
+        if self.get_name() in ['tmp', None]:
             self.last_job_endtime = self.now
             return self.last_job_endtime
         if self.last_job_endtime:
             return self.last_job_endtime
-        url = self.get_buildapi_json_url()
-        endtime = self.now
-        try:
-            json_data = urllib2.urlopen(url, timeout=timeout)
-            data = json.load(json_data)
-            try:
-                endtime = max([job['endtime'] for job in data])
-                log.debug("{instance}: max endtime: {endtime}".format(
-                    instance=self.get_id(), endtime=endtime))
-            except TypeError:
-                # somehow endtime is not set
-                # ignore and use None
-                log.debug("{instance}: endtime is not set".format(
-                    instance=self.get_id()))
-            except ValueError:
-                # no jobs completed, ignore
-                log.debug("{instance}: no jobs completed".format(
-                    instance=self.get_id()))
-        except urllib2.HTTPError as error:
-            log.debug('http error {0}, url: {1}'.format(error.code, url))
-        except urllib2.URLError as error:
-            # in python < 2.7 this exception intercepts timeouts
-            log.debug('url: {0} - error {1}'.format(url, error.reason))
-        # in python > 2.7, timeout is a socket.timeout exception
-        except socket.timeout as error:
-            log.debug('connection timed out, url: {0}'.format(url))
-        self.last_job_endtime = endtime
+        cache = self.buildapi_cache
+        if self.cached_endtime_usable():
+            endtime = cache.get(self.get_name())
+        elif cache is not None and cache.has_failed(self.get_name()):
+            endtime = None
+        else:
+            endtime, fetched = fetch_last_job_endtime(self.get_name(),
+                                                      timeout)
+            if cache is not None and fetched:
+                cache.set(self.get_name(), endtime)
+            elif cache is not None:
+                cache.set_failed(self.get_name())
+        # no info from buildapi, assume a recent job
+        self.last_job_endtime = endtime or self.now
         return self.last_job_endtime
 
+    def cached_endtime_usable(self):
+        """returns True if the cached endtime can be used. Jobs may have
+           ended since an endtime loaded from the cache file was fetched, so
+           it is only used if the slave isn't lazy anyway: lazy spot
+           instances get terminated"""
+        cache = self.buildapi_cache
+        if cache is None or self.get_name() not in cache:
+            return False
+        if cache.is_fresh(self.get_name()):
+            return True
+        endtime = cache.get(self.get_name())
+        return endtime is None or self.now - endtime < self.max_uptime
+
     def get_buildapi_url(self):
         """returns buildapi's url"""
         return BUILDAPI_URL.format(slave_name=self.get_name())
@@ -432,9 +582,9 @@ class Slave(AWSInstance):
         return message
 
 
-def aws_instance_factory(instance, events_dir):
+def aws_instance_factory(instance, events_dir, buildapi_cache=None):
     aws_instance = AWSInstance(instance)
     # is aws_instance a slave ?
     if aws_instance.get_instance_type() in SLAVE_TAGS:
-        aws_instance = Slave(instance, events_dir)
+        aws_instance = Slave(instance, events_dir, buildapi_cache)
     return aws_instance
@@ -1,8 +1,12 @@
 import logging
 import boto
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from repoze.lru import lru_cache
-from . import get_aws_connection, aws_time_to_datetime, retry_aws_request
+from repoze.lru import lru_cache, LRUCache
+from boto.exception import BotoServerError
+from . import get_aws_connection, aws_time_to_datetime
+from .ratelimit import call_aws, get_region_name
 from ..slavealloc import get_classified_slaves
 
 CANCEL_STATUS_CODES = ["capacity-oversubscribed", "price-too-low",
@@ -18,7 +22,15 @@ IGNORABLE_STATUS_CODES = CANCEL_STATUS_CODES + TERMINATED_BY_AWS_STATUS_CODES \
 
 log = logging.getLogger(__name__)
 _spot_cache = {}
+_spot_price_store = None
 _spot_requests = {}
+_active_spot_requests_cache = LRUCache(10)
+_filtered_spot_requests_cache = LRUCache(100)
+_usable_spot_choice_cache = LRUCache(100)
+# Maximum allowed by the DescribeSpotPriceHistory API
+SPOT_PRICE_HISTORY_PAGE_SIZE = 1000
+# Number of spot price history requests run in parallel
+SPOT_PRICE_WORKERS = 8
 
 
 def populate_spot_requests_cache(region, request_ids=None):
@@ -84,10 +96,36 @@ def copy_spot_request_tags(i):
                      tag_value, i)
             tags[tag_name] = tag_value
     tags["moz-state"] = "ready"
-    retry_aws_request(i.connection.create_tags, [i.id], tags)
+    call_aws(i.region.name, "CreateTags", i.connection.create_tags, [i.id],
+             tags)
 
 
-@lru_cache(10)
+def create_tags_with_retries(conn, resource_ids, tags, max_tries=10):
+    """Tags freshly created resources, waiting for them to become visible"""
+    call_aws(get_region_name(conn), "CreateTags", conn.create_tags,
+             resource_ids, tags,
+             retry_codes=["InvalidSpotInstanceRequestID.NotFound"],
+             max_tries=max_tries)
+
+
+def tag_spot_requests(region, requests, moz_instance_type):
+    """Tags new spot requests. `requests` is a list of (spot_request, name,
+    fqdn) tuples. Returns a list of successfully tagged spot requests"""
+    conn = get_aws_connection(region)
+    tagged = []
+    for sir, name, fqdn in requests:
+        # All tags are set in one call. Name will be used to determine
+        # available slave names.
+        tags = {"moz-type": moz_instance_type, "Name": name, "FQDN": fqdn}
+        try:
+            create_tags_with_retries(conn, [sir.id], tags)
+            tagged.append(sir)
+        except BotoServerError:
+            log.warn("Cannot tag %s (%s)", sir.id, name, exc_info=True)
+    return tagged
+
+
+@lru_cache(10, cache=_active_spot_requests_cache)
 def get_active_spot_requests(region):
     """Gets open and active spot requests"""
     log.debug("getting all spot requests for %s", region)
@@ -97,7 +135,7 @@ def get_active_spot_requests(region):
     return spot_requests
 
 
-@lru_cache(100)
+@lru_cache(100, cache=_filtered_spot_requests_cache)
 def get_spot_requests(region, instance_type, availability_zone):
     log.debug("getting filtered spot requests for %s (%s)", availability_zone,
               instance_type)
@@ -115,13 +153,21 @@ def get_spot_requests(region, instance_type, availability_zone):
     return retval
 
 
+def invalidate_spot_requests_cache():
+    """Forget cached spot requests and everything derived from them"""
+    _spot_requests.clear()
+    _active_spot_requests_cache.clear()
+    _filtered_spot_requests_cache.clear()
+    _usable_spot_choice_cache.clear()
+
+
 def get_spot_requests_for_moztype(region, moz_instance_type):
     """retruns a list of all open and active spot requests"""
     req = get_active_spot_requests(region)
     return [r for r in req if r.tags.get('moz-type') == moz_instance_type]
 
 
-@lru_cache(100)
+@lru_cache(100, cache=_usable_spot_choice_cache)
 def usable_spot_choice(choice, minutes=15):
     """Sanity check recent spot requests"""
     region = choice.region
@@ -203,13 +249,21 @@ def get_available_slave_name(region, moz_instance_type, is_spot,
                                         is_spot, all_instances)
 
 
+def invalidate_slave_names_cache():
+    """Forget available slave names. They are recalculated from the instance
+    and spot request lists on the next get_available_slave_name call"""
+    _avail_slave_names.clear()
+
+
 def get_current_spot_prices(connection, product_description, start_time=None,
                             instance_type=None, ignored_availability_zones=None,
                             ignore_cache=False):
     """
     Get the current spot prices for the region associated with the given
     connection. This may return cached results. Pass ignore_cache=True to
-    bypass the cache
+    bypass the cache. If a persistent store is set using
+    set_spot_price_store, only price points newer than the stored ones are
+    fetched.
 
     Args:
         connection (boto.ec2.Connection): connection to a region
@@ -236,55 +290,102 @@ def get_current_spot_prices(connection, product_description, start_time=None,
         log.debug("using cached pricing for %s in %s", instance_type, region)
         return _spot_cache[cache_key]
 
+    if ignored_availability_zones is None:
+        ignored_availability_zones = []
+    all_zones = set([az.name for az in call_aws(
+        region, "DescribeAvailabilityZones", connection.get_all_zones)])
+    useful_zones = all_zones - set(ignored_availability_zones)
+
+    # The persistent store is used for the default time window only
+    store = _spot_price_store if instance_type and not start_time else None
+    stored = {}
+    if store:
+        stored = store.get(region, product_description, instance_type)
+        if not ignore_cache and store.is_fresh(stored, useful_zones):
+            log.debug("using stored pricing for %s in %s", instance_type,
+                      region)
+            retval = {region: {instance_type: dict(
+                (az, stored[az][0]) for az in useful_zones)}}
+            _spot_cache[cache_key] = retval
+            return retval
+        if useful_zones and all(az in stored for az in useful_zones):
+            # Only fetch price points newer than the stored ones
+            start_time = min(stored[az][1] for az in useful_zones)
+
     if not start_time:
         # Default to 24 hours
         now = datetime.utcnow()
         yesterday = now - timedelta(hours=24)
         start_time = yesterday.isoformat() + "Z"
 
-    if ignored_availability_zones is None:
-        ignored_availability_zones = []
-    all_zones = set([az.name for az in connection.get_all_zones()])
-    useful_zones = all_zones - set(ignored_availability_zones)
-    remaining = useful_zones
+    remaining = set(useful_zones)
+    timestamps = {}
     log.debug("getting spot prices for instance_type %s in %s, from %s",
               instance_type, sorted(remaining), start_time)
     while remaining:
-        all_prices = connection.get_spot_price_history(
+        all_prices = call_aws(
+            region, "DescribeSpotPriceHistory",
+            connection.get_spot_price_history,
             product_description=product_description,
             instance_type=instance_type,
             start_time=start_time,
-            max_results=50,
+            max_results=SPOT_PRICE_HISTORY_PAGE_SIZE,
             next_token=next_token,
         )
         next_token = all_prices.next_token
-        # make sure to sort them by the timestamp, so we don't process the same
-        # entry twice
-        all_prices = sorted(all_prices, key=lambda x: x.timestamp,
-                            reverse=True)
+        # Pick the latest price point per zone. Sorting the page is not
+        # needed, only the handful of winners are ordered by timestamp.
+        latest = {}
         for price in all_prices:
             az = price.availability_zone
             if az not in remaining:
                 continue
-            inst_type = price.instance_type
-            if not current_prices.get(inst_type):
-                current_prices[inst_type] = {}
-            if not current_prices[inst_type].get(az):
-                current_prices[inst_type][az] = price.price
-                remaining.remove(az)
-
-        if remaining:
-            log.debug("getting more prices for %s", sorted(remaining))
+            if az not in latest or price.timestamp > latest[az].timestamp:
+                latest[az] = price
+        for price in sorted(latest.values(), key=lambda x: x.timestamp,
+                            reverse=True):
+            az = price.availability_zone
+            current_prices.setdefault(price.instance_type, {})[az] = \
+                price.price
+            timestamps[az] = price.timestamp
+            remaining.remove(az)
+
+        if not remaining:
+            break
+        log.debug("getting more prices for %s", sorted(remaining))
         if not next_token:
             log.debug("ran out of prices, need an earlier start time than %s",
                       start_time)
             break
 
+    if store:
+        prices = current_prices.setdefault(instance_type, {})
+        to_store = {}
+        for az in useful_zones:
+            if az in prices:
+                to_store[az] = (prices[az], timestamps[az])
+            elif az in stored:
+                # No newer price points, the stored price is still current
+                prices[az] = stored[az][0]
+                to_store[az] = stored[az][:2]
+        store.update(region, product_description, instance_type, to_store)
+
     retval = {region: current_prices}
     _spot_cache[cache_key] = retval
     return retval
 
 
+def set_spot_price_store(store):
+    """Makes get_current_spot_prices use a persistent price store, e.g.
+    cloudtools.aws.spot_price_cache.SpotPriceCache"""
+    global _spot_price_store
+    _spot_price_store = store
+
+
+def invalidate_spot_prices_cache():
+    _spot_cache.clear()
+
+
 class Spot:
     def __init__(self, instance_type, region, availability_zone, current_price,
                  bid_price, performance_constant):
@@ -314,18 +415,59 @@ class Spot:
         return cmp(self.value, other.value)
 
 
+def plan_spot_price_requests(connections, rules):
+    """Returns a list of (connection, instance_type, ignored_azs) tuples,
+    one per region and instance type used by the rules. Zones are only
+    ignored if every rule using the instance type ignores them."""
+    ignored = OrderedDict()
+    for rule in rules:
+        azs = set(rule.get("ignored_azs", []))
+        instance_type = rule["instance_type"]
+        if instance_type in ignored:
+            ignored[instance_type] &= azs
+        else:
+            ignored[instance_type] = azs
+    plan = []
+    for instance_type, azs in ignored.iteritems():
+        for connection in connections:
+            plan.append((connection, instance_type, sorted(azs)))
+    return plan
+
+
+def fetch_spot_prices(connections, rules, product_description,
+                      start_time=None):
+    """Fetches spot prices for all the instance types used by the rules
+    concurrently. Returns a dict mapping (region, instance_type) to the
+    get_current_spot_prices result"""
+    plan = plan_spot_price_requests(connections, rules)
+    if not plan:
+        return {}
+    prices = {}
+    workers = min(SPOT_PRICE_WORKERS, len(plan))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict(
+            (executor.submit(get_current_spot_prices, connection,
+                             product_description, start_time, instance_type,
+                             ignored_azs),
+             (connection.region.name, instance_type))
+            for connection, instance_type, ignored_azs in plan)
+        for future in as_completed(futures):
+            prices[futures[future]] = future.result()
+    return prices
+
+
 def get_spot_choices(connections, rules, product_description, start_time=None):
     choices = []
     prices = {}
+    fetched = fetch_spot_prices(connections, rules, product_description,
+                                start_time)
     for rule in rules:
         instance_type = rule["instance_type"]
         bid_price = rule["bid_price"]
         performance_constant = rule["performance_constant"]
         ignored_availability_zones = rule.get("ignored_azs", [])
         for connection in connections:
-            prices.update(get_current_spot_prices(connection, product_description,
-                                                  start_time, instance_type,
-                                                  ignored_availability_zones))
+            prices.update(fetched[connection.region.name, instance_type])
 
         for region, region_prices in prices.iteritems():
             for az, price in region_prices.get(instance_type, {}).iteritems():
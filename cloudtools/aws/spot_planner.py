@@ -0,0 +1,137 @@
+"""
+Joint spot allocation of all the moz-types of a scheduling cycle.
+
+The allocation is solved as a min-cost max-flow problem:
+
+    source -> moz-type          capacity: instances needed
+    moz-type -> region          capacity: regional limit of the moz-type
+    region -> spot choice       cost: choice value (price per performance)
+    spot choice -> subnet       subnets of the moz-type in the choice AZ
+    subnet -> sink              capacity: usable IPs
+
+The flow starts as many instances as the limits and the subnets allow, at
+the lowest total price per unit of performance, without moz-types
+processed first starving the others of shared subnets.
+"""
+import logging
+from collections import defaultdict, deque, namedtuple
+
+log = logging.getLogger(__name__)
+
+LaunchPlanEntry = namedtuple("LaunchPlanEntry", [
+    "moz_instance_type", "choice", "subnet_id", "count", "ami"])
+
+# Costs closer than this are considered equal
+EPSILON = 1e-9
+
+
+class FlowNetwork(object):
+    """A directed graph with capacities and costs on the edges"""
+
+    def __init__(self):
+        # [target node, residual capacity, cost]. Edges are stored in
+        # pairs, the reverse of edge e is e ^ 1.
+        self._edges = []
+        self._graph = defaultdict(list)
+
+    def add_edge(self, source, target, capacity, cost=0):
+        """Adds an edge, returns its id"""
+        edge = len(self._edges)
+        self._edges.append([target, capacity, cost])
+        self._edges.append([source, 0, -cost])
+        self._graph[source].append(edge)
+        self._graph[target].append(edge ^ 1)
+        return edge
+
+    def flow(self, edge):
+        """Returns the flow through edge"""
+        return self._edges[edge ^ 1][1]
+
+    def _shortest_path(self, source, sink):
+        """Returns the edges of the cheapest path with residual capacity
+        from source to sink, None if there is no such path"""
+        dist = {source: 0}
+        via = {}
+        queue = deque([source])
+        queued = set([source])
+        while queue:
+            node = queue.popleft()
+            queued.discard(node)
+            for edge in self._graph[node]:
+                target, capacity, cost = self._edges[edge]
+                if capacity <= 0:
+                    continue
+                if dist[node] + cost < dist.get(target, float("inf")) - \
+                        EPSILON:
+                    dist[target] = dist[node] + cost
+                    via[target] = edge
+                    if target not in queued:
+                        queue.append(target)
+                        queued.add(target)
+        if sink not in dist:
+            return None
+        path = []
+        node = sink
+        while node != source:
+            edge = via[node]
+            path.append(edge)
+            node = self._edges[edge ^ 1][0]
+        return path
+
+    def min_cost_max_flow(self, source, sink):
+        """Pushes as much flow as possible from source to sink, using the
+        cheapest paths first. Returns the total flow."""
+        total = 0
+        while True:
+            path = self._shortest_path(source, sink)
+            if not path:
+                return total
+            push = min(self._edges[edge][1] for edge in path)
+            for edge in path:
+                self._edges[edge][1] -= push
+                self._edges[edge ^ 1][1] += push
+            total += push
+
+
+def plan_spot_allocation(demands, region_capacity, choices, subnet_capacity):
+    """Returns a list of LaunchPlanEntry tuples, cheapest choices first.
+
+    `demands` maps moz-types to the number of instances needed,
+    `region_capacity` maps (moz-type, region) to the number of instances the
+    moz-type may start in the region, `choices` maps moz-types to lists of
+    (Spot, subnet ids in the choice availability zone) tuples and
+    `subnet_capacity` maps (region, subnet id) to the number of usable
+    IPs."""
+    source, sink = "source", "sink"
+    unlimited = sum(demands.itervalues())
+    net = FlowNetwork()
+    for moz_instance_type, demand in sorted(demands.iteritems()):
+        net.add_edge(source, ("type", moz_instance_type), demand)
+    for (moz_instance_type, region), capacity in \
+            sorted(region_capacity.iteritems()):
+        net.add_edge(("type", moz_instance_type),
+                     ("region", moz_instance_type, region), capacity)
+    for (region, subnet_id), capacity in sorted(subnet_capacity.iteritems()):
+        net.add_edge(("subnet", region, subnet_id), sink, capacity)
+
+    # (moz-type, choice, subnet id, edge)
+    candidates = []
+    for moz_instance_type, type_choices in sorted(choices.iteritems()):
+        for n, (choice, subnet_ids) in enumerate(type_choices):
+            node = ("choice", moz_instance_type, n)
+            net.add_edge(("region", moz_instance_type, choice.region), node,
+                         unlimited, cost=choice.value)
+            for subnet_id in subnet_ids:
+                edge = net.add_edge(node, ("subnet", choice.region, subnet_id),
+                                    unlimited)
+                candidates.append((moz_instance_type, choice, subnet_id, edge))
+
+    planned = net.min_cost_max_flow(source, sink)
+    log.debug("Planned %i of %i spot instances", planned, unlimited)
+    plan = [LaunchPlanEntry(moz_instance_type, choice, subnet_id,
+                            net.flow(e), None)
+            for moz_instance_type, choice, subnet_id, e in candidates
+            if net.flow(e) > 0]
+    # Stable sort, keeps the order of equally priced choices
+    plan.sort(key=lambda e: e.choice.value)
+    return plan
@@ -0,0 +1,78 @@
+"""On-disk spot price cache shared between runs and processes.
+
+Prices are stored per (region, product description, instance type,
+availability zone) together with the timestamp of the price point and the
+time it was fetched. The file is replaced atomically, so concurrent readers
+always see a complete file.
+"""
+import json
+import time
+import errno
+import logging
+import threading
+
+from cloudtools.fileutils import atomic_write
+
+log = logging.getLogger(__name__)
+
+# Number of seconds stored prices are used without asking AWS
+DEFAULT_TTL = 5 * 60
+
+
+class SpotPriceCache(object):
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        # Serializes read-merge-write cycles of threads sharing the cache
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                log.warn("Cannot read %s", self.path, exc_info=True)
+        except ValueError:
+            log.warn("Ignoring corrupted spot price cache %s", self.path)
+        return {}
+
+    def _write(self, data):
+        atomic_write(self.path, json.dumps(data))
+
+    def get(self, region, product_description, instance_type):
+        """Returns a dict mapping availability zone to (price, timestamp,
+        fetched_at) tuples"""
+        data = self._read()
+        entries = data.get(region, {}).get(product_description, {}).get(
+            instance_type, {})
+        return dict((az, tuple(entry)) for az, entry in entries.iteritems())
+
+    def is_fresh(self, entries, zones, now=None):
+        """Returns True if all zones have prices fetched within ttl"""
+        if now is None:
+            now = time.time()
+        if not zones:
+            return False
+        for az in zones:
+            if az not in entries or now - entries[az][2] >= self.ttl:
+                return False
+        return True
+
+    def update(self, region, product_description, instance_type, prices,
+               fetched_at=None):
+        """Stores prices, a dict mapping availability zone to (price,
+        timestamp) tuples. Entries stored by other processes are preserved,
+        newer price points win."""
+        if fetched_at is None:
+            fetched_at = time.time()
+        with self._lock:
+            data = self._read()
+            entries = data.setdefault(region, {}).setdefault(
+                product_description, {}).setdefault(instance_type, {})
+            for az, (price, timestamp) in prices.iteritems():
+                if az in entries and entries[az][1] > timestamp:
+                    continue
+                entries[az] = [price, timestamp, fetched_at]
+            self._write(data)
@@ -1,11 +1,16 @@
+import heapq
 import logging
-from collections import namedtuple
+import threading
+from collections import Counter
 from IPy import IP
-from repoze.lru import lru_cache
+from repoze.lru import lru_cache, LRUCache
 from . import get_vpc, get_aws_connection
 from .spot import get_active_spot_requests
 
 log = logging.getLogger(__name__)
+_subnets_cache = LRUCache(100)
+# Minimum IPs in a subnet to qualify it as usable
+MIN_FREE_IPS = 2
 
 
 def get_subnet_id(vpc, ip):
@@ -28,34 +33,133 @@ def ip_available(region, ip):
         return True
 
 
-@lru_cache(100)
+@lru_cache(100, cache=_subnets_cache)
 def get_all_subnets(region, subnet_ids):
     vpc = get_vpc(region)
     return vpc.get_all_subnets(subnet_ids=subnet_ids)
 
 
-def get_avail_subnet(region, subnet_ids, availability_zone):
-    # Minimum IPs in a subnet to qualify it as usable
-    min_ips = 2
-    subnets = [s for s in get_all_subnets(region, tuple(subnet_ids))
-               if s.available_ip_address_count > min_ips and
-               s.availability_zone == availability_zone]
-    pending_spot_req = [sr for sr in get_active_spot_requests(region) if
-                        sr.state == 'open']
-    usable_subnets = []
-    UsableSubnet = namedtuple("UsableSubnet", ["subnet", "usable_ips"])
-    for s in subnets:
-        # Subtract pending requests from available IP count
-        pending_req = [sr for sr in pending_spot_req if
-                       sr.launch_specification.subnet_id == s.id]
-        usable_ips = s.available_ip_address_count - len(pending_req)
-        if usable_ips > min_ips:
-            usable_subnets.append(UsableSubnet(s, usable_ips))
-
-    if not usable_subnets:
+class SubnetLedger(object):
+    """Keeps track of usable IPs per subnet while instances are launched.
+
+    Open spot requests are counted per subnet once, every allocation takes
+    one IP off the subnet it returns. Subnets are handed out from a heap
+    ordered by the remaining number of usable IPs."""
+
+    def __init__(self, min_ips=MIN_FREE_IPS):
+        self.min_ips = min_ips
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # (region, subnet_id) -> usable IPs
+        self._usable = {}
+        # (region, subnet_ids, availability_zone) -> heap of
+        # (-usable IPs, position, subnet_id)
+        self._heaps = {}
+        # region -> number of open spot requests per subnet
+        self._pending = {}
+
+    def _pending_requests(self, region):
+        if region not in self._pending:
+            self._pending[region] = Counter(
+                sr.launch_specification.subnet_id
+                for sr in get_active_spot_requests(region)
+                if sr.state == 'open')
+        return self._pending[region]
+
+    def _get_heap(self, region, subnet_ids, availability_zone):
+        key = (region, subnet_ids, availability_zone)
+        if key not in self._heaps:
+            pending = self._pending_requests(region)
+            heap = []
+            for pos, s in enumerate(get_all_subnets(region, subnet_ids)):
+                if s.availability_zone != availability_zone:
+                    continue
+                usable = self._usable.setdefault(
+                    (region, s.id), s.available_ip_address_count - pending[s.id])
+                if usable > self.min_ips:
+                    heap.append((-usable, pos, s.id))
+            heapq.heapify(heap)
+            self._heaps[key] = heap
+        return self._heaps[key]
+
+    def capacity(self, region, subnet_ids, availability_zone):
+        """Returns a {subnet_id: number of IPs that can be allocated} dict of
+        the subnets in availability_zone with IPs to spare"""
+        subnet_ids = tuple(subnet_ids)
+        with self._lock:
+            heap = self._get_heap(region, subnet_ids, availability_zone)
+            rv = {}
+            for _, _, subnet_id in heap:
+                spare = self._usable[region, subnet_id] - self.min_ips
+                if spare > 0:
+                    rv[subnet_id] = spare
+            return rv
+
+    def allocate(self, region, subnet_ids, availability_zone):
+        """Returns the subnet with the most usable IPs and takes one IP off
+        it. Returns None if no subnet has IPs to spare."""
+        subnet_ids = tuple(subnet_ids)
+        with self._lock:
+            heap = self._get_heap(region, subnet_ids, availability_zone)
+            while heap:
+                neg_usable, pos, subnet_id = heap[0]
+                usable = self._usable[region, subnet_id]
+                if usable != -neg_usable:
+                    # Another heap allocated from the same subnet
+                    heapq.heapreplace(heap, (-usable, pos, subnet_id))
+                    continue
+                if usable <= self.min_ips:
+                    break
+                self._usable[region, subnet_id] = usable - 1
+                heapq.heapreplace(heap, (1 - usable, pos, subnet_id))
+                return subnet_id
         log.debug("No free IP available in %s for subnets %s",
                   availability_zone, subnet_ids)
         return None
-    # sort by usable IP address count
-    usable_subnets.sort(key=lambda x: x.usable_ips, reverse=True)
-    return usable_subnets[0].subnet.id
+
+    def allocate_from(self, region, subnet_id):
+        """Takes one IP off a subnet seen by capacity() or allocate()
+        before. Returns False if it has no IPs to spare or is unknown."""
+        with self._lock:
+            usable = self._usable.get((region, subnet_id))
+            if usable is None or usable <= self.min_ips:
+                log.debug("No free IP available in %s", subnet_id)
+                return False
+            # The heaps notice the change lazily
+            self._usable[region, subnet_id] = usable - 1
+            return True
+
+
+_subnet_ledger = SubnetLedger()
+
+
+def reset_subnet_ledger():
+    """Forget IP allocations. Should only be called together with
+    invalidating the subnets cache: the IPs taken since the last reset are
+    only accounted for by fresh subnet IP counts"""
+    _subnet_ledger.clear()
+
+
+def invalidate_subnets_cache():
+    _subnets_cache.clear()
+    reset_subnet_ledger()
+
+
+def get_avail_subnet(region, subnet_ids, availability_zone):
+    """Returns the subnet in availability_zone with the most usable IPs and
+    reserves an IP in it for the instance about to be launched"""
+    return _subnet_ledger.allocate(region, subnet_ids, availability_zone)
+
+
+def allocate_subnet_ip(region, subnet_id):
+    """Reserves an IP in a subnet returned by get_subnet_capacity(). Returns
+    False if there are none left."""
+    return _subnet_ledger.allocate_from(region, subnet_id)
+
+
+def get_subnet_capacity(region, subnet_ids, availability_zone):
+    """Returns how many IPs can be allocated per subnet in
+    availability_zone"""
+    return _subnet_ledger.capacity(region, subnet_ids, availability_zone)
@@ -2,55 +2,162 @@ import time
 import sqlalchemy as sa
 import re
 import logging
-import requests
 from sqlalchemy.engine.reflection import Inspector
-from collections import defaultdict
+from collections import defaultdict, Counter, namedtuple
+
+from cloudtools.twistd_log import log_probe_command, read_chunk, \
+    update_activity, ACTIVITY_BOOTING
+from cloudtools.masters import MASTER_TIMEOUT, MasterClient
+# Part of the get_last_activity() results
+from cloudtools.twistd_log import ACTIVITY_STOPPED  # noqa: F401
 
 log = logging.getLogger(__name__)
-ACTIVITY_BOOTING, ACTIVITY_STOPPED = ("booting", "stopped")
-
-
-def find_pending(dburl):
-    db = sa.create_engine(dburl)
-    inspector = Inspector(db)
-    # Newer buildbot has a "buildrequest_claims" table
-    if "buildrequest_claims" in inspector.get_table_names():
-        query = sa.text("""
-        SELECT buildername, id FROM
-               buildrequests WHERE
-               complete=0 AND
-               submitted_at > :yesterday AND
-               submitted_at < :toonew AND
-               (select count(brid) from buildrequest_claims
-                       where brid=id) = 0""")
-    # Older buildbot doesn't
-    else:
-        query = sa.text("""
-        SELECT buildername, id FROM
-               buildrequests WHERE
-               complete=0 AND
-               claimed_at=0 AND
-               submitted_at > :yesterday AND
-               submitted_at < :toonew""")
-
-    result = db.execute(
-        query,
-        yesterday=time.time() - 86400,
-        toonew=time.time() - 10
-    )
-    retval = result.fetchall()
-    return retval
-
-
-def map_builders(pending, builder_map):
+
+# Commands run by probe_slave(), in order. Their output is parsed by
+# parse_probe(). The twistd.log command, which depends on the cursor of the
+# slave, comes last.
+PROBE_COMMANDS = [
+    ("date", "date +%Y%m%d%H%M%S"),
+    ("uptime", "cat /proc/uptime"),
+    ("tac", "grep '^buildmaster_host = ' /builds/slave/buildbot.tac"),
+]
+# Printed before the output of each probe command
+PROBE_MARKER = "--cloudtools-probe-%s--"
+_probe_marker_re = re.compile(r"^--cloudtools-probe-(\w+)--\n", re.M)
+_master_host_re = re.compile("^buildmaster_host = '(.*?)'$", re.M)
+
+SlaveProbe = namedtuple("SlaveProbe", ["slave_time", "uptime", "master_host",
+                                       "activity", "cursor"])
+
+
+class PendingQuery(object):
+    """Finds unclaimed build requests. The engine and its connection pool are
+    kept between calls, as well as the detected buildbot schema."""
+
+    def __init__(self, dburl):
+        # recycle connections before MySQL's wait_timeout kicks in
+        self.db = sa.create_engine(dburl, pool_recycle=3600)
+        self._has_claims_table = None
+
+    @property
+    def has_claims_table(self):
+        # Newer buildbot has a "buildrequest_claims" table
+        if self._has_claims_table is None:
+            inspector = Inspector(self.db)
+            self._has_claims_table = \
+                "buildrequest_claims" in inspector.get_table_names()
+        return self._has_claims_table
+
+    def get_query(self, aggregate=False):
+        if aggregate:
+            columns = "br.buildername, COUNT(*)"
+            group_by = "GROUP BY br.buildername"
+        else:
+            columns = "br.buildername, br.id"
+            group_by = ""
+        if self.has_claims_table:
+            # Anti-join instead of a correlated subquery per request
+            query = """
+            SELECT {columns} FROM buildrequests br
+                   LEFT JOIN buildrequest_claims brc ON brc.brid = br.id
+                   WHERE
+                   br.complete=0 AND
+                   br.submitted_at > :yesterday AND
+                   br.submitted_at < :toonew AND
+                   brc.brid IS NULL
+                   {group_by}"""
+        # Older buildbot doesn't
+        else:
+            query = """
+            SELECT {columns} FROM buildrequests br WHERE
+                   br.complete=0 AND
+                   br.claimed_at=0 AND
+                   br.submitted_at > :yesterday AND
+                   br.submitted_at < :toonew
+                   {group_by}"""
+        return sa.text(query.format(columns=columns, group_by=group_by))
+
+    def fetch(self, aggregate=False):
+        """Returns a list of (buildername, id) rows, or (buildername, count)
+        rows if aggregate is set"""
+        now = time.time()
+        result = self.db.execute(
+            self.get_query(aggregate),
+            yesterday=now - 86400,
+            toonew=now - 10
+        )
+        return result.fetchall()
+
+
+_pending_queries = {}
+
+
+def find_pending(dburl, aggregate=False):
+    if dburl not in _pending_queries:
+        _pending_queries[dburl] = PendingQuery(dburl)
+    return _pending_queries[dburl].fetch(aggregate)
+
+
+class BuilderClassifier(object):
+    """Maps builder names to instance types. The first matching expression
+    wins, in the order of builder_map (use an OrderedDict to preserve the
+    order declared in the config). Results are memoized per builder name."""
+
+    def __init__(self, builder_map):
+        self.rules = [(re.compile(buildername_exp), moz_instance_type)
+                      for buildername_exp, moz_instance_type
+                      in builder_map.items()]
+        self._memo = {}
+
+    def classify(self, buildername):
+        """Returns the instance type for buildername or None"""
+        try:
+            return self._memo[buildername]
+        except KeyError:
+            pass
+        moz_instance_type = None
+        for buildername_exp, instance_type in self.rules:
+            if buildername_exp.match(buildername):
+                moz_instance_type = instance_type
+                break
+        self._memo[buildername] = moz_instance_type
+        return moz_instance_type
+
+
+_builder_classifiers = {}
+
+
+def get_builder_classifier(builder_map):
+    """Returns a BuilderClassifier for builder_map. Classifiers are reused
+    across calls, so the memoized results survive between cycles."""
+    key = tuple(builder_map.items())
+    if key not in _builder_classifiers:
+        _builder_classifiers[key] = BuilderClassifier(builder_map)
+    return _builder_classifiers[key]
+
+
+def count_builders(pending, aggregated=False):
+    """Groups pending (buildername, id) rows by builder name. Rows returned
+    by find_pending(aggregate=True) are already grouped."""
+    if aggregated:
+        counts = Counter()
+        for buildername, count in pending:
+            counts[buildername] += count
+        return counts
+    return Counter(buildername for buildername, _ in pending)
+
+
+def map_builders(pending, builder_map, aggregated=False):
     """Map pending builder names to instance types"""
+    classifier = get_builder_classifier(builder_map)
     type_map = defaultdict(int)
-    for pending_buildername, _ in pending:
-        for buildername_exp, moz_instance_type in builder_map.items():
-            if re.match(buildername_exp, pending_buildername):
-                log.debug("%s instance type %s", pending_buildername, moz_instance_type)
-                type_map[moz_instance_type] += 1
-                break
+    counts = count_builders(pending, aggregated)
+    for pending_buildername, count in counts.iteritems():
+        moz_instance_type = classifier.classify(pending_buildername)
+        if moz_instance_type:
+            log.debug("%s instance type %s (%i pending)", pending_buildername,
+                      moz_instance_type, count)
+            type_map[moz_instance_type] += count
         else:
             log.debug("%s has pending jobs, but no instance types defined",
                       pending_buildername)
@@ -61,10 +168,46 @@ def get_tacfile(ssh_client):
     return ssh_client.get_stdout("cat /builds/slave/buildbot.tac")
 
 
-def get_buildbot_master(ssh_client, masters_json):
-    tacfile = get_tacfile(ssh_client)
-    host = re.search("^buildmaster_host = '(.*?)'$", tacfile, re.M)
-    host = host.group(1)
+def parse_master_host(tacfile):
+    host = _master_host_re.search(tacfile)
+    return host.group(1) if host else None
+
+
+def probe_command(cursor=None):
+    """Returns the probe command, reading twistd.log from `cursor` if
+    possible"""
+    commands = PROBE_COMMANDS + [("log", log_probe_command(cursor))]
+    return "; ".join(
+        "echo '%s'; %s 2>/dev/null" % (PROBE_MARKER % name, command)
+        for name, command in commands)
+
+
+def parse_probe(output, cursor=None, name=None):
+    """Parses the output of probe_command(cursor) into a SlaveProbe"""
+    parts = _probe_marker_re.split(output, maxsplit=len(PROBE_COMMANDS) + 1)
+    sections = dict(zip(parts[1::2], parts[2::2]))
+    slave_time = time.mktime(time.strptime(sections["date"].strip(),
+                                           "%Y%m%d%H%M%S"))
+    uptime = float(sections["uptime"].split()[0])
+    chunk = read_chunk(sections.get("log", ""), cursor)
+    activity, cursor = update_activity(chunk, cursor, name)
+    return SlaveProbe(slave_time=slave_time, uptime=uptime,
+                      master_host=parse_master_host(sections.get("tac", "")),
+                      activity=activity, cursor=cursor)
+
+
+def probe_slave(ssh_client, cursor=None):
+    """Collects the slave time, uptime, master and the twistd.log lines
+    appended since `cursor` in a single remote command"""
+    output = ssh_client.get_stdout(probe_command(cursor))
+    return parse_probe(output, cursor, ssh_client.name)
+
+
+def get_buildbot_master(ssh_client, masters_json, host=None):
+    """Returns the (host, port) of the slave master. `host` saves reading
+    buildbot.tac again if the slave was probed already."""
+    if host is None:
+        host = parse_master_host(get_tacfile(ssh_client))
     port = None
     for master in masters_json:
         if master["hostname"] == host:
@@ -74,22 +217,31 @@ def get_buildbot_master(ssh_client, masters_json):
     return host, port
 
 
-def graceful_shutdown(ssh_client, masters_json):
-    # Find out which master we're attached to by looking at buildbot.tac
-    log.debug("%s - looking up which master we're attached to",
-              ssh_client.name)
-    host, port = get_buildbot_master(ssh_client, masters_json)
+def graceful_shutdown(ssh_client, masters_json, timeout=MASTER_TIMEOUT,
+                      master_host=None, client=None):
+    """Asks the master of the slave to shut it down. A shared MasterClient
+    reuses its master lookups and connections."""
+    if client is None:
+        client = MasterClient(masters_json, timeout)
+    client.attach(ssh_client.name, master_host)
 
-    url = "http://{host}:{port}/buildslaves/{name}/shutdown".format(
-        host=host, port=port, name=ssh_client.name)
-    log.debug("%s - POSTing to %s", ssh_client.name, url)
-    requests.post(url, allow_redirects=False)
+    def lookup():
+        # Find out which master we're attached to by looking at buildbot.tac
+        log.debug("%s - looking up which master we're attached to",
+                  ssh_client.name)
+        return parse_master_host(get_tacfile(ssh_client))
 
+    client.shutdown(ssh_client.name, lookup)
 
-def get_last_activity(ssh_client):
-    slave_time = ssh_client.get_stdout("date +%Y%m%d%H%M%S").strip()
-    slave_time = time.mktime(time.strptime(slave_time, "%Y%m%d%H%M%S"))
-    uptime = float(ssh_client.get_stdout("cat /proc/uptime").split()[0])
+
+def get_last_activity(ssh_client, probe=None):
+    """Returns the number of seconds since the last activity of the slave,
+    ACTIVITY_BOOTING or ACTIVITY_STOPPED. The slave is probed unless
+    `probe` is given."""
+    if probe is None:
+        probe = probe_slave(ssh_client)
+    slave_time = probe.slave_time
+    uptime = probe.uptime
 
     if uptime < 3 * 60:
         # Assume we're still booting
@@ -97,52 +249,17 @@ def get_last_activity(ssh_client):
                   ssh_client.name, uptime)
         return ACTIVITY_BOOTING
 
-    stdout = ssh_client.get_stdout(
-        "tail -n 100 /builds/slave/twistd.log.1 /builds/slave/twistd.log")
-
-    last_activity = None
-    running_command = False
-    t = time.time()
-    line = ""
-    for line in stdout.splitlines():
-        m = re.search(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})", line)
-        if m:
-            t = time.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
-            t = time.mktime(t)
-        else:
-            # Not sure what to do with this line...
-            continue
-
-        # uncomment to dump out ALL the lines
-        # log.debug("%s - %s", name, line.strip())
-
-        if "RunProcess._startCommand" in line or "using PTY: " in line:
-            log.debug("%s - started command - %s", ssh_client.name,
-                      line.strip())
-            running_command = True
-        elif "commandComplete" in line or "stopCommand" in line:
-            log.debug("%s - done command - %s", ssh_client.name, line.strip())
-            running_command = False
-
-        if "Shut Down" in line:
-            # Check if this happened before we booted, i.e. we're still booting
-            # up
-            if (slave_time - t) > uptime:
-                log.debug(
-                    "%s - shutdown line is older than uptime; assuming we're "
-                    "still booting %s", ssh_client.name, line.strip())
-                last_activity = ACTIVITY_BOOTING
-            else:
-                last_activity = ACTIVITY_STOPPED
-        elif "I have a leftover directory" in line:
-            # Ignore this, it doesn't indicate anything
-            continue
-        elif running_command:
-            # We're in the middle of running something, so say that our last
-            # activity is now (0 seconds ago)
-            last_activity = 0
-        else:
-            last_activity = slave_time - t
+    activity = probe.activity
+    last_activity = activity.last_activity(slave_time, uptime)
+    if last_activity == ACTIVITY_BOOTING:
+        log.debug(
+            "%s - shutdown line is older than uptime; assuming we're "
+            "still booting %s", ssh_client.name, activity.last_line)
+
+    t = activity.last_time
+    if t is None:
+        t = time.time()
+    line = activity.last_line
 
     # If the last lines from the log are over 10 minutes ago, and are from
     # before our reboot, then try rebooting
@@ -0,0 +1,157 @@
+"""
+Slaves asked to shut down by aws_stop_idle.
+
+A graceful shutdown takes a while: the slave finishes its current step, the
+master releases it and buildbot exits. The ledger remembers which slave of
+every instance was asked to shut down, by which master and since when, so
+that the next sweep confirms drained slaves first, with one request to
+their master and no SSH, and terminates them without waiting for their turn
+in the checks. Drains are forgotten after DRAIN_MAX_AGE seconds, or as soon
+as the slave starts a build after the shutdown request, since a slave
+which is disconnected then may not be drained at all.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
+
+log = logging.getLogger(__name__)
+
+LEDGER_VERSION = 1
+# Seconds after which an unconfirmed drain is forgotten
+DRAIN_MAX_AGE = 6 * 3600
+
+Drain = namedtuple("Drain", ["name", "master_host", "requested_at"])
+
+
+class DrainLedger(object):
+    """Drains by instance id, persisted as JSON"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._drains = {}
+        if filename:
+            self.load()
+
+    def load(self):
+        drains = load_versioned_json(
+            self.filename, LEDGER_VERSION, "drains",
+            lambda d: dict((instance_id, Drain(*drain))
+                           for instance_id, drain in d.iteritems()))
+        if drains is not None:
+            self._drains = drains
+
+    def save(self):
+        with self._lock:
+            drains = dict((k, list(v)) for k, v in self._drains.iteritems())
+        save_versioned_json(self.filename, LEDGER_VERSION, "drains", drains)
+
+    def record(self, instance_id, name, master_host=None):
+        """Remembers a shutdown request. Repeated requests keep the time of
+        the first one."""
+        with self._lock:
+            drain = self._drains.get(instance_id)
+            if drain and drain.name == name:
+                requested_at = drain.requested_at
+            else:
+                requested_at = time.time()
+            self._drains[instance_id] = Drain(
+                name, master_host or (drain and drain.master_host),
+                requested_at)
+
+    def get(self, instance_id):
+        with self._lock:
+            return self._drains.get(instance_id)
+
+    def forget(self, instance_ids):
+        with self._lock:
+            for instance_id in instance_ids:
+                self._drains.pop(instance_id, None)
+
+    def forget_slaves(self, names):
+        """Forgets the drains of the given slave names"""
+        names = set(names)
+        with self._lock:
+            for instance_id, drain in self._drains.items():
+                if drain.name in names:
+                    del self._drains[instance_id]
+
+    def expire(self, max_age=DRAIN_MAX_AGE, now=None):
+        """Forgets the drains requested more than max_age seconds ago"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for instance_id, drain in self._drains.items():
+                if now - drain.requested_at > max_age:
+                    log.debug("%s - forgetting the drain requested %.0fs "
+                              "ago", drain.name, now - drain.requested_at)
+                    del self._drains[instance_id]
+
+    def prune(self, instance_ids):
+        """Forgets the instances not in instance_ids"""
+        instance_ids = set(instance_ids)
+        with self._lock:
+            for instance_id in list(self._drains):
+                if instance_id not in instance_ids:
+                    del self._drains[instance_id]
+
+    def __len__(self):
+        return len(self._drains)
+
+
+def started_since(status, since):
+    """Returns True if the slave status lists a build started after
+    `since`"""
+    for build in status.get("runningBuilds") or []:
+        times = build.get("times") or [None]
+        if times[0] is not None and times[0] > since:
+            return True
+    return False
+
+
+def find_drained(ledger, instances, master_client):
+    """Returns the instances of the ledger whose slave has drained, that is
+    whose master doesn't see it connected anymore. The drains of slaves
+    which started a build since the shutdown request are forgotten. Masters
+    are asked concurrently."""
+    resumed = []
+
+    def is_drained(i):
+        drain = ledger.get(i.id)
+        if drain.master_host not in master_client.ports:
+            return False
+        try:
+            status = master_client.get_slave(drain.master_host, drain.name)
+        except Exception:
+            log.debug("%s - cannot ask %s, leaving it to the checks",
+                      drain.name, drain.master_host, exc_info=True)
+            return False
+        if status.get("connected") and \
+                started_since(status, drain.requested_at):
+            log.debug("%s - took a build after the shutdown request",
+                      drain.name)
+            resumed.append(i.id)
+        return not status.get("connected")
+
+    candidates = [i for i in instances if ledger.get(i.id)]
+    if not candidates:
+        return []
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(master_client.workers, len(candidates))))
+    try:
+        drained = [i for i, d in zip(candidates,
+                                     executor.map(is_drained, candidates))
+                   if d]
+    finally:
+        executor.shutdown(wait=True)
+    ledger.forget(resumed)
+    for i in drained:
+        drain = ledger.get(i.id)
+        log.debug("%s - drained %.0fs after the shutdown request",
+                  drain.name, time.time() - drain.requested_at)
+    return drained
@@ -5,6 +5,7 @@ import os
 import logging
 import gzip
 import json
+import tempfile
 log = logging.getLogger(__name__)
 
 
@@ -43,3 +44,44 @@ def get_data_from_json_file(filename):
         # has been modified by the user
         log.debug('%s is not valid, deleting it', filename)
         raise
+
+
+def atomic_write(filename, data):
+    """Replaces filename with data, readers see either the old or the new
+    content"""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname,
+                                     prefix=".%s" % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_fname, filename)
+    except Exception:
+        os.unlink(tmp_fname)
+        raise
+
+
+def load_versioned_json(filename, version, key, convert=None):
+    """Returns the `key` entry of a file written by save_versioned_json,
+    passed through convert if given. Returns None if the file is missing,
+    was written with another version or is corrupted."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("version") != version:
+            return None
+        value = data[key]
+        if convert:
+            value = convert(value)
+        return value
+    except IOError:
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError):
+        log.warn("Ignoring corrupted %s", filename)
+        return None
+
+
+def save_versioned_json(filename, version, key, value):
+    """Atomically writes value as the `key` entry of a JSON file tagged
+    with version"""
+    atomic_write(filename, json.dumps({"version": version, key: value}))
@@ -1,6 +1,10 @@
 import logging
 import socket
+import threading
 import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
 
 log = logging.getLogger(__name__)
 
@@ -60,7 +64,101 @@ class GraphiteLogger(object):
         self._data = {}
 
 
+class Timings(object):
+    """Aggregates the duration and the number of spans per phase"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.seconds = defaultdict(float)
+            self.counts = Counter()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+            self.counts[name] += 1
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def timed(self, name):
+        """Decorator recording a span for every call"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self, graphite_logger):
+        """Adds timing.<phase>.seconds and timing.<phase>.count metrics"""
+        with self._lock:
+            for name, seconds in self.seconds.iteritems():
+                graphite_logger.add("timing.%s.seconds" % name, seconds)
+                graphite_logger.add("timing.%s.count" % name,
+                                    self.counts[name])
+
+    def summary(self):
+        """Returns a table of the phases, slowest first"""
+        with self._lock:
+            lines = ["%-26s %6s %10s %10s" % ("phase", "count", "total",
+                                              "average")]
+            for name, seconds in sorted(self.seconds.iteritems(),
+                                        key=lambda x: x[1], reverse=True):
+                count = self.counts[name]
+                lines.append("%-26s %6i %9.3fs %9.3fs" % (
+                    name, count, seconds, seconds / count))
+        return "\n".join(lines)
+
+
+class Histogram(object):
+    """Counts observed values per bucket. Buckets are upper bounds in
+    seconds, values above the last bucket are counted as "inf"."""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = Counter()
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def observe(self, value):
+        bucket = next((b for b in self.buckets if value <= b), "inf")
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def report(self, graphite_logger, name):
+        """Adds <name>.le_<bucket> metrics with the cumulative count of each
+        bucket, and <name>.count, <name>.sum and <name>.max"""
+        with self._lock:
+            total = 0
+            for bucket in self.buckets + ["inf"]:
+                total += self.counts[bucket]
+                graphite_logger.add("%s.le_%s" % (name, bucket), total)
+            graphite_logger.add("%s.count" % name, self.count)
+            graphite_logger.add("%s.sum" % name, self.sum)
+            graphite_logger.add("%s.max" % name, self.max)
+
+
 _graphite_logger = GraphiteLogger()
+_timings = Timings()
 
 
 def get_graphite_logger():
@@ -68,6 +166,10 @@ def get_graphite_logger():
     return _graphite_logger
 
 
+def get_timings():
+    return _timings
+
+
 def generate_instance_stats(instances):
     for i in instances:
         if i.state != "running":
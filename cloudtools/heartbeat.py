@@ -0,0 +1,247 @@
+"""
+Push based slave activity.
+
+Instances run a hook (buildslave_heartbeat) which follows twistd.log and
+posts the state of the slave to a collector (aws_heartbeat_collector)
+whenever it changes, and every HEARTBEAT_INTERVAL seconds. The collector
+keeps the last heartbeat of every slave in a compact JSON store, which
+aws_stop_idle reads instead of asking every slave over SSH.
+
+A heartbeat is the state derived by LogActivity: the last event, the time
+it was logged at and the master of the slave. Slaves which haven't sent a
+heartbeat for STALE_AFTER seconds may be unreachable and are left to the
+other checks.
+
+Requests to the collector carry a token shared through the secrets files,
+in the TOKEN_HEADER header. Heartbeats are only a hint: aws_stop_idle
+confirms shutdowns with the master before terminating anything.
+"""
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import namedtuple
+
+import requests
+
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
+from cloudtools.twistd_log import EVENT_IDLE, EVENT_RUNNING, \
+    EVENT_SHUTDOWN, ACTIVITY_BOOTING, ACTIVITY_STOPPED
+
+log = logging.getLogger(__name__)
+
+EVENT_BOOT = "boot"
+EVENTS = (EVENT_BOOT, EVENT_RUNNING, EVENT_IDLE, EVENT_SHUTDOWN)
+# Seconds between heartbeats of an unchanged slave
+HEARTBEAT_INTERVAL = 60
+# Heartbeats older than this don't say anything about the slave
+STALE_AFTER = 15 * 60
+# Slaves which booted less than BOOT_GRACE seconds ago are still booting
+BOOT_GRACE = 3 * 60
+# Seconds between saves of the collector store
+FLUSH_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 10
+TOKEN_HEADER = "X-Heartbeat-Token"
+STORE_VERSION = 1
+
+Heartbeat = namedtuple("Heartbeat", ["event", "event_time", "received_at",
+                                     "master_host"])
+
+
+def heartbeat_activity(beat, now=None):
+    """Returns the last activity of a slave from its heartbeat, like
+    get_last_activity, or None if the heartbeat is stale"""
+    now = now or time.time()
+    if now - beat.received_at > STALE_AFTER:
+        return None
+    if beat.event == EVENT_SHUTDOWN:
+        return ACTIVITY_STOPPED
+    elif beat.event == EVENT_RUNNING:
+        return 0
+    elif beat.event == EVENT_BOOT and now - beat.event_time < BOOT_GRACE:
+        return ACTIVITY_BOOTING
+    return now - beat.event_time
+
+
+def _parse_beats(slaves):
+    return dict((name, Heartbeat(*beat)) for name, beat in slaves.iteritems())
+
+
+class HeartbeatStore(object):
+    """The last heartbeat of every slave, persisted as JSON"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._beats = {}
+        self._saved_at = 0
+        if filename:
+            self.load()
+
+    def load(self):
+        beats = load_versioned_json(self.filename, STORE_VERSION, "slaves",
+                                    _parse_beats)
+        if beats is not None:
+            with self._lock:
+                self._beats = beats
+
+    def update(self, data):
+        """Loads the to_dict() data of a store"""
+        if data.get("version") != STORE_VERSION:
+            return
+        beats = _parse_beats(data["slaves"])
+        with self._lock:
+            self._beats = beats
+
+    def _slaves(self):
+        with self._lock:
+            return dict((name, list(beat)) for name, beat in
+                        self._beats.iteritems())
+
+    def to_dict(self):
+        return {"version": STORE_VERSION, "slaves": self._slaves()}
+
+    def save(self):
+        save_versioned_json(self.filename, STORE_VERSION, "slaves",
+                            self._slaves())
+        self._saved_at = time.time()
+
+    def maybe_save(self):
+        """Saves at most every FLUSH_INTERVAL seconds"""
+        if self.filename and time.time() - self._saved_at > FLUSH_INTERVAL:
+            self.save()
+
+    def record(self, name, event, event_time=None, master_host=None):
+        now = time.time()
+        with self._lock:
+            self._beats[name] = Heartbeat(event, event_time or now, now,
+                                          master_host)
+
+    def get(self, name):
+        with self._lock:
+            return self._beats.get(name)
+
+    def __len__(self):
+        return len(self._beats)
+
+
+def load_heartbeats(source, token=None, timeout=HEARTBEAT_TIMEOUT):
+    """Returns a HeartbeatStore from a store file or a collector URL"""
+    if source.startswith("http://") or source.startswith("https://"):
+        store = HeartbeatStore()
+        r = requests.get(source.rstrip("/") + "/heartbeats", timeout=timeout,
+                         headers={TOKEN_HEADER: token or ""})
+        r.raise_for_status()
+        store.update(r.json())
+        return store
+    return HeartbeatStore(source)
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    """POST /heartbeat/<slave name> with a JSON body of "event",
+    "event_time" and "master_host" records a heartbeat. GET /heartbeats
+    returns the store. Both need the collector token."""
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+    def reply(self, code, data=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        if data is not None:
+            self.wfile.write(json.dumps(data))
+
+    def authorized(self):
+        token = self.headers.getheader(TOKEN_HEADER.lower()) or ""
+        if hmac.compare_digest(token, self.server.token):
+            return True
+        log.warn("Rejecting %s %s from %s: bad token", self.command,
+                 self.path, self.client_address[0])
+        self.reply(403)
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip("/") == "/heartbeats":
+            self.reply(200, self.server.store.to_dict())
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "heartbeat":
+            return self.reply(404)
+        try:
+            length = int(self.headers.getheader("content-length") or 0)
+            beat = json.loads(self.rfile.read(length))
+            if beat["event"] not in EVENTS:
+                raise ValueError("unknown event %s" % beat["event"])
+        except (ValueError, KeyError, TypeError), e:
+            return self.reply(400, {"error": str(e)})
+        self.server.store.record(parts[1], beat["event"],
+                                 beat.get("event_time"),
+                                 beat.get("master_host"))
+        self.server.store.maybe_save()
+        self.reply(204)
+
+
+class HeartbeatCollector(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, token):
+        if not token:
+            raise ValueError("the collector needs a token")
+        HTTPServer.__init__(self, address, CollectorHandler)
+        self.store = store
+        self.token = str(token)
+
+
+def send_heartbeat(collector_url, name, event, event_time=None,
+                   master_host=None, token=None, timeout=HEARTBEAT_TIMEOUT):
+    url = "{}/heartbeat/{}".format(collector_url.rstrip("/"), name)
+    r = requests.post(url, data=json.dumps({
+        "event": event, "event_time": event_time,
+        "master_host": master_host}), timeout=timeout,
+        headers={TOKEN_HEADER: token or ""})
+    r.raise_for_status()
+
+
+def follow_log(filename, activity, on_change, interval=HEARTBEAT_INTERVAL,
+               poll=1, running=lambda: True):
+    """Feeds the lines appended to filename to `activity`, calls
+    on_change(activity) when the last event changes and at least every
+    `interval` seconds. Reopens the log after a rotation."""
+    f = None
+    inode = None
+    last_sent = (None, None)
+    sent_at = 0
+    while running():
+        try:
+            st = os.stat(filename)
+            if st.st_ino != inode or (f and st.st_size < f.tell()):
+                if f:
+                    # Rotated or truncated, read the rest of the old file
+                    activity.feed_bytes(f.read())
+                    f.close()
+                f = open(filename, "rb")
+                inode = st.st_ino
+            activity.feed_bytes(f.read())
+        except (IOError, OSError):
+            log.debug("Cannot read %s", filename, exc_info=True)
+        state = (activity.event, activity.event_time)
+        if state != last_sent or time.time() - sent_at >= interval:
+            try:
+                on_change(activity)
+                last_sent = state
+                sent_at = time.time()
+            except Exception:
+                log.warn("Cannot send heartbeat", exc_info=True)
+        time.sleep(poll)
@@ -0,0 +1,276 @@
+"""
+Slave activity as seen by the buildbot masters.
+
+Every master serves the state of its slaves at /json/slaves. MasterActivity
+asks each master of masters_json once per sweep, in parallel, and maps
+connected slaves to their activity: 0 while they run builds, otherwise the
+seconds since they were first seen idle. The masters don't report idle
+durations, so idle start times are kept between sweeps in a JSON file,
+together with the last build numbers the master lists for the slave: a
+slave which ran builds between two sweeps is idle since the later one.
+Slaves seen idle for the first time have no report yet, and neither have
+the slaves which no master reports as connected: both are left to the SSH
+checks, which read the idle time from twistd.log. Without a state file,
+e.g. on the first run, the first sweep leaves every idle slave to SSH. The
+idle start times of the slaves of a master which doesn't answer are kept
+for the next sweep.
+
+MasterClient talks to the masters: it indexes masters_json by hostname,
+remembers which master every slave is attached to and keeps one pooled
+keep-alive session per master, so that draining many slaves doesn't pay
+for a lookup and a new connection per request.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for buildbot masters
+MASTER_TIMEOUT = 30
+# Number of masters queried in parallel
+MASTER_WORKERS = 8
+STATE_VERSION = 2
+
+SlaveReport = namedtuple("SlaveReport", ["name", "master_host", "master_port",
+                                         "last_activity"])
+
+
+def get_last_builds(status):
+    """Returns the sorted [builder name, last build number] pairs of the
+    builds a master lists for a slave"""
+    return sorted([builder, max(numbers)] for builder, numbers in
+                  (status.get("builders") or {}).iteritems() if numbers)
+
+
+def get_master_slaves(host, port, timeout=MASTER_TIMEOUT, session=None):
+    """Returns the {slave name: slave status} dict of a master"""
+    url = "http://{host}:{port}/json/slaves".format(host=host, port=port)
+    r = (session or requests).get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+def get_master_slave(host, port, name, timeout=MASTER_TIMEOUT,
+                     session=None):
+    """Returns the status of a single slave"""
+    url = "http://{host}:{port}/json/slaves/{name}".format(
+        host=host, port=port, name=name)
+    r = (session or requests).get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+def request_shutdown(host, port, name, timeout=MASTER_TIMEOUT, session=None):
+    """Asks a master to gracefully shut down a slave"""
+    url = "http://{host}:{port}/buildslaves/{name}/shutdown".format(
+        host=host, port=port, name=name)
+    log.debug("%s - POSTing to %s", name, url)
+    r = (session or requests).post(url, allow_redirects=False,
+                                   timeout=timeout)
+    r.raise_for_status()
+
+
+class MasterClient(object):
+    """Requests to the masters of masters_json, over one keep-alive
+    connection pool per master. Thread safe."""
+
+    def __init__(self, masters_json, timeout=MASTER_TIMEOUT,
+                 workers=MASTER_WORKERS):
+        self.ports = dict((m["hostname"], m["http_port"])
+                          for m in masters_json)
+        self.timeout = timeout
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._sessions = {}
+        # slave name -> master host
+        self._attached = {}
+        self._deferred = []
+
+    def session(self, host):
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                # Every check thread may talk to the same master
+                session.mount("http://", HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.workers))
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def attach(self, name, host):
+        """Remembers that slave `name` is attached to master `host`"""
+        if host:
+            with self._lock:
+                self._attached[name] = host
+
+    def get_attached(self, name):
+        """Returns the host of the master of a slave, None if unknown"""
+        with self._lock:
+            return self._attached.get(name)
+
+    def get_master(self, name, lookup=None):
+        """Returns the (host, port) of the master of a slave. lookup() is
+        called to find the host of slaves which weren't attached yet."""
+        with self._lock:
+            host = self._attached.get(name)
+        if host is None and lookup is not None:
+            host = lookup()
+            self.attach(name, host)
+        port = self.ports.get(host)
+        assert host and port, "%s - unknown master %s" % (name, host)
+        return host, port
+
+    def get_slaves(self, host):
+        return get_master_slaves(host, self.ports[host], self.timeout,
+                                 self.session(host))
+
+    def get_slave(self, host, name):
+        return get_master_slave(host, self.ports[host], name, self.timeout,
+                                self.session(host))
+
+    def shutdown(self, name, lookup=None):
+        host, port = self.get_master(name, lookup)
+        request_shutdown(host, port, name, self.timeout, self.session(host))
+
+    def shutdown_many(self, names):
+        """Shuts down attached slaves, `workers` requests at a time. Returns
+        the names of the slaves which couldn't be shut down."""
+        def shutdown(name):
+            try:
+                self.shutdown(name)
+            except Exception:
+                log.warn("%s - graceful shutdown failed", name, exc_info=True)
+                return name
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.workers, len(names))))
+        try:
+            return [name for name in executor.map(shutdown, names) if name]
+        finally:
+            executor.shutdown(wait=True)
+
+    def defer_shutdown(self, name):
+        """Queues a shutdown for the next flush_shutdowns()"""
+        with self._lock:
+            self._deferred.append(name)
+
+    def flush_shutdowns(self):
+        """Sends the deferred shutdowns as one batch. Returns the names of
+        the slaves which couldn't be shut down."""
+        with self._lock:
+            names, self._deferred = self._deferred, []
+        if not names:
+            return []
+        log.debug("Shutting down %i slaves", len(names))
+        return self.shutdown_many(names)
+
+
+class MasterActivity(object):
+    """Activity of the slaves connected to the masters of masters_json"""
+
+    def __init__(self, masters_json, state_file=None, timeout=MASTER_TIMEOUT,
+                 workers=MASTER_WORKERS, client=None):
+        self.masters = [m for m in masters_json if m.get("enabled", True)]
+        self.state_file = state_file
+        self.timeout = timeout
+        self.workers = workers
+        self.client = client or MasterClient(masters_json, timeout, workers)
+        self._lock = threading.Lock()
+        self._reports = {}
+        # slave name -> [time it was first seen idle, get_last_builds()]
+        self._idle_since = {}
+        self.load()
+
+    def load(self):
+        if not self.state_file:
+            return
+        idle_since = load_versioned_json(self.state_file, STATE_VERSION,
+                                         "idle_since", dict)
+        if idle_since is not None:
+            self._idle_since = idle_since
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            idle_since = dict(self._idle_since)
+        save_versioned_json(self.state_file, STATE_VERSION, "idle_since",
+                            idle_since)
+
+    def _query(self, master):
+        try:
+            return master, self.client.get_slaves(master["hostname"])
+        except Exception:
+            log.warn("Cannot get slaves of %s, falling back to SSH",
+                     master["hostname"], exc_info=True)
+            return master, None
+
+    def refresh(self):
+        """Queries all masters. Returns the number of reported slaves."""
+        now = time.time()
+        reports = {}
+        idle_since = {}
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            results = list(executor.map(self._query, self.masters))
+        finally:
+            executor.shutdown(wait=True)
+        listed = set()
+        with self._lock:
+            for master, slaves in results:
+                for name, status in (slaves or {}).iteritems():
+                    listed.add(name)
+                    if not status.get("connected"):
+                        continue
+                    self.client.attach(name, master["hostname"])
+                    builds = get_last_builds(status)
+                    if status.get("runningBuilds"):
+                        last_activity = 0
+                    elif name in self._idle_since and \
+                            self._idle_since[name][1] == builds:
+                        idle_since[name] = self._idle_since[name]
+                        last_activity = now - idle_since[name][0]
+                    else:
+                        # Idle for an unknown time, or ran builds since the
+                        # last sweep. Reported from the next sweep on.
+                        idle_since[name] = [now, builds]
+                        continue
+                    reports[name] = SlaveReport(
+                        name, master["hostname"], master["http_port"],
+                        last_activity)
+            if any(slaves is None for _, slaves in results):
+                # Some slaves belong to the masters which didn't answer
+                for name, since in self._idle_since.iteritems():
+                    if name not in listed:
+                        idle_since[name] = since
+            self._reports = reports
+            self._idle_since = idle_since
+        log.debug("%i slaves reported by %i masters", len(reports),
+                  len(self.masters))
+        return len(reports)
+
+    def get(self, name):
+        """Returns the SlaveReport of a slave, None if no master reported it
+        as connected or if it is idle since an unknown time"""
+        with self._lock:
+            return self._reports.get(name)
+
+    def is_connected(self, report):
+        """Asks the master of a reported slave whether it is still
+        connected"""
+        status = self.client.get_slave(report.master_host, report.name)
+        return bool(status.get("connected"))
+
+    def shutdown(self, report):
+        self.client.attach(report.name, report.master_host)
+        self.client.shutdown(report.name)
+
+    def __len__(self):
+        return len(self._reports)
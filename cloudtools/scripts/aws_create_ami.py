@@ -12,6 +12,7 @@ from fabric.api import run, put, lcd
 from fabric.context_managers import hide
 from cloudtools.aws import AMI_CONFIGS_DIR, wait_for_status
 from cloudtools.aws.ami import ami_cleanup, copy_ami
+from cloudtools.aws.ratelimit import report_throttle_stats
 from cloudtools.aws.instance import run_instance, assimilate_instance
 from cloudtools.fabric import setup_fabric_env
 
@@ -512,6 +513,7 @@ def main():
         log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"), r)
         new_ami = copy_ami(ami, r)
         log.info("New AMI created. AMI ID: %s", new_ami.id)
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
@@ -17,6 +17,7 @@ from cloudtools.dns import get_ip, get_ptr
 from cloudtools.aws.instance import assimilate_instance, \
     make_instance_interfaces, user_data_from_template, \
     pick_puppet_master
+from cloudtools.aws.ratelimit import report_throttle_stats
 from cloudtools.aws.vpc import get_subnet_id, ip_available
 from cloudtools.aws.ami import ami_cleanup, volume_to_ami, copy_ami, \
     get_ami
@@ -318,6 +319,7 @@ def main():
         log.info("Copying %s (%s) to %s", ami.id, ami.tags.get("Name"), r)
         new_ami = copy_ami(ami, r)
         log.info("New AMI created. AMI ID: %s", new_ami.id)
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
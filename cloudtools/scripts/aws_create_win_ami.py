@@ -17,6 +17,7 @@ from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
 from boto.ec2.networkinterface import NetworkInterfaceSpecification, \
     NetworkInterfaceCollection
 from cloudtools.aws import AMI_CONFIGS_DIR, wait_for_status, get_aws_connection
+from cloudtools.aws.ratelimit import report_throttle_stats
 from docopt import docopt
 
 log = logging.getLogger(__name__)
@@ -118,6 +119,7 @@ def main():
     host_instance = create_instance(connection, args['INSTANCE_NAME'], config,
                                     args['--key-name'])
     create_ami(host_instance, args['--config'], config)
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
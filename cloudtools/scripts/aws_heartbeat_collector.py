@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Collects buildslave heartbeats for aws_stop_idle --heartbeats
+
+Usage: aws_heartbeat_collector -k secrets.json [-p PORT] -s heartbeats.json
+
+Requests need the "heartbeat_token" of the secrets file. The collector only
+listens on localhost unless told otherwise with --bind.
+"""
+import argparse
+import json
+import logging
+
+from cloudtools.heartbeat import HeartbeatCollector, HeartbeatStore
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_const",
+                        dest="loglevel", const=logging.DEBUG,
+                        default=logging.INFO)
+    parser.add_argument("-k", "--secrets", type=argparse.FileType('r'),
+                        required=True,
+                        help="file with the heartbeat_token")
+    parser.add_argument("-b", "--bind", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=8011)
+    parser.add_argument("-s", "--store", required=True,
+                        help="file the heartbeats are kept in")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+
+    token = json.load(args.secrets).get("heartbeat_token")
+    if not token:
+        parser.error("no heartbeat_token in the secrets file")
+
+    store = HeartbeatStore(args.store)
+    server = HeartbeatCollector((args.bind, args.port), store, token)
+    log.info("listening on %s:%s, %i slaves known", args.bind, args.port,
+             len(store))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,10 @@ import logging
 import collections
 import re
 
-from cloudtools.aws.sanity import AWSInstance, aws_instance_factory, SLAVE_TAGS
+from cloudtools.aws.sanity import AWSInstance, aws_instance_factory, \
+    SLAVE_TAGS, Slave, BuildapiCache, BUILDAPI_CACHE_TTL
 from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS
+from cloudtools.aws.ratelimit import report_throttle_stats
 
 log = logging.getLogger(__name__)
 
@@ -202,14 +204,26 @@ def _report_instance_stats(instances, regions):
     print
 
 
-def generate_report(connection, regions, instances, volumes, events_dir):
+def generate_report(connection, regions, instances, volumes, events_dir,
+                    buildapi_cache=None):
     """creates the final report"""
+    if buildapi_cache is None:
+        buildapi_cache = BuildapiCache()
     aws_instances = []
     for instance in instances:
-        aws_instances.append(aws_instance_factory(instance, events_dir))
+        aws_instances.append(aws_instance_factory(instance, events_dir,
+                                                  buildapi_cache))
     bad_type = [i for i in aws_instances if i.bad_type()]
     bad_state = [i for i in aws_instances if i.bad_state()]
     long_running = [i for i in aws_instances if i.is_long_running()]
+    # only long running slaves can be lazy, ask buildapi about all of them
+    # at once. Cached endtimes which would make a slave lazy are fetched
+    # again, lazy spot instances get terminated.
+    slaves = [i for i in long_running if isinstance(i, Slave)]
+    buildapi_cache.fetch([i.get_name() for i in slaves],
+                         refetch=[i.get_name() for i in slaves
+                                  if not i.cached_endtime_usable()])
+    buildapi_cache.save()
     long_stopped = [i for i in aws_instances if i.is_long_stopped()]
     lazy = [i for i in long_running if i.is_lazy()]
     loaned = [i for i in aws_instances if i.is_loaned()]
@@ -248,6 +262,12 @@ def main():
                         help="Supress logging messages")
     parser.add_argument("--events-dir", dest="events_dir",
                         help="cloudtrail logs event directory")
+    parser.add_argument("--buildapi-cache", dest="buildapi_cache",
+                        help="json file keeping buildapi results between "
+                        "runs")
+    parser.add_argument("--buildapi-ttl", dest="buildapi_ttl", type=int,
+                        default=BUILDAPI_CACHE_TTL,
+                        help="seconds buildapi results are reused for")
     args = parser.parse_args()
 
     logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
@@ -269,7 +289,10 @@ def main():
                     regions=args.regions,
                     instances=all_instances,
                     volumes=all_volumes,
-                    events_dir=args.events_dir)
+                    events_dir=args.events_dir,
+                    buildapi_cache=BuildapiCache(args.buildapi_cache,
+                                                 args.buildapi_ttl))
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
@@ -8,17 +8,23 @@ import logging.handlers
 import time
 import calendar
 import random
-import threading
 import boto.ec2
 import requests
 import logging
 import json
 
-from Queue import Queue, Empty
-from cloudtools.aws import get_impaired_instance_ids, get_buildslave_instances
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from cloudtools.aws import get_impaired_instance_ids, \
+    get_buildslave_instances, terminate_instances
+from cloudtools.aws.ratelimit import report_throttle_stats
 from cloudtools.buildbot import graceful_shutdown, get_last_activity, \
-    ACTIVITY_STOPPED, ACTIVITY_BOOTING
+    probe_slave, ACTIVITY_STOPPED, ACTIVITY_BOOTING
+from cloudtools.drains import DrainLedger, find_drained
+from cloudtools.heartbeat import load_heartbeats, heartbeat_activity
+from cloudtools.masters import MasterActivity, MasterClient
 from cloudtools.ssh import SSHClient
+from cloudtools.twistd_log import LogCursorStore, get_log_stats, \
+    reset_log_stats
 import cloudtools.graphite
 from cloudtools.log import add_syslog_handler
 
@@ -30,106 +36,363 @@ gr_log = cloudtools.graphite.get_graphite_logger()
 STOP_THRESHOLD_MINS_SPOT = 45
 STOP_THRESHOLD_MINS_ONDEMAND = 30
 
+# Number of instances checked in parallel. Checks mostly wait for SSH and
+# the masters, so this can be far larger than the number of CPUs.
+DEFAULT_CONCURRENCY = 128
+# Upper bounds, in seconds, of the per instance check latency histogram
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 300]
+# Odds that checking a slave stops its instance, by what the masters or the
+# heartbeats said about the slave before the check
+IDLE_ODDS_UNKNOWN = 0.5
+IDLE_ODDS_IDLE = 0.9
+IDLE_ODDS_BUSY = 0.1
+# Slaves idle for longer than this many seconds are terminated without
+# waiting for the graceful shutdown
+IDLE_TERMINATE_AFTER = 8 * 3600
 
-def aws_safe_stop_instance(i, impaired_ids, user, key_filename, masters_json,
-                           dryrun=False):
-    "Returns True if stopped"
-    # TODO: Check with slavealloc
 
-    ssh_client = SSHClient(instance=i, username=user,
-                           key_filename=key_filename).connect()
-    stopped = False
-    launch_time = calendar.timegm(time.strptime(
-        i.launch_time[:19], '%Y-%m-%dT%H:%M:%S'))
-    if not ssh_client:
-        if i.id in impaired_ids:
-            if time.time() - launch_time > 60 * 10:
-                stopped = True
-                if not dryrun:
-                    log.debug(
-                        "%s - shut down an instance with impaired status",
-                        ssh_client.name)
-                    i.terminate()
-                    gr_log.add("impaired.{moz_type}".format(
-                        ssh_client.instance.tags.get("moz-type", "none")), 1,
-                        collect=True)
-                else:
-                    log.debug("%s - would have stopped", ssh_client.name)
-        return stopped
+def get_launch_time(i):
+    return calendar.timegm(time.strptime(i.launch_time[:19],
+                                         '%Y-%m-%dT%H:%M:%S'))
+
 
+def too_young(i, name, launch_time):
+    """Returns True if the instance should not be stopped yet"""
     uptime_min = int((time.time() - launch_time) / 60)
     # Don't try to stop spot instances until after STOP_THRESHOLD_MINS_SPOT
     # minutes into each hour
     if i.spot_instance_request_id:
         threshold = STOP_THRESHOLD_MINS_SPOT
         if uptime_min % 60 < threshold:
-            log.debug("Skipping %s, with uptime %s", ssh_client.name,
-                      uptime_min)
-            return False
+            log.debug("Skipping %s, with uptime %s", name, uptime_min)
+            return True
     else:
         # On demand instances can be stopped after STOP_THRESHOLD_MINS_ONDEMAND
         threshold = STOP_THRESHOLD_MINS_ONDEMAND
         if uptime_min < threshold:
-            log.debug("Skipping %s, with updtime %s", ssh_client.name,
-                      uptime_min)
-            return False
-
-    last_activity = get_last_activity(ssh_client)
+            log.debug("Skipping %s, with updtime %s", name, uptime_min)
+            return True
+    return False
+
+
+def stop_priority(i, launch_time, last_activity=None, impaired=False):
+    """Returns the expected savings of checking the instance now, higher
+    first, or None if it can't be stopped yet. `last_activity` is what is
+    known of the slave without asking it, None if nothing."""
+    name = i.tags.get("Name")
+    if impaired:
+        return 1.0
+    if last_activity == ACTIVITY_BOOTING or too_young(i, name, launch_time):
+        return None
+    if last_activity == ACTIVITY_STOPPED:
+        odds = 1.0
+    elif last_activity is None:
+        odds = IDLE_ODDS_UNKNOWN
+    elif last_activity > 300:
+        odds = IDLE_ODDS_IDLE
+    else:
+        odds = IDLE_ODDS_BUSY
+    if i.spot_instance_request_id:
+        # Spot instances are paid by the started hour: stopping one before
+        # the hour boundary saves the next hour, and the window closes soon
+        into_hour = int((time.time() - launch_time) / 60) % 60
+        odds *= 1 + float(into_hour - STOP_THRESHOLD_MINS_SPOT) / \
+            (60 - STOP_THRESHOLD_MINS_SPOT)
+    return odds
+
+
+def schedule_instances(instances, impaired_ids, known_activity=None):
+    """Returns the instances worth checking, the most valuable first.
+    known_activity(name) returns the last activity of a slave known without
+    SSH, or None."""
+    scheduled = []
+    for i in instances:
+        last_activity = None
+        if known_activity is not None:
+            last_activity = known_activity(i.tags.get("Name"))
+        priority = stop_priority(i, get_launch_time(i), last_activity,
+                                 i.id in impaired_ids)
+        if priority is not None:
+            scheduled.append((priority, i))
+    # Stable, so that the shuffled order breaks ties
+    scheduled.sort(key=lambda x: x[0], reverse=True)
+    log.debug("%i instances to check, %i can't be stopped yet",
+              len(scheduled), len(instances) - len(scheduled))
+    return [i for _, i in scheduled]
+
+
+def terminate_now(i):
+    i.terminate()
+
+
+def stop_if_idle(i, name, last_activity, shutdown, has_stopped, dryrun,
+                 terminate=terminate_now):
+    """Stops the instance depending on the last activity of its slave.
+    shutdown() starts a graceful shutdown, has_stopped() tells whether the
+    slave exited and terminate(i) stops the instance. Returns True if
+    stopped."""
+    stopped = False
     if last_activity == ACTIVITY_STOPPED:
         stopped = True
         if not dryrun:
-            log.debug("%s - stopping instance (launched %s)", ssh_client.name,
+            log.debug("%s - stopping instance (launched %s)", name,
                       i.launch_time)
-            i.terminate()
+            terminate(i)
         else:
-            log.debug("%s - would have stopped", ssh_client.name)
+            log.debug("%s - would have stopped", name)
         return stopped
 
     if last_activity == ACTIVITY_BOOTING:
         # Wait harder
         return stopped
 
-    log.debug("%s - last activity %s", ssh_client.name, last_activity)
+    log.debug("%s - last activity %s", name, last_activity)
 
     # If it looks like we're idle for more than 8 hours, kill the machine
-    if last_activity > 8 * 3600:
+    if last_activity > IDLE_TERMINATE_AFTER:
         log.debug("%s - last activity more than 8 hours ago; shutting down",
-                  ssh_client.name)
+                  name)
         if not dryrun:
-            log.debug("%s - starting graceful shutdown", ssh_client.name)
-            graceful_shutdown(ssh_client, masters_json)
+            log.debug("%s - starting graceful shutdown", name)
+            shutdown()
             # Stop the instance
-            log.debug("%s - stopping instance", ssh_client.name)
-            i.terminate()
+            log.debug("%s - stopping instance", name)
+            terminate(i)
             stopped = True
 
     # If the machine is idle for more than 5 minutes, shut it down
     elif last_activity > 300:
         if not dryrun:
             # Hit graceful shutdown on the master
-            log.debug("%s - starting graceful shutdown", ssh_client.name)
-            graceful_shutdown(ssh_client, masters_json)
+            log.debug("%s - starting graceful shutdown", name)
+            shutdown()
 
             # Check if we've exited right away
-            if get_last_activity(ssh_client) == ACTIVITY_STOPPED:
-                log.debug("%s - stopping instance", ssh_client.name)
-                i.terminate()
+            if has_stopped():
+                log.debug("%s - stopping instance", name)
+                terminate(i)
                 stopped = True
             else:
                 log.debug(
                     "%s - not stopping, waiting for graceful shutdown",
-                    ssh_client.name)
+                    name)
         else:
-            log.debug("%s - would have started graceful shutdown",
-                      ssh_client.name)
+            log.debug("%s - would have started graceful shutdown", name)
             stopped = True
     else:
-        log.debug("%s - not stopping", ssh_client.name)
+        log.debug("%s - not stopping", name)
     return stopped
 
 
+def get_beat_master_status(master_client, name, beat):
+    """Returns the status of a slave according to the master named in its
+    heartbeat, None if the master is unknown or can't be asked"""
+    if beat.master_host not in master_client.ports:
+        log.debug("%s - unknown master %s, not trusting the heartbeat",
+                  name, beat.master_host)
+        return None
+    try:
+        return master_client.get_slave(beat.master_host, name)
+    except Exception:
+        log.debug("%s - cannot confirm the heartbeat with %s", name,
+                  beat.master_host, exc_info=True)
+        return None
+
+
+def master_confirms_stopped(master_client, name, beat):
+    """Returns True if the master of a slave which reported its shutdown
+    doesn't see it connected anymore"""
+    status = get_beat_master_status(master_client, name, beat)
+    if status is None:
+        return False
+    if status.get("connected"):
+        log.warn("%s - reported a shutdown but is connected to %s", name,
+                 beat.master_host)
+        return False
+    return True
+
+
+def master_confirms_idle(master_client, name, beat):
+    """Returns True if the master of a slave which reported being idle
+    doesn't see it running builds"""
+    status = get_beat_master_status(master_client, name, beat)
+    if status is None:
+        return False
+    if status.get("runningBuilds"):
+        log.warn("%s - reported being idle but runs builds on %s", name,
+                 beat.master_host)
+        return False
+    return True
+
+
+def aws_safe_stop_instance(i, impaired_ids, user, key_filename, masters_json,
+                           dryrun=False, cursors=None, master_activity=None,
+                           heartbeats=None, master_client=None, drains=None,
+                           terminate=terminate_now):
+    "Returns True if stopped"
+    # TODO: Check with slavealloc
+
+    launch_time = get_launch_time(i)
+    if master_client is None:
+        master_client = MasterClient(masters_json)
+    name = i.tags.get("Name")
+
+    def drain(shutdown):
+        """Records shutdown requests in the drain ledger"""
+        def wrapper():
+            shutdown()
+            if drains is not None:
+                drains.record(i.id, name, master_client.get_attached(name))
+        return wrapper
+
+    # Fresh heartbeats spare the SSH round trip. Anything that could post
+    # a heartbeat could claim a shutdown or a long idle time though, so the
+    # master confirms every heartbeat which gets the instance terminated.
+    beat = heartbeats.get(name) if heartbeats is not None else None
+    last_activity = heartbeat_activity(beat) if beat else None
+    if last_activity == ACTIVITY_STOPPED:
+        if not master_confirms_stopped(master_client, name, beat):
+            last_activity = None
+    elif last_activity not in (None, ACTIVITY_BOOTING) and \
+            last_activity > IDLE_TERMINATE_AFTER:
+        if not master_confirms_idle(master_client, name, beat):
+            last_activity = None
+    if beat and beat.master_host and last_activity is not None:
+        if too_young(i, name, launch_time):
+            return False
+        master_client.attach(name, beat.master_host)
+        # The slave reports the shutdown in a later heartbeat, so the
+        # shutdowns can be sent as one batch after the sweep
+        return stop_if_idle(
+            i, name, last_activity,
+            shutdown=drain(lambda: master_client.defer_shutdown(name)),
+            has_stopped=lambda: False, dryrun=dryrun, terminate=terminate)
+
+    # Slaves connected to a master don't need to be asked over SSH
+    report = None
+    if master_activity is not None:
+        report = master_activity.get(i.tags.get("Name"))
+    if report:
+        if too_young(i, report.name, launch_time):
+            return False
+        return stop_if_idle(
+            i, report.name, report.last_activity,
+            shutdown=drain(lambda: master_activity.shutdown(report)),
+            has_stopped=lambda: not master_activity.is_connected(report),
+            dryrun=dryrun, terminate=terminate)
+
+    ssh_client = SSHClient(instance=i, username=user,
+                           key_filename=key_filename).connect()
+    stopped = False
+    if not ssh_client:
+        if i.id in impaired_ids:
+            if time.time() - launch_time > 60 * 10:
+                stopped = True
+                if not dryrun:
+                    log.debug(
+                        "%s - shut down an instance with impaired status",
+                        ssh_client.name)
+                    terminate(i)
+                    gr_log.add("impaired.{moz_type}".format(
+                        ssh_client.instance.tags.get("moz-type", "none")), 1,
+                        collect=True)
+                else:
+                    log.debug("%s - would have stopped", ssh_client.name)
+        return stopped
+
+    if too_young(i, ssh_client.name, launch_time):
+        return False
+
+    # One round trip for the activity and the master of the slave, reading
+    # only the log lines appended since the last sweep
+    cursor = cursors.get(i.id) if cursors is not None else None
+    probe = probe_slave(ssh_client, cursor)
+    if cursors is not None:
+        cursors.set(i.id, probe.cursor)
+
+    def has_stopped():
+        reprobe = probe_slave(ssh_client, probe.cursor)
+        if cursors is not None:
+            cursors.set(i.id, reprobe.cursor)
+        return get_last_activity(ssh_client, reprobe) == ACTIVITY_STOPPED
+
+    return stop_if_idle(
+        i, ssh_client.name, get_last_activity(ssh_client, probe),
+        shutdown=drain(lambda: graceful_shutdown(
+            ssh_client, masters_json, master_host=probe.master_host,
+            client=master_client)),
+        has_stopped=has_stopped, dryrun=dryrun, terminate=terminate)
+
+
+def check_instances(instances, check, concurrency=DEFAULT_CONCURRENCY,
+                    latency=None, deadline=None):
+    """Calls check(i) for every instance, in order, `concurrency` at a time.
+    Returns the instances check returned True for. The time spent per
+    instance is observed by the `latency` histogram, if given. Checks not
+    started by the `deadline` epoch are skipped."""
+    def timed_check(i):
+        start = time.time()
+        try:
+            return check(i)
+        finally:
+            if latency:
+                latency.observe(time.time() - start)
+
+    rv = []
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = dict((executor.submit(timed_check, i), i) for i in instances)
+    try:
+        while pending:
+            if deadline is not None and time.time() > deadline:
+                skipped = [f for f in pending if f.cancel()]
+                if skipped:
+                    log.warn("Sweep deadline reached, skipping %i instances",
+                             len(skipped))
+                    gr_log.add("sweep.skipped", len(skipped))
+                for future in skipped:
+                    del pending[future]
+                deadline = None
+                continue
+            # Wait with a timeout, so that KeyboardInterrupt gets through
+            timeout = 0.5
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.time()))
+            done, _ = wait(pending, timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                try:
+                    if future.result():
+                        rv.append(i)
+                except Exception:
+                    log.debug("%s - unable to stop" % i.tags.get('Name'),
+                              exc_info=True)
+    except KeyboardInterrupt:
+        for future in pending:
+            future.cancel()
+        raise SystemExit(1)
+    finally:
+        executor.shutdown(wait=False)
+    return rv
+
+
+def terminate_batch(instances, drains=None):
+    """Terminates instances with batched calls. Returns the terminated
+    ones, which are removed from the drain ledger."""
+    failed = terminate_instances(instances)
+    if failed:
+        log.warn("Cannot terminate %s", ", ".join(i.id for i in failed))
+    terminated = [i for i in instances if i not in failed]
+    if drains is not None:
+        drains.forget(i.id for i in terminated)
+    return terminated
+
+
 def aws_stop_idle(user, key_filename, regions, masters_json, moz_types,
-                  dryrun=False, concurrency=8):
+                  dryrun=False, concurrency=DEFAULT_CONCURRENCY,
+                  cursors_file=None, use_masters=True, masters_state_file=None,
+                  heartbeats_source=None, deadline=None, drains_file=None,
+                  heartbeat_token=None):
     if not regions:
         # Look at all regions
         log.debug("loading all regions")
@@ -165,50 +428,113 @@ def aws_stop_idle(user, key_filename, regions, masters_json, moz_types,
 
         all_instances.extend(instances)
 
+    # The order of equally valuable instances changes between sweeps
     random.shuffle(all_instances)
 
-    q = Queue()
-    to_stop = Queue()
-
-    def worker():
-        while True:
-            try:
-                i = q.get(timeout=0.1)
-            except Empty:
-                return
-            try:
-                if aws_safe_stop_instance(i, impaired_ids, user, key_filename,
-                                          masters_json, dryrun=dryrun):
-                    to_stop.put(i)
-            except Exception:
-                log.debug("%s - unable to stop" % i.tags.get('Name'),
-                          exc_info=True)
-
-    for i in all_instances:
-        q.put(i)
+    cursors = None
+    if cursors_file:
+        cursors = LogCursorStore(cursors_file)
+        # Forget instances which are gone
+        cursors.prune(i.id for i in all_instances)
+    reset_log_stats()
+
+    heartbeats = None
+    if heartbeats_source:
+        try:
+            heartbeats = load_heartbeats(heartbeats_source, heartbeat_token)
+            gr_log.add("heartbeats.known", len(heartbeats))
+        except Exception:
+            log.warn("Cannot load heartbeats from %s", heartbeats_source,
+                     exc_info=True)
+
+    # Shared by all checks: one master lookup table and connection pool
+    master_client = MasterClient(masters_json, workers=concurrency)
+    master_activity = None
+    if use_masters:
+        master_activity = MasterActivity(masters_json, masters_state_file,
+                                         client=master_client)
+        master_activity.refresh()
+
+    # Slaves which drained since the last sweep are stopped right away
+    drains = None
+    drained = []
+    if drains_file:
+        drains = DrainLedger(drains_file)
+        drains.prune(i.id for i in all_instances)
+        drains.expire()
+        drained = find_drained(drains, all_instances, master_client)
+        log.info("%i of %i drained slaves are ready to be stopped",
+                 len(drained), len(drains))
+        gr_log.add("drains.pending", len(drains))
+        gr_log.add("drains.confirmed", len(drained))
+        drained_ids = set(i.id for i in drained)
+        all_instances = [i for i in all_instances if i.id not in drained_ids]
+        if drained and not dryrun:
+            drained = terminate_batch(drained, drains)
+
+    # Terminated in batches after the checks
+    to_terminate = []
+
+    def check(i):
+        return aws_safe_stop_instance(i, impaired_ids, user, key_filename,
+                                      masters_json, dryrun=dryrun,
+                                      cursors=cursors,
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client,
+                                      drains=drains,
+                                      terminate=to_terminate.append)
+
+    def known_activity(name):
+        beat = heartbeats.get(name) if heartbeats is not None else None
+        if beat and heartbeat_activity(beat) is not None:
+            return heartbeat_activity(beat)
+        if master_activity is not None and master_activity.get(name):
+            return master_activity.get(name).last_activity
+        return None
 
     # Workaround for http://bugs.python.org/issue11108
     time.strptime("19000102030405", "%Y%m%d%H%M%S")
-    threads = []
-    for i in range(concurrency):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    while threads:
-        for t in threads[:]:
-            try:
-                if t.is_alive():
-                    t.join(timeout=0.5)
-                else:
-                    t.join()
-                    threads.remove(t)
-            except KeyboardInterrupt:
-                raise SystemExit(1)
+    scheduled = schedule_instances(all_instances, impaired_ids,
+                                   known_activity)
+    gr_log.add("sweep.scheduled", len(scheduled))
+    latency = cloudtools.graphite.Histogram(LATENCY_BUCKETS)
+    start = time.time()
+    to_stop = check_instances(
+        scheduled, check, concurrency=concurrency, latency=latency,
+        deadline=start + deadline if deadline else None)
+    failed = master_client.flush_shutdowns()
+    if failed:
+        log.warn("Graceful shutdown failed for %s", ", ".join(failed))
+        if drains is not None:
+            drains.forget_slaves(failed)
+    if to_terminate and not dryrun:
+        terminated = terminate_batch(to_terminate, drains)
+        to_stop = [i for i in to_stop
+                   if i in terminated or i not in to_terminate]
+    to_stop = drained + to_stop
+    sweep_seconds = time.time() - start
+    log.info("checked %i instances in %.1fs, slowest check took %.1fs",
+             latency.count, sweep_seconds, latency.max)
+    gr_log.add("sweep.seconds", sweep_seconds)
+    gr_log.add("sweep.instances", len(all_instances))
+    latency.report(gr_log, "check_latency")
+    log_stats = get_log_stats()
+    log.info("read %(bytes)i bytes of twistd.log, %(incremental)i "
+             "incremental and %(full)i full reads, parsed in "
+             "%(parse_seconds).2fs", log_stats)
+    for name, value in log_stats.iteritems():
+        gr_log.add("twistd_log.%s" % name, value)
+    if cursors is not None:
+        cursors.save()
+    if master_activity is not None:
+        gr_log.add("masters.reported", len(master_activity))
+        master_activity.save()
+    if drains is not None:
+        drains.save()
 
     total_stopped = {}
-    while not to_stop.empty():
-        i = to_stop.get()
+    for i in to_stop:
         if not dryrun:
             i.update()
         if 'moz-type' not in i.tags:
@@ -240,11 +566,34 @@ def main():
     parser.add_argument("-t", "--moz-type", action="append", dest="moz_types",
                         required=True,
                         help="moz-type tag values to be checked")
-    parser.add_argument("-j", "--concurrency", type=int, default=8)
+    parser.add_argument("-j", "--concurrency", type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help="number of instances checked in parallel")
     parser.add_argument(
         "--masters-json",
         default="https://hg.mozilla.org/build/tools/raw-file/default/buildfarm"
         "/maintenance/production-masters.json")
+    parser.add_argument("--log-cursors", default="aws_stop_idle_cursors.json",
+                        help="file keeping the twistd.log position of each "
+                        "instance between runs")
+    parser.add_argument("--no-masters", action="store_false",
+                        dest="use_masters",
+                        help="check all slaves over SSH instead of asking "
+                        "the masters first")
+    parser.add_argument("--masters-state",
+                        default="aws_stop_idle_masters.json",
+                        help="file keeping since when slaves are idle "
+                        "according to the masters")
+    parser.add_argument("--drains", default="aws_stop_idle_drains.json",
+                        help="file keeping the slaves asked to shut down, "
+                        "checked first by the next run")
+    parser.add_argument("--heartbeats",
+                        help="heartbeat store file or aws_heartbeat_collector "
+                        "URL, checked before the masters and SSH")
+    parser.add_argument("--deadline", type=int,
+                        help="seconds after which instances not checked yet "
+                        "are left for the next run, the most valuable ones "
+                        "are checked first")
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument("-l", "--logfile", dest="logfile",
                         help="log file for full debug log")
@@ -277,7 +626,13 @@ def main():
     aws_stop_idle(user=args.user, key_filename=args.ssh_key,
                   regions=args.regions, masters_json=masters_json,
                   moz_types=args.moz_types, dryrun=args.dry_run,
-                  concurrency=args.concurrency)
+                  concurrency=args.concurrency,
+                  cursors_file=args.log_cursors,
+                  use_masters=args.use_masters,
+                  masters_state_file=args.masters_state,
+                  heartbeats_source=args.heartbeats,
+                  deadline=args.deadline, drains_file=args.drains,
+                  heartbeat_token=secrets.get("heartbeat_token"))
     for entry in secrets.get("graphite_hosts", []):
         host = entry.get("host")
         port = entry.get("port")
@@ -289,6 +644,7 @@ def main():
         add_syslog_handler(log, address=secrets["syslog_address"],
                            app="aws_stop_idle")
 
+    report_throttle_stats(gr_log)
     gr_log.sendall()
     log.debug("done")
 
@@ -4,8 +4,9 @@ Watches pending jobs and starts or creates EC2 instances if required
 """
 # lint_ignore=E501,C901
 import argparse
+import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 import logging
 
 try:
@@ -14,7 +15,7 @@ try:
 except ImportError:
     import json
 
-from boto.exception import BotoServerError, EC2ResponseError
+from boto.exception import EC2ResponseError
 from boto.ec2.networkinterface import NetworkInterfaceCollection, \
     NetworkInterfaceSpecification
 
@@ -24,17 +25,30 @@ from cloudtools.aws import (get_aws_connection, aws_get_running_instances,
                             distribute_in_region, load_instance_config,
                             get_region_dns_atom)
 from cloudtools.aws.spot import get_spot_requests_for_moztype, \
-    usable_spot_choice, get_available_slave_name, get_spot_choices
+    usable_spot_choice, get_available_slave_name, get_spot_choices, \
+    tag_spot_requests, set_spot_price_store
+from cloudtools.aws.spot_price_cache import SpotPriceCache, DEFAULT_TTL
 from cloudtools.aws.ami import get_ami, get_spot_amis
-from cloudtools.aws.vpc import get_avail_subnet
+from cloudtools.aws.vpc import get_avail_subnet, get_subnet_capacity, \
+    allocate_subnet_ip
+from cloudtools.aws.spot_planner import plan_spot_allocation
+from cloudtools.aws.inventory import Inventory
+from cloudtools.aws.fleet import FleetIndex
+from cloudtools.aws.launcher import Launcher
+from cloudtools.aws.ratelimit import call_aws, set_rate_limits, \
+    report_throttle_stats
 from cloudtools.buildbot import find_pending, map_builders
 from cloudtools.aws.instance import create_block_device_mapping, \
     user_data_from_template, tag_ondemand_instance
 import cloudtools.graphite
 from cloudtools.log import add_syslog_handler
+from cloudtools import slavealloc
 
 log = logging.getLogger()
 gr_log = cloudtools.graphite.get_graphite_logger()
+timings = cloudtools.graphite.get_timings()
+# Launches report their metrics from the launcher threads
+_report_lock = threading.Lock()
 
 
 def find_prev_latest_amis_needed(latest_ami_percentage, latest_ami_count,
@@ -100,13 +114,15 @@ def find_prev_latest_amis_needed(latest_ami_percentage, latest_ami_count,
 
 
 def aws_resume_instances(all_instances, moz_instance_type, start_count,
-                         regions, region_priorities, dryrun):
-    """Create up to `start_count` on-demand instances"""
+                         regions, region_priorities, dryrun, launcher):
+    """Submits up to `start_count` on-demand instance launches to
+    `launcher`. Returns the number of submitted launches, launcher.wait()
+    returns the number of started instances."""
 
     start_count_per_region = distribute_in_region(start_count, regions,
                                                   region_priorities)
 
-    started = 0
+    submitted = 0
     instance_config = load_instance_config(moz_instance_type)
     for region, count in start_count_per_region.iteritems():
         # TODO: check region limits
@@ -119,19 +135,14 @@ def aws_resume_instances(all_instances, moz_instance_type, start_count,
                     price=None, availability_zone=None,
                     ami=ami, instance_config=instance_config,
                     instance_type=instance_config[region]["instance_type"],
-                    is_spot=False, dryrun=dryrun,
-                    all_instances=all_instances)
+                    dryrun=dryrun,
+                    all_instances=all_instances, launcher=launcher)
                 if r:
-                    started += 1
-            except EC2ResponseError, e:
-                # TODO: Handle e.code
-                log.warn("On-demand failure: %s; giving up", e.code)
-                log.warn("Cannot start", exc_info=True)
-                break
+                    submitted += 1
             except Exception:
                 log.warn("Cannot start", exc_info=True)
 
-    return started
+    return submitted
 
 
 def get_product_description(moz_instance_type):
@@ -140,33 +151,12 @@ def get_product_description(moz_instance_type):
     return "Linux/UNIX (Amazon VPC)"
 
 
-def request_spot_instances(all_instances, moz_instance_type, start_count,
-                           regions, region_priorities, spot_config, dryrun,
-                           latest_ami_percentage):
-    started = 0
-    spot_rules = spot_config.get("rules", {}).get(moz_instance_type)
-    if not spot_rules:
-        log.warn("No spot rules found for %s", moz_instance_type)
-        return 0
-
-    instance_config = load_instance_config(moz_instance_type)
-    connections = [get_aws_connection(r) for r in regions]
-    product_description = get_product_description(moz_instance_type)
-    spot_choices = get_spot_choices(connections, spot_rules, product_description)
-    if not spot_choices:
-        log.warn("No spot choices for %s", moz_instance_type)
-        log.warn("%s: market price too expensive in all available regions; spot instances needed: %i",
-                 moz_instance_type, start_count)
-        return 0
-
-    to_start = defaultdict(list)
-    active_instance_ids = set(i.id for i in all_instances)
-
-    # count the number of instances for each image id
-    ami_distribution = defaultdict(int)
-    for instance in all_instances:
-        ami_distribution[instance.image_id] += 1
-
+def get_spot_region_capacity(all_instances, moz_instance_type, regions,
+                             spot_config):
+    """Returns a {region: number of spot instances that can be started}
+    dict, according to the regional limits"""
+    rv = OrderedDict()
+    active_instance_ids = all_instances.ids
     for region in regions:
         # Check if spots are enabled in this region for this type
         region_limit = spot_config.get("limits", {}).get(region, {}).get(
@@ -193,169 +183,351 @@ def request_spot_instances(all_instances, moz_instance_type, start_count,
                       "hit limit of %s. Active count: %s", region,
                       region_limit, active_count)
             continue
+        rv[region] = can_be_started
+    return rv
+
+
+def get_spot_options(moz_instance_type, regions, spot_rules, capacity):
+    """Returns usable (spot choice, subnet capacity) tuples of a moz-type,
+    cheapest first"""
+    instance_config = load_instance_config(moz_instance_type)
+    connections = [get_aws_connection(r) for r in regions]
+    product_description = get_product_description(moz_instance_type)
+    with timings.span("get_spot_choices"):
+        spot_choices = get_spot_choices(connections, spot_rules,
+                                        product_description)
+    rv = []
+    for choice in spot_choices:
+        region = choice.region
+        if region not in capacity:
+            log.debug("Skipping %s for %s", choice, region)
+            continue
+        if not usable_spot_choice(choice):
+            log.debug("Skipping %s for %s - unusable", choice, region)
+            continue
+        with timings.span("get_avail_subnet"):
+            subnets = get_subnet_capacity(
+                region, instance_config[region]["subnet_ids"],
+                choice.availability_zone)
+        if not subnets:
+            log.debug("No free IP available for %s in %s", moz_instance_type,
+                      choice.availability_zone)
+            continue
+        rv.append((choice, subnets))
+    return rv
+
 
-        to_be_started_latest = min(can_be_started, start_count - started)
-        spot_amis = get_spot_amis(region=region, tags={"moz-type": moz_instance_type})
+def assign_spot_amis(plan, all_instances, latest_ami_percentage):
+    """Returns the plan with AMIs set. When the previous AMI is still in
+    use, the cheapest entries of each region get the previous AMI."""
+    counts = defaultdict(int)
+    for e in plan:
+        counts[e.moz_instance_type, e.choice.region] += e.count
+    # (moz-type, region) -> [[ami, instances], ...]
+    to_start = {}
+    for (moz_instance_type, region), count in counts.iteritems():
+        with timings.span("get_spot_amis"):
+            spot_amis = get_spot_amis(region=region,
+                                      tags={"moz-type": moz_instance_type})
         ami_latest = spot_amis[-1]
         if len(spot_amis) > 1 and latest_ami_percentage < 100:
             # get the total number of running instances with both the latest and
             # prevous ami types, so that we can decide how many of each type to
             # launch.
             ami_prev = spot_amis[-2]
-            prev_ami_count = ami_distribution[ami_prev.id]
-            latest_ami_count = ami_distribution[ami_latest.id]
+            prev_ami_count = all_instances.count_by_ami(ami_prev.id)
+            latest_ami_count = all_instances.count_by_ami(ami_latest.id)
             ami_prev_to_start, ami_latest_to_start = find_prev_latest_amis_needed(
                 latest_ami_percentage,
                 prev_ami_count,
                 latest_ami_count,
-                to_be_started_latest
+                count
             )
-            to_start[region].append({"ami": ami_prev, "instances": ami_prev_to_start})
-            to_start[region].append({"ami": ami_latest, "instances": ami_latest_to_start})
+            to_start[moz_instance_type, region] = [
+                [ami_prev, ami_prev_to_start],
+                [ami_latest, ami_latest_to_start]]
         else:
-            to_start[region].append({"ami": ami_latest, "instances": to_be_started_latest})
-    if not to_start:
-        log.debug("Nothing to start for %s", moz_instance_type)
-        return 0
+            to_start[moz_instance_type, region] = [[ami_latest, count]]
+
+    rv = []
+    for e in plan:
+        remaining = e.count
+        for entry in to_start[e.moz_instance_type, e.choice.region]:
+            ami, available = entry
+            count = min(remaining, available)
+            if count > 0:
+                rv.append(e._replace(count=count, ami=ami))
+                entry[1] -= count
+                remaining -= count
+    return rv
 
-    for choice in spot_choices:
-        region = choice.region
-        if region not in to_start:
-            log.debug("Skipping %s for %s", choice, region)
+
+def plan_spot_launches(all_instances, demands, regions, spot_config,
+                       latest_ami_percentage):
+    """Plans the spot launches of all moz-types at once. `demands` maps
+    moz-types to the number of instances needed. Returns a list of
+    LaunchPlanEntry tuples."""
+    if not isinstance(all_instances, FleetIndex):
+        all_instances = FleetIndex(all_instances)
+    region_capacity = {}
+    choices = {}
+    subnet_capacity = {}
+    for moz_instance_type, start_count in demands.iteritems():
+        spot_rules = spot_config.get("rules", {}).get(moz_instance_type)
+        if not spot_rules:
+            log.warn("No spot rules found for %s", moz_instance_type)
             continue
-        if not usable_spot_choice(choice):
-            log.debug("Skipping %s for %s - unusable", choice, region)
+        capacity = get_spot_region_capacity(all_instances, moz_instance_type,
+                                            regions, spot_config)
+        if not capacity:
+            log.debug("Nothing to start for %s", moz_instance_type)
             continue
-        for to_start_entry in to_start[region]:
-            need = min(to_start_entry["instances"], start_count - started)
-            if need > 0:
-                log.debug("Need %s of %s in %s", need, moz_instance_type,
-                          choice.availability_zone)
-
-                log.debug("Using %s", choice)
-                launched = do_request_spot_instances(
-                    amount=need,
-                    region=region,
-                    moz_instance_type=moz_instance_type,
-                    ami=to_start_entry["ami"],
-                    instance_config=instance_config, dryrun=dryrun,
-                    spot_choice=choice,
-                    all_instances=all_instances,
-                )
-                started += launched
-
-        if started >= start_count:
-            break
-
-    return started
+        options = get_spot_options(moz_instance_type, regions, spot_rules,
+                                   capacity)
+        if not options:
+            log.warn("No spot choices for %s", moz_instance_type)
+            log.warn("%s: market price too expensive in all available regions; spot instances needed: %i",
+                     moz_instance_type, start_count)
+            continue
+        for region, count in capacity.iteritems():
+            region_capacity[moz_instance_type, region] = count
+        choices[moz_instance_type] = []
+        for choice, subnets in options:
+            choices[moz_instance_type].append((choice, sorted(subnets)))
+            for subnet_id, spare in subnets.iteritems():
+                subnet_capacity[choice.region, subnet_id] = spare
+
+    plan = plan_spot_allocation(
+        dict((t, c) for t, c in demands.iteritems() if t in choices),
+        region_capacity, choices, subnet_capacity)
+    return assign_spot_amis(plan, all_instances, latest_ami_percentage)
+
+
+def execute_spot_plan(plan, all_instances, dryrun, launcher):
+    """Submits the spot launches of a plan to `launcher`. Returns a Counter
+    of submitted launches per moz-type, launcher.wait() returns the number
+    of started instances."""
+    submitted = Counter()
+    for e in plan:
+        log.debug("Need %s of %s in %s", e.count, e.moz_instance_type,
+                  e.choice.availability_zone)
+        log.debug("Using %s", e.choice)
+        submitted[e.moz_instance_type] += do_request_spot_instances(
+            amount=e.count,
+            region=e.choice.region,
+            moz_instance_type=e.moz_instance_type,
+            ami=e.ami,
+            instance_config=load_instance_config(e.moz_instance_type),
+            dryrun=dryrun,
+            spot_choice=e.choice,
+            all_instances=all_instances,
+            launcher=launcher,
+            subnet_id=e.subnet_id,
+        )
+    return submitted
 
 
 def do_request_spot_instances(amount, region, moz_instance_type, ami,
                               instance_config, spot_choice,
-                              all_instances, dryrun):
-    started = 0
+                              all_instances, dryrun, launcher,
+                              subnet_id=None):
+    """Submits up to `amount` spot requests in the spot_choice availability
+    zone to `launcher`. Slave names and subnet IPs are allocated up front,
+    from the planned `subnet_id` if given. Returns the number of submitted
+    requests."""
+    availability_zone = spot_choice.availability_zone
+    subnet_ids = instance_config[region]["subnet_ids"]
+    planned_subnet_id = subnet_id
+    # (name, subnet_id) tuples
+    allocations = []
     for _ in range(amount):
-        try:
-            r = do_request_instance(
-                region=region,
-                moz_instance_type=moz_instance_type,
-                price=spot_choice.bid_price,
-                availability_zone=spot_choice.availability_zone,
-                ami=ami, instance_config=instance_config,
-                instance_type=spot_choice.instance_type,
-                is_spot=True, dryrun=dryrun, all_instances=all_instances)
-            if r:
-                started += 1
+        with timings.span("get_avail_subnet"):
+            if planned_subnet_id:
+                subnet_id = planned_subnet_id if allocate_subnet_ip(
+                    region, planned_subnet_id) else None
             else:
-                return started
-        except EC2ResponseError, e:
-            if e.code == "MaxSpotInstanceCountExceeded":
-                log.warn("MaxSpotInstanceCountExceeded in %s; giving up", region)
-                return started
-            log.warn("Cannot start", exc_info=True)
-        except Exception:
-            log.warn("Cannot start", exc_info=True)
-    return started
+                subnet_id = get_avail_subnet(region, subnet_ids,
+                                             availability_zone)
+        if not subnet_id:
+            log.debug("No free IP available for %s in %s", moz_instance_type,
+                      availability_zone)
+            break
+        name = get_available_slave_name(region, moz_instance_type,
+                                        is_spot=True,
+                                        all_instances=all_instances)
+        if not name:
+            log.debug("No slave name available for %s, %s",
+                      region, moz_instance_type)
+            break
+        allocations.append((name, subnet_id))
 
+    if dryrun:
+        for name, subnet_id in allocations:
+            log.debug("Spot request for %s in %s (%s)", name, subnet_id,
+                      spot_choice.bid_price)
+        log.info("Dry run. skipping")
+        launcher.record(moz_instance_type, len(allocations))
+        return len(allocations)
 
+    # User data differs per instance, everything else is shared by the batch
+    network_interfaces = {}
+    bdm = create_block_device_mapping(
+        ami, instance_config[region]['device_map'])
+    for name, subnet_id in allocations:
+        if subnet_id not in network_interfaces:
+            network_interfaces[subnet_id] = make_network_interfaces(
+                region, instance_config, subnet_id)
+        fqdn = "{}.{}".format(name, instance_config[region]["domain"])
+        log.debug("Spot request for %s (%s)", fqdn, spot_choice.bid_price)
+        user_data = make_user_data(region, moz_instance_type, instance_config,
+                                   name, fqdn)
+        launcher.submit(
+            moz_instance_type, launch_spot_instance, region,
+            moz_instance_type, spot_choice, ami, instance_config, user_data,
+            bdm, network_interfaces[subnet_id], name, fqdn, launcher)
+    return len(allocations)
+
+
+@timings.timed("launch_spot_instance")
+def launch_spot_instance(region, moz_instance_type, spot_choice, ami,
+                         instance_config, user_data, bdm, nc, name, fqdn,
+                         launcher):
+    """Requests and tags a spot instance. Returns the number of started
+    instances"""
+    if launcher.gave_up(("spot", region)):
+        return 0
+    try:
+        sir = do_request_spot_instance(
+            region, spot_choice.bid_price, ami.id, spot_choice.instance_type,
+            instance_config[region]["ssh_key"], user_data, bdm, nc,
+            instance_config[region].get("instance_profile_name"))
+    except EC2ResponseError, e:
+        if e.code == "MaxSpotInstanceCountExceeded":
+            log.warn("MaxSpotInstanceCountExceeded in %s; giving up", region)
+            launcher.give_up(("spot", region))
+            return 0
+        raise
+    if not tag_spot_requests(region, [(sir, name, fqdn)], moz_instance_type):
+        return 0
+    launcher.record_launched(moz_instance_type, sir.id)
+    report_started(region, moz_instance_type, spot_choice.instance_type,
+                   is_spot=True, ami=ami)
+    return 1
+
+
+def make_user_data(region, moz_instance_type, instance_config, name, fqdn):
+    return user_data_from_template(moz_instance_type, {
+        "moz_instance_type": moz_instance_type,
+        "hostname": name,
+        "domain": instance_config[region]["domain"],
+        "fqdn": fqdn,
+        "region_dns_atom": get_region_dns_atom(region),
+        "puppet_server": "",  # intentionally empty
+        "password": ""  # intentionally empty
+    })
+
+
+def make_network_interfaces(region, instance_config, subnet_id):
+    spec = NetworkInterfaceSpecification(
+        associate_public_ip_address=True, subnet_id=subnet_id,
+        delete_on_termination=True,
+        groups=instance_config[region].get("security_group_ids"))
+    return NetworkInterfaceCollection(spec)
+
+
+def report_started(region, moz_instance_type, instance_type, is_spot, ami,
+                   count=1):
+    template_values = dict(
+        region=region,
+        moz_instance_type=moz_instance_type,
+        instance_type=instance_type.replace(".", "-"),
+        life_cycle_type="spot" if is_spot else "ondemand",
+        virtualization=ami.virtualization_type,
+        root_device_type=ami.root_device_type,
+    )
+    name = "started.{region}.{moz_instance_type}.{instance_type}" \
+        ".{life_cycle_type}.{virtualization}.{root_device_type}"
+    with _report_lock:
+        gr_log.add(name.format(**template_values), count, collect=True)
+
+
+@timings.timed("do_request_instance")
 def do_request_instance(region, moz_instance_type, price, ami, instance_config,
-                        instance_type, availability_zone, is_spot,
-                        all_instances, dryrun):
+                        instance_type, availability_zone, all_instances,
+                        dryrun, launcher):
+    """Allocates a name and a subnet IP for an on-demand instance and
+    submits its launch to `launcher`. Returns False if the instance cannot
+    be launched"""
     name = get_available_slave_name(region, moz_instance_type,
-                                    is_spot=is_spot,
+                                    is_spot=False,
                                     all_instances=all_instances)
     if not name:
         log.debug("No slave name available for %s, %s",
                   region, moz_instance_type)
         return False
 
-    subnet_id = get_avail_subnet(region, instance_config[region]["subnet_ids"],
-                                 availability_zone)
+    with timings.span("get_avail_subnet"):
+        subnet_id = get_avail_subnet(
+            region, instance_config[region]["subnet_ids"], availability_zone)
     if not subnet_id:
         log.debug("No free IP available for %s in %s", moz_instance_type,
                   availability_zone)
         return False
 
     fqdn = "{}.{}".format(name, instance_config[region]["domain"])
-    if is_spot:
-        log.debug("Spot request for %s (%s)", fqdn, price)
-    else:
-        log.debug("Starting %s", fqdn)
+    log.debug("Starting %s", fqdn)
 
     if dryrun:
         log.info("Dry run. skipping")
+        launcher.record(moz_instance_type, 1)
         return True
 
-    spec = NetworkInterfaceSpecification(
-        associate_public_ip_address=True, subnet_id=subnet_id,
-        delete_on_termination=True,
-        groups=instance_config[region].get("security_group_ids"))
-    nc = NetworkInterfaceCollection(spec)
+    launcher.submit(moz_instance_type, launch_instance, region,
+                    moz_instance_type, price, ami, instance_config,
+                    instance_type, subnet_id, name, fqdn, launcher)
+    return True
 
-    user_data = user_data_from_template(moz_instance_type, {
-        "moz_instance_type": moz_instance_type,
-        "hostname": name,
-        "domain": instance_config[region]["domain"],
-        "fqdn": fqdn,
-        "region_dns_atom": get_region_dns_atom(region),
-        "puppet_server": "",  # intentionally empty
-        "password": ""  # intentionally empty
-    })
 
+@timings.timed("launch_instance")
+def launch_instance(region, moz_instance_type, price, ami, instance_config,
+                    instance_type, subnet_id, name, fqdn, launcher):
+    """Launches and tags an on-demand instance. Returns the number of
+    started instances"""
+    scope = ("ondemand", region, moz_instance_type)
+    if launcher.gave_up(scope):
+        return 0
+    nc = make_network_interfaces(region, instance_config, subnet_id)
+    user_data = make_user_data(region, moz_instance_type, instance_config,
+                               name, fqdn)
     bdm = create_block_device_mapping(
         ami, instance_config[region]['device_map'])
-    if is_spot:
-        rv = do_request_spot_instance(
-            region, price, ami.id, instance_type,
-            instance_config[region]["ssh_key"], user_data, bdm, nc,
-            instance_config[region].get("instance_profile_name"),
-            moz_instance_type, name, fqdn)
-    else:
+    try:
         rv = do_request_ondemand_instance(
             region, price, ami.id, instance_type,
             instance_config[region]["ssh_key"], user_data, bdm, nc,
             instance_config[region].get("instance_profile_name"),
             moz_instance_type, name, fqdn)
-    if rv:
-        template_values = dict(
-            region=region,
-            moz_instance_type=moz_instance_type,
-            instance_type=instance_type.replace(".", "-"),
-            life_cycle_type="spot" if is_spot else "ondemand",
-            virtualization=ami.virtualization_type,
-            root_device_type=ami.root_device_type,
-        )
-        name = "started.{region}.{moz_instance_type}.{instance_type}" \
-            ".{life_cycle_type}.{virtualization}.{root_device_type}"
-        gr_log.add(name.format(**template_values), 1, collect=True)
-    return rv
+    except EC2ResponseError, e:
+        # TODO: Handle e.code
+        log.warn("%s failure in %s: %s; giving up", scope[0], region, e.code)
+        log.warn("Cannot start", exc_info=True)
+        launcher.give_up(scope)
+        return 0
+    if not rv:
+        return 0
+    launcher.record_launched(moz_instance_type, rv.id)
+    report_started(region, moz_instance_type, instance_type, is_spot=False,
+                   ami=ami)
+    return 1
 
 
 def do_request_spot_instance(region, price, ami_id, instance_type, ssh_key,
-                             user_data, bdm, nc, profile, moz_instance_type,
-                             name, fqdn):
+                             user_data, bdm, nc, profile):
+    """Submits a single spot request and returns it. The request has to be
+    tagged using tag_spot_requests"""
     conn = get_aws_connection(region)
-    sir = conn.request_spot_instances(
+    sir = call_aws(
+        region, "RequestSpotInstances", conn.request_spot_instances,
         price=str(price),
         image_id=ami_id,
         count=1,
@@ -366,42 +538,15 @@ def do_request_spot_instance(region, price, ami_id, instance_type, ssh_key,
         network_interfaces=nc,
         instance_profile_name=profile,
     )
-    # Sleep for a little bit to prevent us hitting
-    # InvalidSpotInstanceRequestID.NotFound right away
-    time.sleep(0.5)
-    max_tries = 10
-    sleep_time = 5
-    for i in range(max_tries):
-        try:
-            sir[0].add_tag("moz-type", moz_instance_type)
-            # Name will be used to determine available slave names
-            sir[0].add_tag("Name", name)
-            sir[0].add_tag("FQDN", fqdn)
-            return True
-        except EC2ResponseError, e:
-            if e.code == "InvalidSpotInstanceRequestID.NotFound":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("waiting for spot request")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-        except BotoServerError, e:
-            if e.code == "RequestLimitExceeded":
-                if i < max_tries - 1:
-                    # Try again
-                    log.debug("request limit exceeded; sleeping and trying again")
-                    time.sleep(sleep_time)
-                    sleep_time = min(30, sleep_time * 1.5)
-                    continue
-            raise
+    return sir[0]
 
 
 def do_request_ondemand_instance(region, price, ami_id, instance_type, ssh_key,
                                  user_data, bdm, nc, profile,
                                  moz_instance_type, name, fqdn):
     conn = get_aws_connection(region)
-    res = conn.run_instances(
+    res = call_aws(
+        region, "RunInstances", conn.run_instances,
         image_id=ami_id,
         key_name=ssh_key,
         instance_type=instance_type,
@@ -417,22 +562,27 @@ def do_request_ondemand_instance(region, price, ami_id, instance_type, ssh_key,
 
 
 def aws_watch_pending(dburl, regions, builder_map, region_priorities,
-                      spot_config, ondemand_config, dryrun, latest_ami_percentage):
+                      spot_config, ondemand_config, dryrun, latest_ami_percentage,
+                      inventory=None):
     # First find pending jobs in the db
-    pending = find_pending(dburl)
+    with timings.span("find_pending"):
+        pending = find_pending(dburl, aggregate=True)
+    pending_count = sum(count for _, count in pending)
 
-    if not pending:
+    if not pending_count:
         gr_log.add("pending", 0)
         log.debug("no pending jobs! all done!")
         return
 
-    log.debug("processing %i pending jobs", len(pending))
-    gr_log.add("pending", len(pending))
+    log.debug("processing %i pending jobs", pending_count)
+    gr_log.add("pending", pending_count)
 
     # Mapping of instance types to # of instances we want to
     # creates
     # Map pending builder names to instance types
-    pending_builder_map = map_builders(pending, builder_map)
+    with timings.span("map_builders"):
+        pending_builder_map = map_builders(pending, builder_map,
+                                           aggregated=True)
     gr_log.add("aws_pending", sum(pending_builder_map.values()))
     if not pending_builder_map:
         log.debug("no pending jobs we can do anything about! all done!")
@@ -442,8 +592,10 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
     to_create_ondemand = defaultdict(int)
 
     # For each moz_instance_type find how many are currently
-    # running, and scale our count accordingly
-    all_instances = aws_get_all_instances(regions)
+    # running, and scale our count accordingly. The index answers the
+    # per-type questions below without scanning the whole fleet.
+    with timings.span("aws_get_all_instances"):
+        all_instances = FleetIndex(aws_get_all_instances(regions))
     cloudtools.graphite.generate_instance_stats(all_instances)
 
     # Reduce the requirements, pay attention to freshess and running instances
@@ -451,8 +603,15 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
     for moz_instance_type, count in to_create_spot.iteritems():
         running = aws_get_running_instances(all_instances, moz_instance_type)
         spot_running = filter_spot_instances(running)
-        to_create_spot[moz_instance_type] = reduce_by_freshness(
-            count, spot_running, moz_instance_type)
+        count = reduce_by_freshness(count, spot_running, moz_instance_type)
+        if inventory:
+            # Instances launched during the previous cycles may be not running
+            # yet. Spot and on-demand launches which run already don't count.
+            in_flight = inventory.in_flight(moz_instance_type, running)
+            log.debug("%i %s instances in flight", in_flight,
+                      moz_instance_type)
+            count = max(0, count - in_flight)
+        to_create_spot[moz_instance_type] = count
 
         if to_create_spot[moz_instance_type] == 0:
             log.debug("removing requirement for %s %s", "spot",
@@ -462,60 +621,133 @@ def aws_watch_pending(dburl, regions, builder_map, region_priorities,
     for moz_instance_type in to_delete:
         del to_create_spot[moz_instance_type]
 
-    for (moz_instance_type), count in to_create_spot.iteritems():
-        log.debug("need %i spot %s", count, moz_instance_type)
-        # Cap by our global limits if applicable
-        if spot_config and 'global' in spot_config.get('limits', {}):
-            global_limit = spot_config['limits']['global'].get(moz_instance_type)
-            # How many of this type of spot instance are running?
-            n = len(filter_spot_instances(aws_get_running_instances(all_instances, moz_instance_type)))
-            log.debug("%i %s spot instances running globally", n, moz_instance_type)
-            if global_limit and n + count > global_limit:
-                new_count = max(0, global_limit - n)
-                log.debug("decreasing requested number of %s from %i to %i (%i out of %i running)", moz_instance_type, count, new_count, n, global_limit)
-                count = new_count
-                if count <= 0:
-                    continue
-
-        started = request_spot_instances(
-            all_instances,
-            moz_instance_type=moz_instance_type, start_count=count,
-            regions=regions, region_priorities=region_priorities,
-            spot_config=spot_config, dryrun=dryrun,
-            latest_ami_percentage=latest_ami_percentage)
-        count -= started
-        log.debug("%s - started %i spot instances; need %i",
-                  moz_instance_type, started, count)
-
-        # Add leftover to ondemand
-        to_create_ondemand[moz_instance_type] += count
-
-    for moz_instance_type, count in to_create_ondemand.iteritems():
-        log.debug("need %i ondemand %s", count,
-                  moz_instance_type)
-        # Cap by our global limits if applicable
-        if ondemand_config and 'global' in ondemand_config.get('limits', {}):
-            global_limit = ondemand_config['limits']['global'].get(moz_instance_type)
-            # How many of this type of ondemand instance are running?
-            n = len(filter_ondemand_instances(aws_get_running_instances(all_instances, moz_instance_type)))
-            log.debug("%i %s ondemand instances running globally", n, moz_instance_type)
-            if global_limit and n + count > global_limit:
-                new_count = max(0, global_limit - n)
-                log.debug("decreasing requested number of %s from %i to %i (%i out of %i running)", moz_instance_type, count, new_count, n, global_limit)
-                count = new_count
-                if count <= 0:
-                    continue
-        if count < 1:
-            continue
+    # Launches are submitted to the launcher and run concurrently, the
+    # limits are applied when they are submitted
+    with Launcher() as launcher:
+        spot_needed = {}
+        for (moz_instance_type), count in to_create_spot.iteritems():
+            log.debug("need %i spot %s", count, moz_instance_type)
+            # Cap by our global limits if applicable
+            if spot_config and 'global' in spot_config.get('limits', {}):
+                global_limit = spot_config['limits']['global'].get(moz_instance_type)
+                # How many of this type of spot instance are running?
+                n = len(filter_spot_instances(aws_get_running_instances(all_instances, moz_instance_type)))
+                log.debug("%i %s spot instances running globally", n, moz_instance_type)
+                if global_limit and n + count > global_limit:
+                    new_count = max(0, global_limit - n)
+                    log.debug("decreasing requested number of %s from %i to %i (%i out of %i running)", moz_instance_type, count, new_count, n, global_limit)
+                    count = new_count
+                    if count <= 0:
+                        continue
+
+            spot_needed[moz_instance_type] = count
+
+        # All moz-types compete for the same subnets, plan them together
+        if spot_needed and spot_config:
+            plan = plan_spot_launches(
+                all_instances, spot_needed, regions=regions,
+                spot_config=spot_config,
+                latest_ami_percentage=latest_ami_percentage)
+            execute_spot_plan(plan, all_instances, dryrun=dryrun,
+                              launcher=launcher)
+        spot_started = launcher.wait()
+        spot_launched = launcher.pop_launched()
+        for moz_instance_type, count in spot_needed.iteritems():
+            started = spot_started[moz_instance_type]
+            if inventory:
+                inventory.record_launches(moz_instance_type,
+                                          spot_launched[moz_instance_type])
+            count -= started
+            log.debug("%s - started %i spot instances; need %i",
+                      moz_instance_type, started, count)
+
+            # Add leftover to ondemand
+            to_create_ondemand[moz_instance_type] += count
+
+        ondemand_needed = {}
+        for moz_instance_type, count in to_create_ondemand.iteritems():
+            log.debug("need %i ondemand %s", count,
+                      moz_instance_type)
+            # Cap by our global limits if applicable
+            if ondemand_config and 'global' in ondemand_config.get('limits', {}):
+                global_limit = ondemand_config['limits']['global'].get(moz_instance_type)
+                # How many of this type of ondemand instance are running?
+                n = len(filter_ondemand_instances(aws_get_running_instances(all_instances, moz_instance_type)))
+                log.debug("%i %s ondemand instances running globally", n, moz_instance_type)
+                if global_limit and n + count > global_limit:
+                    new_count = max(0, global_limit - n)
+                    log.debug("decreasing requested number of %s from %i to %i (%i out of %i running)", moz_instance_type, count, new_count, n, global_limit)
+                    count = new_count
+                    if count <= 0:
+                        continue
+            if count < 1:
+                continue
+
+            # Check for stopped instances in the given regions and start them if
+            # there are any
+            ondemand_needed[moz_instance_type] = count
+            aws_resume_instances(all_instances, moz_instance_type, count,
+                                 regions, region_priorities,
+                                 dryrun, launcher)
+
+        ondemand_started = launcher.wait()
+        ondemand_launched = launcher.pop_launched()
+        for moz_instance_type, count in ondemand_needed.iteritems():
+            started = ondemand_started[moz_instance_type]
+            if inventory:
+                inventory.record_launches(moz_instance_type,
+                                          ondemand_launched[moz_instance_type])
+            count -= started
+            log.debug("%s - started %i instances; need %i",
+                      moz_instance_type, started, count)
+
+
+def report_cycle_stats(timing_summary=False):
+    """Reports the AWS API calls, retries and throttling delays, and the
+    time spent in each phase since the last report"""
+    report_throttle_stats(gr_log)
+    timings.report(gr_log)
+    if timing_summary:
+        log.info("Phase timings:\n%s", timings.summary())
+    timings.reset()
+
+
+def aws_watch_pending_daemon(cycle_interval, refresh_intervals=None,
+                             timing_summary=False, **kwargs):
+    """Runs aws_watch_pending every cycle_interval seconds against a warm
+    fleet inventory"""
+    inventory = Inventory(kwargs["regions"],
+                          refresh_intervals=refresh_intervals)
+    while True:
+        cycle_start = time.time()
+        try:
+            inventory.refresh()
+            aws_watch_pending(inventory=inventory, **kwargs)
+        except Exception:
+            log.warn("Scheduling cycle failed", exc_info=True)
+        report_cycle_stats(timing_summary)
+        gr_log.sendall()
+        log.debug("cycle took %.2fs", time.time() - cycle_start)
+        time.sleep(max(0, cycle_interval - (time.time() - cycle_start)))
+
+
+def setup_reporting(config, secrets):
+    if all([config.get("graphite_host"), config.get("graphite_port"),
+            config.get("graphite_prefix")]):
+        gr_log.add_destination(
+            host=config["graphite_host"], port=config["graphite_port"],
+            prefix=config["graphite_prefix"])
 
-        # Check for stopped instances in the given regions and start them if
-        # there are any
-        started = aws_resume_instances(all_instances, moz_instance_type, count,
-                                       regions, region_priorities,
-                                       dryrun)
-        count -= started
-        log.debug("%s - started %i instances; need %i",
-                  moz_instance_type, started, count)
+    for entry in secrets.get("graphite_hosts", []):
+        host = entry.get("host")
+        port = entry.get("port")
+        prefix = entry.get("prefix")
+        prefix = "{}.releng.aws.aws_watch_pending".format(entry.get("prefix"))
+        if all([host, port, prefix]):
+            gr_log.add_destination(host, port, prefix)
+    if secrets.get("syslog_address"):
+        add_syslog_handler(log, address=secrets["syslog_address"],
+                           app="aws_watch_pending")
 
 
 def main():
@@ -537,6 +769,25 @@ def main():
                         help="percentage instances which will be launched with"
                         " the latest ami available, remaining requests will be"
                         " made using the previous (default: 100)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and rerun the scheduling logic "
+                        "against a cached fleet inventory")
+    parser.add_argument("--cycle-interval", type=int, default=10,
+                        help="seconds between scheduling cycles in daemon "
+                        "mode (default: 10)")
+    parser.add_argument("--spot-price-cache",
+                        help="file used to share spot prices between runs")
+    parser.add_argument("--spot-price-cache-ttl", type=int,
+                        default=DEFAULT_TTL,
+                        help="seconds cached spot prices are used without "
+                        "checking for newer ones (default: %(default)s)")
+    parser.add_argument("--timing-summary", action="store_true",
+                        help="log the time spent in each phase at the end "
+                        "of every cycle")
+    parser.add_argument("--slavealloc-cache-dir",
+                        help="directory used to cache slavealloc data "
+                        "(default: $SLAVEALLOC_CACHE_DIR or the current "
+                        "directory)")
 
     args = parser.parse_args()
 
@@ -557,10 +808,19 @@ def main():
         fhandler.setFormatter(formatter)
         logging.getLogger().addHandler(fhandler)
 
-    config = json.load(args.config)
+    if args.spot_price_cache:
+        set_spot_price_store(SpotPriceCache(args.spot_price_cache,
+                                            ttl=args.spot_price_cache_ttl))
+
+    if args.slavealloc_cache_dir:
+        slavealloc.set_cache_dir(args.slavealloc_cache_dir)
+
+    # Keep the buildermap order, the first matching expression wins
+    config = json.load(args.config, object_pairs_hook=OrderedDict)
     secrets = json.load(args.secrets)
+    set_rate_limits(config.get("api_rate_limits"))
 
-    aws_watch_pending(
+    watch_pending_kwargs = dict(
         dburl=secrets['db'],
         regions=args.regions,
         builder_map=config['buildermap'],
@@ -571,23 +831,18 @@ def main():
         latest_ami_percentage=args.latest_ami_percentage,
     )
 
-    if all([config.get("graphite_host"), config.get("graphite_port"),
-            config.get("graphite_prefix")]):
-        gr_log.add_destination(
-            host=config["graphite_host"], port=config["graphite_port"],
-            prefix=config["graphite_prefix"])
-
-    for entry in secrets.get("graphite_hosts", []):
-        host = entry.get("host")
-        port = entry.get("port")
-        prefix = entry.get("prefix")
-        prefix = "{}.releng.aws.aws_watch_pending".format(entry.get("prefix"))
-        if all([host, port, prefix]):
-            gr_log.add_destination(host, port, prefix)
-    if secrets.get("syslog_address"):
-        add_syslog_handler(log, address=secrets["syslog_address"],
-                           app="aws_watch_pending")
+    if args.daemon:
+        setup_reporting(config, secrets)
+        aws_watch_pending_daemon(
+            cycle_interval=args.cycle_interval,
+            refresh_intervals=config.get("inventory_refresh_intervals"),
+            timing_summary=args.timing_summary,
+            **watch_pending_kwargs)
+        return
 
+    aws_watch_pending(**watch_pending_kwargs)
+    setup_reporting(config, secrets)
+    report_cycle_stats(args.timing_summary)
     gr_log.sendall()
     log.debug("done")
 
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Records the inputs of an aws_watch_pending scheduling cycle and replays them
+offline against a fake EC2.
+
+Usage:
+    aws_watch_pending_sim record -r us-east-1 -k secrets.json \
+        -c configs/watch_pending.cfg -o cycle.json
+    aws_watch_pending_sim replay [-c configs/watch_pending.cfg] cycle.json
+
+A replay reports the launches aws_watch_pending decided on, the number of
+EC2 API calls and the wall time spent in each phase of the cycle. Phases
+nest, e.g. get_spot_choices is part of plan_spot_launches.
+"""
+import argparse
+import logging
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+import cloudtools.aws
+import cloudtools.aws.ami
+import cloudtools.aws.ratelimit
+import cloudtools.aws.spot
+import cloudtools.aws.vpc
+import cloudtools.slavealloc
+from cloudtools.aws import get_aws_connection, get_vpc, aws_get_all_instances
+from cloudtools.aws.fake_ec2 import FakeEC2, dump_region
+from cloudtools.aws.spot import get_active_spot_requests
+from cloudtools.buildbot import find_pending
+from cloudtools.graphite import Timings
+from cloudtools.scripts import aws_watch_pending
+
+log = logging.getLogger(__name__)
+
+RECORDING_VERSION = 1
+# aws_watch_pending functions timed during replays
+PHASES = [
+    "find_pending", "map_builders", "aws_get_all_instances",
+    "plan_spot_launches", "get_spot_choices", "usable_spot_choice",
+    "get_subnet_capacity", "get_spot_amis", "execute_spot_plan",
+    "get_avail_subnet", "get_available_slave_name",
+    "do_request_spot_instances", "launch_spot_instance",
+    "aws_resume_instances", "launch_instance",
+]
+
+
+def get_product_instance_types(spot_config):
+    """Returns (product description, instance type) pairs used by the spot
+    rules"""
+    rv = set()
+    for moz_instance_type, rules in spot_config.get("rules", {}).iteritems():
+        product_description = aws_watch_pending.get_product_description(
+            moz_instance_type)
+        for rule in rules:
+            rv.add((product_description, rule["instance_type"]))
+    return sorted(rv)
+
+
+def record_cycle(dburl, regions, config):
+    """Returns a JSON serializable recording of the inputs of a scheduling
+    cycle"""
+    recorded_at = time.time()
+    product_instance_types = get_product_instance_types(
+        config.get("spot") or {})
+    start_time = (datetime.utcnow() - timedelta(hours=24)).isoformat() + "Z"
+    instances = aws_get_all_instances(regions)
+    ec2 = {}
+    for region in regions:
+        log.info("Recording %s", region)
+        ec2[region] = dump_region(
+            get_aws_connection(region), get_vpc(region),
+            [i for i in instances if i.region.name == region],
+            get_active_spot_requests(region), product_instance_types,
+            start_time)
+    slaves = cloudtools.slavealloc.get_slaves_json(
+        cloudtools.slavealloc.SLAVES_JSON_URL,
+        cloudtools.slavealloc.get_cache_file())
+    return {
+        "version": RECORDING_VERSION,
+        "recorded_at": recorded_at,
+        "regions": regions,
+        "config": config,
+        "pending": [list(row) for row in find_pending(dburl, aggregate=True)],
+        "slaves": slaves,
+        "ec2": ec2,
+    }
+
+
+def reset_caches():
+    cloudtools.aws.invalidate_connections_cache()
+    cloudtools.aws.invalidate_instances_cache()
+    cloudtools.aws.spot.invalidate_spot_requests_cache()
+    cloudtools.aws.spot.invalidate_slave_names_cache()
+    cloudtools.aws.spot.invalidate_spot_prices_cache()
+    cloudtools.aws.ami.invalidate_spot_amis_cache()
+    cloudtools.aws.vpc.invalidate_subnets_cache()
+    cloudtools.slavealloc.invalidate_classified_slaves_cache()
+    cloudtools.aws.ratelimit.reset_token_buckets()
+    aws_watch_pending.timings.reset()
+
+
+@contextmanager
+def patched(patches):
+    """Sets (object, attribute, value) patches, restoring them on exit"""
+    saved = [(obj, attr, getattr(obj, attr)) for obj, attr, _ in patches]
+    try:
+        for obj, attr, value in patches:
+            setattr(obj, attr, value)
+        yield
+    finally:
+        for obj, attr, value in reversed(saved):
+            setattr(obj, attr, value)
+
+
+@contextmanager
+def replay_environment(ec2, recording, timer):
+    """Points aws_watch_pending at the fake EC2 and the recorded pending
+    jobs and slavealloc data. Yields a dict which receives the emitted
+    graphite metrics and the skipped sleep time on exit."""
+    pending = [tuple(row) for row in recording["pending"]]
+    slaves_index = cloudtools.slavealloc.build_slaves_index(
+        recording["slaves"])
+    slept = []
+    captured = {}
+
+    def fake_find_pending(dburl, aggregate=False):
+        assert aggregate, "recordings contain aggregated pending jobs"
+        return pending
+
+    patches = [
+        (cloudtools.aws, "connect_to_region", ec2.connect_to_region),
+        (cloudtools.aws, "VPCConnection", ec2.vpc_connection),
+        (cloudtools.slavealloc, "get_slaves_json",
+         lambda url, cache: recording["slaves"]),
+        (cloudtools.slavealloc, "get_slaves_index",
+         lambda url, cache: slaves_index),
+        (cloudtools.aws.spot, "_spot_price_store", None),
+        (time, "sleep", slept.append),
+        (aws_watch_pending, "find_pending",
+         timer.timed("find_pending")(fake_find_pending)),
+    ]
+    for name in PHASES:
+        if name != "find_pending":
+            patches.append((aws_watch_pending, name,
+                            timer.timed(name)(getattr(aws_watch_pending,
+                                                      name))))
+
+    gr_log = aws_watch_pending.gr_log
+    saved_metrics = gr_log._data
+    gr_log._data = {}
+    reset_caches()
+    try:
+        with patched(patches):
+            yield captured
+    finally:
+        aws_watch_pending.timings.report(gr_log)
+        captured["metrics"] = dict((name, value) for name, (value, _) in
+                                   gr_log._data.iteritems())
+        captured["slept"] = sum(slept)
+        gr_log._data = saved_metrics
+        reset_caches()
+
+
+def replay_cycle(recording, config=None, latest_ami_percentage=100,
+                 dryrun=False):
+    """Runs aws_watch_pending against a recording. Returns a dict with the
+    sorted decisions, API call counts, phase timings, emitted metrics and the
+    total wall time"""
+    if recording.get("version") != RECORDING_VERSION:
+        raise ValueError("Unsupported recording version %s" %
+                         recording.get("version"))
+    config = config or recording["config"]
+    ec2 = FakeEC2(recording["ec2"], recorded_at=recording["recorded_at"])
+    timer = Timings()
+    with replay_environment(ec2, recording, timer) as captured:
+        start = time.time()
+        aws_watch_pending.aws_watch_pending(
+            dburl=None,
+            regions=recording["regions"],
+            builder_map=config["buildermap"],
+            region_priorities=config["region_priorities"],
+            spot_config=config.get("spot"),
+            ondemand_config=config.get("ondemand"),
+            dryrun=dryrun,
+            latest_ami_percentage=latest_ami_percentage)
+        total = time.time() - start
+    # Launches run concurrently, sort them to make replays comparable
+    decisions = sorted(ec2.decisions(), key=lambda d: (
+        d["lifecycle"] != "spot", d["region"], d["moz_instance_type"],
+        d["name"]))
+    return {
+        "decisions": decisions,
+        "api_calls": dict(("%s.%s" % key, count)
+                          for key, count in ec2.calls.iteritems()),
+        "phases": dict((name, {"calls": timer.counts[name],
+                               "seconds": timer.seconds[name]})
+                       for name in timer.counts),
+        "metrics": captured["metrics"],
+        "simulated_sleep": captured["slept"],
+        "total": total,
+    }
+
+
+def print_report(result):
+    summary = Counter(
+        (d["moz_instance_type"], d["lifecycle"], d["region"],
+         d["instance_type"], d["availability_zone"])
+        for d in result["decisions"])
+    print "Launches: %i" % len(result["decisions"])
+    for key, count in sorted(summary.iteritems()):
+        print "  %-16s %-8s %-10s %-11s %-11s %5i" % (key + (count,))
+    print "EC2 API calls: %i" % sum(result["api_calls"].values())
+    for name, count in sorted(result["api_calls"].iteritems()):
+        print "  %-50s %5i" % (name, count)
+    print "Phases:"
+    for name, phase in sorted(result["phases"].iteritems(),
+                              key=lambda x: x[1]["seconds"], reverse=True):
+        print "  %-26s %6i calls %9.4fs" % (
+            name, phase["calls"], phase["seconds"])
+    print "Total: %.4fs (%.1fs of sleeps skipped)" % (
+        result["total"], result["simulated_sleep"])
+
+
+def record(args):
+    config = json.load(args.config, object_pairs_hook=OrderedDict)
+    secrets = json.load(args.secrets)
+    recording = record_cycle(secrets["db"], args.regions, config)
+    with open(args.output, "w") as f:
+        json.dump(recording, f)
+    log.info("Recorded %i pending builders to %s", len(recording["pending"]),
+             args.output)
+
+
+def replay(args):
+    with open(args.recording) as f:
+        recording = json.load(f, object_pairs_hook=OrderedDict)
+    config = None
+    if args.config:
+        config = json.load(args.config, object_pairs_hook=OrderedDict)
+    results = []
+    for _ in range(args.repeat):
+        results.append(replay_cycle(
+            recording, config=config,
+            latest_ami_percentage=args.latest_ami_percentage,
+            dryrun=args.dryrun))
+    # Report the fastest run, decisions are the same for every run
+    result = min(results, key=lambda r: r["total"])
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_const",
+                        dest="loglevel", const=logging.DEBUG,
+                        default=logging.WARN)
+    subparsers = parser.add_subparsers()
+
+    record_parser = subparsers.add_parser(
+        "record", help="record the inputs of a scheduling cycle")
+    record_parser.add_argument("-r", "--region", action="append",
+                               dest="regions", required=True)
+    record_parser.add_argument("-k", "--secrets", type=argparse.FileType('r'),
+                               required=True)
+    record_parser.add_argument("-c", "--config", type=argparse.FileType('r'),
+                               required=True)
+    record_parser.add_argument("-o", "--output", required=True)
+    record_parser.set_defaults(func=record)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="replay a recorded scheduling cycle")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("-c", "--config", type=argparse.FileType('r'),
+                               help="use this config instead of the "
+                               "recorded one")
+    replay_parser.add_argument("-n", "--dryrun", action="store_true")
+    replay_parser.add_argument("--latest-ami-percentage", type=int,
+                               default=100)
+    replay_parser.add_argument("--repeat", type=int, default=1,
+                               help="replay several times and report the "
+                               "fastest run")
+    replay_parser.add_argument("--json", help="write the full result here")
+    replay_parser.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel,
+                        format="%(asctime)s - %(message)s")
+    logging.getLogger("boto").setLevel(logging.INFO)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Reports the activity of the local buildslave to aws_heartbeat_collector.
+Meant to be started from the boot or user-data scripts of the instances.
+
+Usage: buildslave_heartbeat -c http://collector:8011 -k secrets.json [-e EVENT]
+
+Without -e, follows twistd.log and posts a heartbeat whenever the slave
+starts or finishes a job or shuts down, and at least every minute.
+"""
+import argparse
+import json
+import logging
+import socket
+import time
+
+from cloudtools.buildbot import parse_master_host
+from cloudtools.heartbeat import send_heartbeat, follow_log, EVENTS, \
+    EVENT_BOOT, HEARTBEAT_INTERVAL
+from cloudtools.twistd_log import LogActivity, TWISTD_LOG
+
+log = logging.getLogger(__name__)
+
+BUILDBOT_TAC = "/builds/slave/buildbot.tac"
+
+
+def get_boot_time():
+    with open("/proc/uptime") as f:
+        return time.time() - float(f.read().split()[0])
+
+
+def get_master_host(tacfile=BUILDBOT_TAC):
+    try:
+        with open(tacfile) as f:
+            return parse_master_host(f.read())
+    except IOError:
+        return None
+
+
+def heartbeat_state(activity, boot_time):
+    """Returns the (event, event_time) to report. Events logged before the
+    instance booted, like the shutdown before a reboot, are stale."""
+    if activity.event is None or activity.event_time < boot_time:
+        return EVENT_BOOT, boot_time
+    return activity.event, activity.event_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_const",
+                        dest="loglevel", const=logging.DEBUG,
+                        default=logging.INFO)
+    parser.add_argument("-c", "--collector", required=True,
+                        help="collector URL")
+    parser.add_argument("-k", "--secrets", type=argparse.FileType('r'),
+                        required=True,
+                        help="file with the heartbeat_token")
+    parser.add_argument("-n", "--name", default=socket.gethostname().split(".")[0],
+                        help="slave name (default: the short host name)")
+    parser.add_argument("-e", "--event", choices=EVENTS,
+                        help="send a single heartbeat for this event")
+    parser.add_argument("--log", default=TWISTD_LOG)
+    parser.add_argument("--interval", type=int, default=HEARTBEAT_INTERVAL)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    token = json.load(args.secrets).get("heartbeat_token")
+
+    if args.event:
+        send_heartbeat(args.collector, args.name, args.event,
+                       master_host=get_master_host(), token=token)
+        return
+
+    boot_time = get_boot_time()
+
+    def on_change(activity):
+        event, event_time = heartbeat_state(activity, boot_time)
+        log.debug("%s at %s", event, event_time)
+        send_heartbeat(args.collector, args.name, event, event_time,
+                       master_host=get_master_host(), token=token)
+
+    follow_log(args.log, LogActivity(), on_change, interval=args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import time
 
 from cloudtools.aws import get_aws_connection, DEFAULT_REGIONS, \
     parse_aws_time, aws_get_all_instances, retry_aws_request
+from cloudtools.aws.ratelimit import report_throttle_stats
 from cloudtools.aws.spot import CANCEL_STATUS_CODES, IGNORABLE_STATUS_CODES
 
 log = logging.getLogger(__name__)
@@ -25,7 +26,7 @@ def sanity_check(regions):
         if req.state in ["open", "failed"]:
             if req.status.code in CANCEL_STATUS_CODES:
                 log.info("Cancelling request %s", req)
-                retry_aws_request(req.add_tag, "moz-cancel-reason", req.status.code)
+                retry_aws_request("CreateTags", req.add_tag, "moz-cancel-reason", req.status.code)
                 req.cancel()
             elif req.status.code not in IGNORABLE_STATUS_CODES:
                 log.error("Uknown status for request %s: %s", req,
@@ -36,7 +37,7 @@ def sanity_check(regions):
                 req.instance_id not in instance_ids:
             log.info("Cancelling request %s: %s is not running", req,
                      req.instance_id)
-            retry_aws_request(req.add_tag, "moz-cancel-reason", "no-running-instances")
+            retry_aws_request("CreateTags", req.add_tag, "moz-cancel-reason", "no-running-instances")
             req.cancel()
 
 
@@ -57,6 +58,7 @@ def main():
 
     regions = args.regions or DEFAULT_REGIONS
     sanity_check(regions)
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
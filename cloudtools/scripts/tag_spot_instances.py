@@ -4,6 +4,7 @@ import argparse
 import logging
 
 from cloudtools.aws import DEFAULT_REGIONS
+from cloudtools.aws.ratelimit import report_throttle_stats
 from cloudtools.aws.spot import get_instances_to_tag, \
     populate_spot_requests_cache, copy_spot_request_tags
 
@@ -39,6 +40,7 @@ def main():
             for i in instances_to_tag:
                 log.debug("tagging %s", i)
                 copy_spot_request_tags(i)
+    report_throttle_stats()
 
 
 if __name__ == '__main__':
@@ -1,33 +1,150 @@
 import os
 import time
+import hashlib
 import logging
 import json
 import requests
-import tempfile
-import shutil
 from collections import defaultdict
-from repoze.lru import lru_cache
+from repoze.lru import lru_cache, LRUCache
+
+from cloudtools.fileutils import atomic_write, load_versioned_json, \
+    save_versioned_json
 
 SLAVES_JSON_URL = "http://slavealloc.pvt.build.mozilla.org/api/slaves"
 CACHE_FILE = "slaves.json"
 CACHE_TTL = 10 * 60
+# Directory used for slaves.json and the files derived from it
+DEFAULT_CACHE_DIR = os.environ.get("SLAVEALLOC_CACHE_DIR", ".")
+
+# Slave classification rules: (moz_type, name prefix, required attributes).
+# The first matching rule wins.
+SLAVE_MOZ_TYPE_RULES = [
+    ("av-linux64", "av-linux64-",
+     {"bitlength": "64", "environment": "prod", "distro": "centos6-mock",
+      "purpose": "build", "trustlevel": "core"}),
+    ("bld-linux64", None,
+     {"bitlength": "64", "environment": "prod", "distro": "centos6-mock",
+      "purpose": "build", "trustlevel": "core"}),
+    ("try-linux64", None,
+     {"bitlength": "64", "environment": "prod", "distro": "centos6-mock",
+      "purpose": "build", "trustlevel": "try"}),
+    ("tst-linux32", None,
+     {"bitlength": "32", "environment": "prod", "distro": "ubuntu32",
+      "purpose": "tests", "trustlevel": "try"}),
+    ("tst-linux64", None,
+     {"bitlength": "64", "environment": "prod", "distro": "ubuntu64",
+      "purpose": "tests", "speed": "m1.medium", "trustlevel": "try"}),
+    ("tst-emulator64", None,
+     {"bitlength": "64", "environment": "prod", "distro": "ubuntu64",
+      "purpose": "tests", "speed": "c3.xlarge", "trustlevel": "try"}),
+    ("b-2008", None,
+     {"bitlength": "64", "environment": "prod", "distro": "win2k8",
+      "purpose": "build", "trustlevel": "core"}),
+    # y-2008 (try-2008)
+    ("y-2008", None,
+     {"bitlength": "64", "environment": "prod", "distro": "win2k8",
+      "purpose": "build", "trustlevel": "try"}),
+    ("t-w732", None,
+     {"bitlength": "32", "environment": "prod", "distro": "win7",
+      "purpose": "tests", "speed": "c3.2xlarge", "trustlevel": "try"}),
+    ("g-w732", None,
+     {"bitlength": "32", "environment": "prod", "distro": "win7",
+      "purpose": "tests", "speed": "g2.2xlarge", "trustlevel": "try"}),
+]
+# Slave attributes used by the rules
+RULE_ATTRS = sorted(set(attr for _, _, attrs in SLAVE_MOZ_TYPE_RULES
+                        for attr in attrs))
+# Bump when the index format changes, rule changes are detected by
+# rules_hash()
+INDEX_VERSION = 2
+META_VERSION = 1
 
 log = logging.getLogger(__name__)
+_classified_slaves_cache = LRUCache(10)
+# attribute values -> rules matching them
+_candidate_rules = {}
+_cache_dir = DEFAULT_CACHE_DIR
+
+
+def set_cache_dir(cache_dir):
+    """Sets the directory slaves.json and its index are kept in"""
+    global _cache_dir
+    _cache_dir = cache_dir
+
+
+def get_cache_file():
+    return os.path.join(_cache_dir, CACHE_FILE)
 
 
-@lru_cache(10)
+@lru_cache(10, cache=_classified_slaves_cache)
 def get_classified_slaves(is_spot=True):
-    js = get_slaves_json(SLAVES_JSON_URL, CACHE_FILE)
-    slaves = [s for s in js if is_spot_slave(s) is is_spot and is_enabled(s)]
+    index = get_slaves_index(SLAVES_JSON_URL, get_cache_file())
     # 2D dict: x[moz_type][region] = ["slave1", "slave2"]
     classified_slaves = defaultdict(lambda: defaultdict(set))
+    kind = "spot" if is_spot else "ondemand"
+    for moz_type, regions in index[kind].iteritems():
+        for region, names in regions.iteritems():
+            classified_slaves[moz_type][region] = set(names)
+    return classified_slaves
+
+
+def rules_hash():
+    """Returns a digest of SLAVE_MOZ_TYPE_RULES, stored with the index to
+    rebuild it when the rules change"""
+    return hashlib.sha1(
+        json.dumps(SLAVE_MOZ_TYPE_RULES, sort_keys=True)).hexdigest()
+
+
+def build_slaves_index(slaves):
+    """Classifies enabled slaves. Returns a dict with "spot" and "ondemand"
+    mappings of moz_type -> region -> sorted slave names"""
+    classified = {"spot": defaultdict(lambda: defaultdict(set)),
+                  "ondemand": defaultdict(lambda: defaultdict(set))}
     for s in slaves:
+        if not is_enabled(s):
+            continue
         moz_type = slave_moz_type(s)
         region = slave_region(s)
         name = s.get("name")
         if all([moz_type, region, name]):
-            classified_slaves[moz_type][region].add(name)
-    return classified_slaves
+            kind = "spot" if is_spot_slave(s) else "ondemand"
+            classified[kind][moz_type][region].add(name)
+    index = {}
+    for kind, moz_types in classified.iteritems():
+        index[kind] = dict(
+            (moz_type, dict((region, sorted(names))
+                            for region, names in regions.iteritems()))
+            for moz_type, regions in moz_types.iteritems())
+    return index
+
+
+def get_slaves_index(url, cache):
+    """Returns the slaves index, rebuilding it only if the cached slaves.json
+    changed since the index was written"""
+    refresh_slaves_json(url, cache)
+    index_file = cache + ".index"
+    try:
+        st = os.stat(cache)
+        source = [rules_hash(), st.st_size, st.st_mtime]
+    except OSError:
+        source = None
+    if source:
+        index = load_versioned_json(index_file, INDEX_VERSION, "index")
+        if index and index.get("source") == source:
+            log.debug("Using cached slaves index")
+            return index
+    index = build_slaves_index(read_slaves_json(cache))
+    if source:
+        index["source"] = source
+        try:
+            save_versioned_json(index_file, INDEX_VERSION, "index", index)
+        except (OSError, IOError):
+            log.warn("Cannot write %s", index_file, exc_info=True)
+    return index
+
+
+def invalidate_classified_slaves_cache():
+    _classified_slaves_cache.clear()
 
 
 def slave_region(slave):
@@ -43,127 +160,60 @@ def is_enabled(slave):
 
 
 def slave_moz_type(slave):
+    name = slave.get("name") or ""
     # Separate golden slaves
-    if slave.get("name") and "golden" in slave.get("name"):
+    if "golden" in name:
         return "golden"
 
-    # av-linux64
-    if slave.get("name", "").startswith("av-linux64-") and \
-       slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "av-linux64"
-
-    # bld-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "bld-linux64"
-
-    # try-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "centos6-mock" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "try":
-        return "try-linux64"
-
-    # tst-linux32
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu32" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("trustlevel") == "try":
-        return "tst-linux32"
-
-    # tst-linux64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu64" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "m1.medium" and \
-       slave.get("trustlevel") == "try":
-        return "tst-linux64"
-
-    # tst-emulator64
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "ubuntu64" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "c3.xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "tst-emulator64"
-
-    # b-2008
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win2k8" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "core":
-        return "b-2008"
-
-    # y-2008 (try-2008)
-    if slave.get("bitlength") == "64" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win2k8" and \
-       slave.get("purpose") == "build" and \
-       slave.get("trustlevel") == "try":
-        return "y-2008"
-
-    # t-w732
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win7" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "c3.2xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "t-w732"
-
-    # g-w732
-    if slave.get("bitlength") == "32" and \
-       slave.get("environment") == "prod" and \
-       slave.get("distro") == "win7" and \
-       slave.get("purpose") == "tests" and \
-       slave.get("speed") == "g2.2xlarge" and \
-       slave.get("trustlevel") == "try":
-        return "g-w732"
-
+    key = tuple(slave.get(attr) for attr in RULE_ATTRS)
+    if key not in _candidate_rules:
+        _candidate_rules[key] = [
+            (moz_type, prefix) for moz_type, prefix, attrs
+            in SLAVE_MOZ_TYPE_RULES
+            if all(slave.get(attr) == value
+                   for attr, value in attrs.iteritems())]
+    for moz_type, prefix in _candidate_rules[key]:
+        if not prefix or name.startswith(prefix):
+            return moz_type
     return None
 
 
 def get_slaves_json(url, cache):
-    try:
-        mtime = os.stat(cache).st_mtime
-        now = time.time()
-        if now - mtime < CACHE_TTL:
-            log.debug("Using cached slaves.json")
-            return read_slaves_json(cache)
-        else:
-            log.debug("File expired, fetching a new one")
-    except (OSError, IOError, KeyError):
-        log.warn("Error reading cache file, trying to fetch", exc_info=True)
+    refresh_slaves_json(url, cache)
+    return read_slaves_json(cache)
+
 
+def refresh_slaves_json(url, cache):
+    """Downloads slaves.json if the cached copy is older than CACHE_TTL.
+    The download is conditional, the file is only replaced if it changed."""
+    meta_file = cache + ".meta"
+    meta = load_versioned_json(meta_file, META_VERSION, "meta") or {}
+    if os.path.exists(cache) and \
+            time.time() - meta.get("checked_at", 0) < CACHE_TTL:
+        log.debug("Using cached slaves.json")
+        return
+    headers = {}
+    if os.path.exists(cache):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
     try:
-        download_file(url, cache)
-    except:  # noqa: E722
+        req = requests.get(url, headers=headers, timeout=30)
+        if req.status_code == 304:
+            log.debug("slaves.json not modified")
+        else:
+            req.raise_for_status()
+            log.debug("writing %s", cache)
+            atomic_write(cache, req.content)
+            meta = {"etag": req.headers.get("etag"),
+                    "last_modified": req.headers.get("last-modified")}
+        meta["checked_at"] = time.time()
+        save_versioned_json(meta_file, META_VERSION, "meta", meta)
+    except Exception:
         log.warn("Cannot fetch slaves.json, reusing the existing file",
                  exc_info=True)
-    return read_slaves_json(cache)
 
 
 def read_slaves_json(filename):
     return json.load(open(filename))
-
-
-def download_file(url, dest):
-    req = requests.get(url, timeout=30)
-    req.raise_for_status()
-    _, tmp_fname = tempfile.mkstemp()
-    with open(tmp_fname, "wb") as f:
-        f.write(req.content)
-    log.debug("moving %s to %s", tmp_fname, dest)
-    shutil.move(tmp_fname, dest)
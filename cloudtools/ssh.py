@@ -8,7 +8,8 @@ gr_log = get_graphite_logger()
 
 class SSHClient(paramiko.SSHClient):
 
-    def __init__(self, instance, username, key_filename, timeout=10):
+    def __init__(self, instance, username, key_filename, timeout=10,
+                 command_timeout=60):
         super(SSHClient, self).__init__()
         self.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
         self.instance = instance
@@ -17,6 +18,8 @@ class SSHClient(paramiko.SSHClient):
         self.ip = instance.private_ip_address
         self.name = instance.tags.get("Name")
         self.timeout = timeout
+        # Seconds a remote command may go without sending output
+        self.command_timeout = command_timeout
 
     def connect(self, *args, **kwargs):
         try:
@@ -31,7 +34,8 @@ class SSHClient(paramiko.SSHClient):
             return None
 
     def get_stdout(self, command):
-        stdin, stdout, _ = self.exec_command(command)
+        stdin, stdout, _ = self.exec_command(command,
+                                             timeout=self.command_timeout)
         stdin.close()
         data = stdout.read()
         return data
@@ -5,7 +5,9 @@ from cloudtools.aws import aws_get_fresh_instances, FRESH_INSTANCE_DELAY, \
     filter_instances_launched_since, \
     reduce_by_freshness, distribute_in_region, aws_get_running_instances, \
     aws_filter_instances, filter_spot_instances, \
-    filter_ondemand_instances, get_buildslave_instances
+    filter_ondemand_instances, get_buildslave_instances, \
+    aws_get_all_instances, invalidate_instances_cache, LIVE_INSTANCE_STATES, \
+    terminate_instances
 
 
 @pytest.fixture
@@ -161,3 +163,67 @@ def test_get_buildslave_instances(conn, example_instances):
     conn.return_value.get_only_instances.assert_called_once_with(
         filters={'tag:moz-state': 'ready',
                  'instance-state-name': 'running'})
+
+
+@mock.patch("cloudtools.aws.get_aws_connection")
+def test_aws_get_all_instances(conn):
+    invalidate_instances_cache()
+    conn.side_effect = lambda region: conns[region]
+    conns = {"r1": mock.Mock(), "r2": mock.Mock()}
+    conns["r1"].get_only_instances.return_value = ["i1", "i2"]
+    conns["r2"].get_only_instances.return_value = ["i3"]
+    assert aws_get_all_instances(["r1", "r2"]) == ["i1", "i2", "i3"]
+    for c in conns.values():
+        c.get_only_instances.assert_called_once_with(
+            filters={"instance-state-name": LIVE_INSTANCE_STATES})
+    # cached
+    assert aws_get_all_instances(["r2", "r1"]) == ["i3", "i1", "i2"]
+    assert conns["r1"].get_only_instances.call_count == 1
+    invalidate_instances_cache(["r1"])
+    assert aws_get_all_instances(["r1"]) == ["i1", "i2"]
+    assert conns["r1"].get_only_instances.call_count == 2
+    assert conns["r2"].get_only_instances.call_count == 1
+    invalidate_instances_cache()
+
+
+@mock.patch("cloudtools.aws.get_aws_connection")
+def test_terminate_instances(m_get_conn):
+    instances = []
+    for n in range(5):
+        i = mock.Mock()
+        i.id = "i-%i" % n
+        i.region.name = "us-east-1" if n < 3 else "us-west-2"
+        instances.append(i)
+    conns = {"us-east-1": mock.Mock(), "us-west-2": mock.Mock()}
+    m_get_conn.side_effect = conns.get
+    conns["us-west-2"].terminate_instances.side_effect = Exception("denied")
+    failed = terminate_instances(instances, batch_size=2)
+    assert conns["us-east-1"].terminate_instances.call_args_list == [
+        mock.call(instance_ids=["i-0", "i-1"]),
+        mock.call(instance_ids=["i-2"])]
+    assert failed == instances[3:]
+    for i in instances:
+        assert not i.terminate.called
+
+
+@mock.patch("cloudtools.aws.get_aws_connection")
+def test_terminate_instances_retries_failed_batch(m_get_conn):
+    instances = []
+    for n in range(3):
+        i = mock.Mock()
+        i.id = "i-%i" % n
+        i.region.name = "us-east-1"
+        instances.append(i)
+
+    def terminate(instance_ids):
+        if "i-1" in instance_ids:
+            raise Exception("denied")
+
+    m_get_conn.return_value.terminate_instances.side_effect = terminate
+    failed = terminate_instances(instances)
+    assert m_get_conn.return_value.terminate_instances.call_args_list == [
+        mock.call(instance_ids=["i-0", "i-1", "i-2"]),
+        mock.call(instance_ids=["i-0"]),
+        mock.call(instance_ids=["i-1"]),
+        mock.call(instance_ids=["i-2"])]
+    assert failed == [instances[1]]
@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from cloudtools.aws import parse_aws_time
+from cloudtools.aws.fake_ec2 import FakeEC2, FakeObject, format_aws_time
+
+
+def make_region(now):
+    return {
+        "zones": ["az1", "az2"],
+        "subnets": [{"id": "subnet-1", "vpc_id": "vpc-1", "state": "available",
+                     "cidr_block": "10.0.0.0/24", "availability_zone": "az1",
+                     "available_ip_address_count": 10}],
+        "images": [{"id": "ami-1", "name": "spot-t1", "state": "available",
+                    "tags": {"moz-type": "t1", "Name": "spot-t1"},
+                    "root_device_type": "ebs", "root_device_name": "/dev/sda",
+                    "virtualization_type": "hvm",
+                    "block_device_mapping": {"/dev/sda": {"size": 10}}}],
+        "instances": [
+            {"id": "i-1", "state": "running", "tags": {"moz-type": "t1"},
+             "launch_time": format_aws_time(now - 60),
+             "spot_instance_request_id": "sir-1"},
+            {"id": "i-2", "state": "stopped", "tags": {"moz-type": "t2"},
+             "launch_time": format_aws_time(now - 60),
+             "spot_instance_request_id": None},
+        ],
+        "spot_requests": [
+            {"id": "sir-1", "state": "active", "tags": {}, "instance_id": "i-1",
+             "launch_specification": {"instance_type": "m1.medium",
+                                      "image_id": "ami-1",
+                                      "subnet_id": "subnet-1"},
+             "status": {"code": "fulfilled",
+                        "update_time": format_aws_time(now - 60)}},
+        ],
+        "spot_prices": [
+            {"availability_zone": az, "instance_type": "m1.medium",
+             "product_description": "Linux/UNIX", "price": 0.01 * i,
+             "timestamp": format_aws_time(now - 3600 * i)}
+            for i, az in enumerate(["az1", "az2", "az1", "az2", "az1"], 1)
+        ],
+    }
+
+
+@pytest.fixture
+def ec2():
+    recorded_at = time.time() - 86400
+    return FakeEC2({"r1": make_region(recorded_at)}, recorded_at=recorded_at)
+
+
+def test_time_shift(ec2):
+    conn = ec2.connect_to_region("r1")
+    i = conn.get_only_instances(instance_ids=["i-1"])[0]
+    assert abs(parse_aws_time(i.launch_time) - (time.time() - 60)) < 5
+
+
+def test_filters(ec2):
+    conn = ec2.connect_to_region("r1")
+    assert [i.id for i in conn.get_only_instances(
+        filters={"instance-state-name": ["running", "pending"]})] == ["i-1"]
+    assert [i.id for i in conn.get_only_instances(
+        filters={"instance-lifecycle": "spot"})] == ["i-1"]
+    assert [i.id for i in conn.get_only_instances(
+        filters={"tag:moz-type": "t2"})] == ["i-2"]
+    assert [a.id for a in conn.get_all_images(
+        filters={"tag:Name": "spot-*", "state": "available"})] == ["ami-1"]
+    with pytest.raises(NotImplementedError):
+        conn.get_only_instances(filters={"vpc-id": "vpc-1"})
+    assert ec2.calls["r1", "get_only_instances"] == 4
+
+
+def test_spot_price_pages(ec2):
+    conn = ec2.connect_to_region("r1")
+    page = conn.get_spot_price_history(instance_type="m1.medium",
+                                       max_results=2)
+    assert [p.price for p in page] == [0.01, 0.02]
+    page = conn.get_spot_price_history(instance_type="m1.medium",
+                                       max_results=2,
+                                       next_token=page.next_token)
+    assert [p.price for p in page] == [0.03, 0.04]
+    start_time = format_aws_time(time.time() - 2.5 * 3600)
+    page = conn.get_spot_price_history(instance_type="m1.medium",
+                                       start_time=start_time)
+    assert [p.price for p in page] == [0.01, 0.02]
+    assert page.next_token is None
+
+
+def test_launches(ec2):
+    conn = ec2.connect_to_region("r1")
+    subnet = ec2.vpc_connection(region=conn.region).get_all_subnets(
+        subnet_ids=["subnet-1"])[0]
+    nc = [FakeObject(subnet_id=subnet.id)]
+    sir = conn.request_spot_instances("0.1", "ami-1",
+                                      instance_type="m1.medium",
+                                      network_interfaces=nc)[0]
+    conn.create_tags([sir.id], {"moz-type": "t1", "Name": "n1"})
+    i = conn.run_instances("ami-1", instance_type="c3.xlarge",
+                           network_interfaces=nc).instances[0]
+    i.add_tag("Name", "n2")
+    assert sir in conn.get_all_spot_instance_requests(
+        filters={"state": ["open"]})
+    assert i in conn.get_only_instances(
+        filters={"instance-state-name": "pending"})
+    assert [(d["lifecycle"], d["name"], d["availability_zone"])
+            for d in ec2.decisions()] == [("spot", "n1", "az1"),
+                                          ("ondemand", "n2", "az1")]
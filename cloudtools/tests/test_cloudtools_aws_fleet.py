@@ -0,0 +1,84 @@
+import mock
+import pytest
+
+from cloudtools.aws import aws_get_running_instances, aws_filter_instances, \
+    filter_spot_instances, filter_ondemand_instances
+from cloudtools.aws.fleet import FleetIndex
+
+
+def make_instance(name, state, tags, spot_request_id, region="r1",
+                  image_id="ami-1"):
+    i = mock.Mock(name=name)
+    i.id = name
+    i.state = state
+    i.tags = tags
+    i.spot_instance_request_id = spot_request_id
+    i.region.name = region
+    i.image_id = image_id
+    return i
+
+
+@pytest.fixture
+def fleet():
+    return [
+        make_instance("i0", "running", {"moz-type": "m1", "moz-state": "ready"},
+                      "r0"),
+        make_instance("i1", "running", {"moz-type": "m2", "moz-state": "ready"},
+                      "r1", region="r2"),
+        make_instance("i2", "stopped", {"moz-type": "m1", "moz-state": "ready"},
+                      None, image_id="ami-2"),
+        make_instance("i3", "running",
+                      {"moz-type": "m1", "moz-state": "not-ready"}, None),
+        make_instance("i4", "running",
+                      {"moz-type": "m1", "moz-loaned-to": "dev1"}, "r1"),
+        make_instance("i5", "running", {"moz-type": "m1", "moz-state": "ready"},
+                      "r5", region="r2"),
+        make_instance("i6", "running", {}, None),
+    ]
+
+
+def test_is_a_sequence(fleet):
+    index = FleetIndex(fleet)
+    assert list(index) == fleet
+    assert len(index) == len(fleet)
+
+
+def test_select(fleet):
+    index = FleetIndex(fleet)
+    assert index.select(moz_type="m1", state="running", moz_state="ready",
+                        lifecycle="spot", region="r1") == (fleet[0],)
+    # fleet order is kept across index keys
+    assert index.select(moz_type="m1", state="running") == \
+        (fleet[0], fleet[3], fleet[4], fleet[5])
+    assert index.select(region="r2") == (fleet[1], fleet[5])
+    assert index.select(moz_type=None) == (fleet[6],)
+    assert index.select(moz_type="m3") == ()
+    assert isinstance(index.select(), FleetIndex)
+
+
+def test_lookups(fleet):
+    index = FleetIndex(fleet)
+    assert index.ids == set("i%i" % n for n in range(7))
+    assert index.ids_by_ami("ami-2") == set(["i2"])
+    assert index.count_by_ami("ami-1") == 6
+    assert index.count_by_ami("ami-3") == 0
+    assert index.is_loaned(fleet[4])
+    assert not index.is_loaned(fleet[0])
+
+
+@pytest.mark.parametrize("helper", [
+    lambda instances: aws_get_running_instances(instances, "m1"),
+    lambda instances: aws_get_running_instances(instances, "m2"),
+    filter_spot_instances,
+    filter_ondemand_instances,
+    lambda instances: filter_spot_instances(
+        aws_get_running_instances(instances, "m1")),
+    aws_filter_instances,
+    lambda instances: aws_filter_instances(instances, state="running"),
+    lambda instances: aws_filter_instances(
+        instances, tags={"moz-type": "m1", "moz-state": "ready"}),
+    lambda instances: aws_filter_instances(
+        instances, state="running", tags={"moz-type": "m1", "other": "x"}),
+])
+def test_helpers_use_index(fleet, helper):
+    assert list(helper(FleetIndex(fleet))) == list(helper(fleet))
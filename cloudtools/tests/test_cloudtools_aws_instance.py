@@ -1,5 +1,6 @@
 import mock
 import pytest
+from boto.exception import EC2ResponseError
 
 from cloudtools.aws.instance import create_block_device_mapping, \
     tag_ondemand_instance, pick_puppet_master
@@ -126,15 +127,23 @@ def test_tag_ondemand_instance():
     name = "name1"
     fqdn = "FQDN1"
     moz_instance_type = "type1"
+    tags = {"Name": name, "FQDN": fqdn, "moz-type": moz_instance_type,
+            "moz-state": "ready"}
     with mock.patch("time.sleep"):
         tag_ondemand_instance(instance, name, fqdn, moz_instance_type)
-    expected_calls = [
-        mock.call.add_tag("Name", name),
-        mock.call.add_tag("FQDN", fqdn),
-        mock.call.add_tag("moz-type", moz_instance_type),
-        mock.call.add_tag("moz-state", "ready"),
-    ]
-    instance.assert_has_calls(expected_calls, any_order=True)
+    instance.connection.create_tags.assert_called_once_with([instance.id],
+                                                            tags)
+    instance.tags.update.assert_called_once_with(tags)
+
+
+def test_tag_ondemand_instance_not_found():
+    instance = mock.MagicMock()
+    not_found = EC2ResponseError(400, "Bad")
+    not_found.code = "InvalidInstanceID.NotFound"
+    instance.connection.create_tags.side_effect = [not_found, None]
+    with mock.patch("time.sleep"):
+        tag_ondemand_instance(instance, "name1", "FQDN1", "type1")
+    assert instance.connection.create_tags.call_count == 2
 
 
 def test_pick_puppet_master():
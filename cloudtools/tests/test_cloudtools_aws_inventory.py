@@ -0,0 +1,79 @@
+import mock
+
+from cloudtools.aws.inventory import Inventory, DEFAULT_REFRESH_INTERVALS
+
+
+def test_stale_initially():
+    inv = Inventory(["r1"])
+    assert inv.stale(now=100) == set(DEFAULT_REFRESH_INTERVALS)
+
+
+@mock.patch("cloudtools.aws.inventory.get_active_spot_requests")
+@mock.patch("cloudtools.aws.inventory.aws_get_all_instances")
+def test_refresh_intervals(m_instances, m_spot_requests):
+    inv = Inventory(["r1", "r2"],
+                    refresh_intervals={"instances": 60, "spot_requests": 30})
+    inv.refresh(now=1000)
+    m_instances.assert_called_once_with(["r1", "r2"])
+    assert m_spot_requests.call_count == 2
+
+    m_instances.reset_mock()
+    m_spot_requests.reset_mock()
+    assert inv.refresh(now=1035) == set(["spot_requests"])
+    assert not m_instances.called
+    m_spot_requests.assert_has_calls([mock.call("r1"), mock.call("r2")])
+
+    # instances refresh brings spot requests along
+    assert inv.refresh(now=1061) == set(["instances", "spot_requests"])
+
+
+@mock.patch("cloudtools.aws.inventory.get_active_spot_requests")
+@mock.patch("cloudtools.aws.inventory.aws_get_all_instances")
+def test_refresh_invalidates_caches(m_instances, m_spot_requests):
+    import cloudtools.aws
+    cloudtools.aws._aws_instances_cache["r1"] = ["i1"]
+    inv = Inventory(["r1"])
+    inv.refresh(now=1000)
+    assert "r1" not in cloudtools.aws._aws_instances_cache
+    cloudtools.aws._aws_instances_cache["r1"] = ["i1"]
+    inv.refresh(now=1001)
+    assert cloudtools.aws._aws_instances_cache["r1"] == ["i1"]
+    inv.refresh(force=True, now=1002)
+    assert "r1" not in cloudtools.aws._aws_instances_cache
+
+
+def test_in_flight():
+    inv = Inventory(["r1"], launch_grace=300)
+    inv.record_launches("t1", ["i-1", "i-2", "i-3"], now=1000)
+    inv.record_launches("t2", ["sir-1", "sir-2"], now=1100)
+    inv.record_launches("t1", [], now=1100)
+    inv.record_launches("t1", ["i-4", "sir-3"], now=1200)
+    assert inv.in_flight("t1", now=1250) == 5
+    assert inv.in_flight("t1", now=1301) == 2
+    assert inv.in_flight("t2", now=1301) == 2
+    assert inv.in_flight("t3", now=1301) == 0
+
+
+def test_in_flight_skips_visible_launches():
+    inv = Inventory(["r1"], launch_grace=300)
+    inv.record_launches("t1", ["i-1", "sir-1", "sir-2"], now=1000)
+    ondemand = mock.Mock(id="i-1", spot_instance_request_id=None)
+    spot = mock.Mock(id="i-2", spot_instance_request_id="sir-1")
+    # Only the launch which is not running yet is in flight
+    assert inv.in_flight("t1", [ondemand, spot], now=1100) == 1
+
+
+@mock.patch("cloudtools.aws.vpc.reset_subnet_ledger")
+@mock.patch("cloudtools.aws.inventory.get_active_spot_requests")
+@mock.patch("cloudtools.aws.inventory.aws_get_all_instances")
+def test_refresh_resets_subnet_ledger(m_instances, m_spot_requests, m_reset):
+    inv = Inventory(["r1"], refresh_intervals={"spot_requests": 30,
+                                               "subnets": 300})
+    inv.refresh(now=1000)
+    assert m_reset.call_count == 1
+    # Fresh spot requests alone don't account for the IPs taken
+    assert "spot_requests" in inv.refresh(now=1031)
+    assert m_reset.call_count == 1
+    # Subnets are refreshed along with the spot requests
+    assert "spot_requests" in inv.refresh(now=1300)
+    assert m_reset.call_count == 2
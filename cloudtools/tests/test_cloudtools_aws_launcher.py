@@ -0,0 +1,62 @@
+import threading
+
+from cloudtools.aws.launcher import Launcher
+
+
+def test_wait_sums_per_key():
+    with Launcher(max_workers=4) as launcher:
+        for _ in range(10):
+            launcher.submit("t1", lambda: 1)
+        launcher.submit("t2", lambda: 0)
+        launcher.record("t2", 2)
+        assert launcher.wait() == {"t1": 10, "t2": 2}
+        # Results are reset
+        assert launcher.wait() == {}
+
+
+def test_launched_ids():
+    def launch(launcher, resource_id):
+        launcher.record_launched("t1", resource_id)
+        return 1
+
+    with Launcher(max_workers=2) as launcher:
+        launcher.submit("t1", launch, launcher, "sir-1")
+        launcher.submit("t1", launch, launcher, "i-2")
+        assert launcher.wait() == {"t1": 2}
+        assert sorted(launcher.pop_launched()["t1"]) == ["i-2", "sir-1"]
+        assert launcher.pop_launched() == {}
+
+
+def test_failed_launches():
+    def fail():
+        raise Exception("boom")
+
+    with Launcher(max_workers=2) as launcher:
+        launcher.submit("t1", fail)
+        launcher.submit("t1", lambda: 1)
+        assert launcher.wait() == {"t1": 1}
+
+
+def test_concurrent():
+    barrier = threading.Event()
+    started = []
+
+    def launch():
+        started.append(1)
+        if len(started) == 4:
+            barrier.set()
+        # Deadlocks unless all four launches run at the same time
+        return 1 if barrier.wait(5) else 0
+
+    with Launcher(max_workers=4) as launcher:
+        for _ in range(4):
+            launcher.submit("t1", launch)
+        assert launcher.wait() == {"t1": 4}
+
+
+def test_give_up():
+    with Launcher(max_workers=1) as launcher:
+        assert not launcher.gave_up(("spot", "r1"))
+        launcher.give_up(("spot", "r1"))
+        assert launcher.gave_up(("spot", "r1"))
+        assert not launcher.gave_up(("spot", "r2"))
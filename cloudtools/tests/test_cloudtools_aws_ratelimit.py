@@ -0,0 +1,179 @@
+import socket
+
+import boto
+import mock
+import pytest
+
+from cloudtools.aws import wait_for_status
+from cloudtools.aws.ratelimit import TokenBucket, AdaptiveTokenBucket, \
+    get_token_bucket, set_rate_limits, throttle, call_aws, backoff_delay, \
+    get_region_budget, get_throttle_stats, reset_throttle_stats, report_throttle_stats, \
+    DEFAULT_RATE_LIMITS, REGION_RATE_LIMIT, BACKOFF_CAP, NOT_FOUND
+
+
+@pytest.fixture(autouse=True)
+def reset_limits(request):
+    def reset():
+        set_rate_limits(None)
+        reset_throttle_stats()
+    reset()
+    request.addfinalizer(reset)
+
+
+def make_error(code):
+    e = boto.exception.EC2ResponseError(400, "Bad")
+    e.code = code
+    return e
+
+
+@mock.patch("time.time", return_value=100)
+def test_burst_then_rate(m_time):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+    # Slots are given back over time
+    m_time.return_value = 110
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+
+
+@mock.patch("time.sleep")
+@mock.patch("time.time", return_value=100)
+def test_acquire_sleeps(m_time, m_sleep):
+    bucket = TokenBucket(rate=1, burst=1)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 1
+    m_sleep.assert_called_once_with(1)
+
+
+def test_buckets_per_region_and_action():
+    b1 = get_token_bucket("r1", "RunInstances")
+    assert get_token_bucket("r1", "RunInstances") is b1
+    assert get_token_bucket("r2", "RunInstances") is not b1
+    assert get_token_bucket("r1", "CreateTags") is not b1
+    assert b1.burst == DEFAULT_RATE_LIMITS["RunInstances"][1]
+
+
+@mock.patch("time.sleep")
+def test_set_rate_limits(m_sleep):
+    set_rate_limits({"CreateTags": {"rate": 1, "burst": 1}})
+    assert get_token_bucket("r1", "CreateTags").interval == 1
+    throttle("r1", "CreateTags")
+    assert not m_sleep.called
+    throttle("r1", "CreateTags")
+    assert m_sleep.called
+
+
+def test_adaptive_bucket():
+    bucket = AdaptiveTokenBucket(rate=4, burst=10, min_rate=1, step=0.5)
+    bucket.slow_down()
+    assert (bucket.rate, bucket.burst) == (2, 1)
+    bucket.slow_down()
+    bucket.slow_down()
+    assert bucket.rate == 1
+    for _ in range(6):
+        bucket.speed_up()
+    assert (bucket.rate, bucket.burst) == (4, 10)
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        delay = min(BACKOFF_CAP, 2 * 2 ** attempt)
+        assert delay / 2.0 <= backoff_delay(attempt) <= delay
+
+
+@mock.patch("time.sleep")
+def test_call_aws_throttled(m_sleep):
+    func = mock.Mock(side_effect=[make_error("RequestLimitExceeded"),
+                                  make_error("RequestLimitExceeded"), 42])
+    assert call_aws("r1", "CreateTags", func, 1, x=2) == 42
+    func.assert_called_with(1, x=2)
+    assert func.call_count == 3
+    assert get_region_budget("r1").rate < REGION_RATE_LIMIT[0]
+    assert get_region_budget("r2").rate == REGION_RATE_LIMIT[0]
+    stats = get_throttle_stats()
+    assert stats["calls"] == 3
+    assert stats["throttled"] == stats["retries"] == 2
+    # Rate limit waits and backoff both sleep
+    assert stats["backoff_seconds"] > 0
+    assert stats["backoff_seconds"] + stats["wait_seconds"] == \
+        pytest.approx(sum(c[0][0] for c in m_sleep.call_args_list))
+
+
+@mock.patch("time.sleep")
+def test_call_aws_retry_codes(m_sleep):
+    func = mock.Mock(side_effect=[make_error("InvalidInstanceID.NotFound"),
+                                  42])
+    assert call_aws("r1", "CreateTags", func, retry_codes=[NOT_FOUND]) == 42
+    assert get_throttle_stats()["throttled"] == 0
+
+    func = mock.Mock(side_effect=make_error("InvalidInstanceID.NotFound"))
+    with pytest.raises(boto.exception.EC2ResponseError):
+        call_aws("r1", "CreateTags", func)
+    assert func.call_count == 1
+
+
+@mock.patch("time.sleep")
+def test_call_aws_gives_up(m_sleep):
+    func = mock.Mock(side_effect=make_error("RequestLimitExceeded"))
+    with pytest.raises(boto.exception.EC2ResponseError):
+        call_aws("r1", "CreateTags", func, max_tries=3)
+    assert func.call_count == 3
+    assert get_throttle_stats()["retries"] == 2
+
+
+@mock.patch("time.sleep")
+def test_report_throttle_stats(m_sleep):
+    func = mock.Mock(side_effect=[make_error("RequestLimitExceeded"), 42])
+    call_aws("r1", "CreateTags", func)
+    gr_log = mock.Mock()
+    report_throttle_stats(gr_log)
+    gr_log.add.assert_any_call("aws_api.calls", 2)
+    gr_log.add.assert_any_call("aws_api.throttled", 1)
+    assert get_throttle_stats()["calls"] == 0
+
+
+@mock.patch("time.sleep")
+def test_wait_for_status(m_sleep):
+    obj = mock.Mock(state="pending")
+    updates = [make_error("InvalidInstanceID.NotFound"), None, None]
+
+    def update():
+        rv = updates.pop(0)
+        if rv:
+            raise rv
+        if not updates:
+            obj.state = "running"
+
+    obj.update.side_effect = update
+    wait_for_status(obj, "state", "running", "update")
+    assert obj.update.call_count == 3
+
+    # Transient errors are retried
+    obj.state = "pending"
+    unavailable = make_error("Unavailable")
+    unavailable.status = 503
+    updates = [socket.error("reset"), unavailable, None]
+    obj.update.reset_mock()
+    obj.update.side_effect = update
+    wait_for_status(obj, "state", "running", "update")
+    assert obj.update.call_count == 3
+
+    # Other errors are not swallowed
+    obj.update.side_effect = make_error("AuthFailure")
+    with pytest.raises(boto.exception.EC2ResponseError):
+        wait_for_status(obj, "state", "stopped", "update")
+
+
+def test_buckets_without_region_or_action():
+    # Objects without a boto region and callables without a name
+    assert call_aws(None, "Foo", lambda: 42) == 42
+    assert call_aws(None, None, lambda: 43) == 43
+    assert isinstance(get_region_budget(None), AdaptiveTokenBucket)
+    assert get_token_bucket("r1", None) is not get_region_budget("r1")
+    assert get_token_bucket(None, None) is not get_region_budget(None)
+
+
+@mock.patch("time.sleep")
+def test_call_aws_throttled_without_region(m_sleep):
+    func = mock.Mock(side_effect=[make_error("RequestLimitExceeded"), 42])
+    assert call_aws(None, "CreateTags", func) == 42
+    assert get_region_budget(None).rate < REGION_RATE_LIMIT[0]
@@ -0,0 +1,121 @@
+import json
+import urllib2
+from StringIO import StringIO
+
+import mock
+
+from cloudtools.aws.sanity import BuildapiCache, Slave, \
+    fetch_last_job_endtime
+
+
+def make_slave(name, cache=None):
+    instance = mock.Mock()
+    instance.tags = {"Name": name, "moz-type": "tst-linux64"}
+    return Slave(instance, buildapi_cache=cache)
+
+
+def buildapi(jobs_by_slave):
+    """urlopen stand-in answering buildapi's recent jobs of a slave"""
+    def urlopen(url, timeout):
+        name = url.split("/")[-1].split("?")[0]
+        if name not in jobs_by_slave:
+            raise urllib2.URLError("timed out")
+        return StringIO(json.dumps(jobs_by_slave[name]))
+    return mock.Mock(side_effect=urlopen)
+
+
+def test_fetch_last_job_endtime():
+    jobs = {"slave1": [{"endtime": 100}, {"endtime": 300}], "slave2": []}
+    with mock.patch("urllib2.urlopen", buildapi(jobs)):
+        assert fetch_last_job_endtime("slave1") == (300, True)
+        assert fetch_last_job_endtime("slave2") == (None, True)
+        assert fetch_last_job_endtime("slave3") == (None, False)
+
+
+def test_cache_fetch_concurrently():
+    jobs = {"slave%i" % n: [{"endtime": n}] for n in range(1, 40)}
+    cache = BuildapiCache()
+    m_urlopen = buildapi(jobs)
+    with mock.patch("urllib2.urlopen", m_urlopen):
+        cache.fetch(["slave%i" % n for n in range(1, 42)] + ["slave1", None],
+                    workers=4)
+        # Cached
+        cache.fetch(["slave1", "slave2"])
+    # slave40 and slave41 failed and are not cached
+    assert m_urlopen.call_count == 41
+    assert cache.get("slave7") == 7
+    assert "slave40" not in cache
+    # ... but not asked again either
+    with mock.patch("urllib2.urlopen", m_urlopen):
+        cache.fetch(["slave40"])
+        assert make_slave("slave41", cache).get_last_job_endtime()
+    assert m_urlopen.call_count == 41
+
+
+def test_failures_not_persisted(tmpdir):
+    filename = str(tmpdir.join("buildapi.json"))
+    cache = BuildapiCache(filename)
+    cache.set_failed("slave1")
+    cache.save()
+    assert not BuildapiCache(filename).has_failed("slave1")
+
+
+def test_cache_ttl(tmpdir):
+    filename = str(tmpdir.join("buildapi.json"))
+    cache = BuildapiCache(filename, ttl=600)
+    with mock.patch("time.time", return_value=1000):
+        cache.set("slave1", 900)
+    with mock.patch("time.time", return_value=1500):
+        cache.set("slave2", None)
+        cache.save()
+    with mock.patch("time.time", return_value=1700):
+        loaded = BuildapiCache(filename, ttl=600)
+        assert "slave1" not in loaded
+        assert "slave2" in loaded
+        assert loaded.get("slave2") is None
+
+
+def test_slave_uses_cache():
+    cache = BuildapiCache()
+    cache.set("slave1", 1000)
+    slave = make_slave("slave1", cache)
+    with mock.patch("urllib2.urlopen") as m_urlopen:
+        assert slave.get_last_job_endtime() == 1000
+        assert not m_urlopen.called
+
+
+def test_lazy_slave_refetched(tmpdir):
+    filename = str(tmpdir.join("buildapi.json"))
+    cache = BuildapiCache(filename)
+    slave = make_slave("slave1", cache)
+    recent = slave.now - 3600
+    cache.set("slave1", recent)
+    cache.set("slave2", slave.now - 24 * 3600)
+    cache.save()
+    cache = BuildapiCache(filename)
+    slave1, slave2 = make_slave("slave1", cache), make_slave("slave2", cache)
+    # Only the cached endtime which would make a slave lazy is refetched
+    assert slave1.cached_endtime_usable()
+    assert not slave2.cached_endtime_usable()
+    m_urlopen = buildapi({"slave2": [{"endtime": recent}]})
+    with mock.patch("urllib2.urlopen", m_urlopen):
+        cache.fetch(["slave1", "slave2"], refetch=["slave2"])
+        assert m_urlopen.call_count == 1
+        assert slave1.get_last_job_endtime() == recent
+        assert slave2.get_last_job_endtime() == recent
+        assert m_urlopen.call_count == 1
+    assert cache.is_fresh("slave2")
+
+
+def test_slave_without_info():
+    cache = BuildapiCache()
+    slave = make_slave("slave1", cache)
+    with mock.patch("urllib2.urlopen", buildapi({"slave1": []})):
+        assert slave.get_last_job_endtime() == slave.now
+    assert "slave1" in cache
+    # buildapi down
+    slave = make_slave("slave2", cache)
+    with mock.patch("urllib2.urlopen", buildapi({})):
+        assert slave.get_last_job_endtime() == slave.now
+    assert "slave2" not in cache
+    assert cache.has_failed("slave2")
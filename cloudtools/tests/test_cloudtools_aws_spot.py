@@ -5,8 +5,39 @@ import cloudtools.aws.spot
 from cloudtools.aws.spot import (
     get_spot_requests_for_moztype, populate_spot_requests_cache,
     get_spot_request, get_instances_to_tag, copy_spot_request_tags,
-    get_active_spot_requests, get_spot_instances, get_spot_requests
+    get_active_spot_requests, get_spot_instances, get_spot_requests,
+    tag_spot_requests, create_tags_with_retries, plan_spot_price_requests,
+    get_current_spot_prices, get_spot_choices
 )
+from cloudtools.aws.ratelimit import set_rate_limits
+
+
+@pytest.fixture
+def no_price_cache(request):
+    cloudtools.aws.spot.invalidate_spot_prices_cache()
+    request.addfinalizer(cloudtools.aws.spot.invalidate_spot_prices_cache)
+
+
+def make_price_connection(region, azs, pages):
+    conn = mock.Mock()
+    conn.region.name = region
+    zones = []
+    for name in azs:
+        az = mock.Mock()
+        az.name = name
+        zones.append(az)
+    conn.get_all_zones.return_value = zones
+    results = []
+    for i, page in enumerate(pages):
+        result = mock.MagicMock()
+        result.__iter__.return_value = iter(
+            mock.Mock(availability_zone=az, instance_type=instance_type,
+                      price=price, timestamp=timestamp)
+            for az, instance_type, price, timestamp in page)
+        result.next_token = "token%i" % i if i < len(pages) - 1 else None
+        results.append(result)
+    conn.get_spot_price_history.side_effect = results
+    return conn
 
 
 @mock.patch("cloudtools.aws.spot.get_aws_connection")
@@ -165,3 +196,124 @@ def test_generic(m):
     r3 = mock.Mock()
     m.return_value = [r1, r2, r3]
     assert get_spot_requests_for_moztype("r11", "tt1") == [r1]
+
+
+@mock.patch("time.sleep")
+@mock.patch("cloudtools.aws.spot.get_aws_connection")
+def test_tag_spot_requests(conn, m_sleep):
+    r1, r2 = mock.Mock(id="sir-1"), mock.Mock(id="sir-2")
+    tagged = tag_spot_requests("r1", [(r1, "n1", "n1.d"), (r2, "n2", "n2.d")],
+                               "t1")
+    assert tagged == [r1, r2]
+    conn.return_value.create_tags.assert_has_calls([
+        mock.call(["sir-1"], {"moz-type": "t1", "Name": "n1",
+                              "FQDN": "n1.d"}),
+        mock.call(["sir-2"], {"moz-type": "t1", "Name": "n2",
+                              "FQDN": "n2.d"}),
+    ])
+    assert not m_sleep.called
+
+
+@mock.patch("time.sleep")
+@mock.patch("cloudtools.aws.spot.get_aws_connection")
+def test_tag_spot_requests_failure(conn, m_sleep):
+    r1, r2 = mock.Mock(id="sir-1"), mock.Mock(id="sir-2")
+    conn.return_value.create_tags.side_effect = [
+        boto.exception.EC2ResponseError(400, "Bad", body=None), None]
+    assert tag_spot_requests("r1", [(r1, "n1", "f1"), (r2, "n2", "f2")],
+                             "t1") == [r2]
+
+
+@mock.patch("time.sleep")
+def test_create_tags_with_retries(m_sleep):
+    conn = mock.Mock()
+    not_found = boto.exception.EC2ResponseError(400, "Bad")
+    not_found.code = "InvalidSpotInstanceRequestID.NotFound"
+    conn.create_tags.side_effect = [not_found, not_found, None]
+    create_tags_with_retries(conn, ["sir-1"], {"t": "v"})
+    assert conn.create_tags.call_count == 3
+    assert m_sleep.call_count == 2
+
+
+@mock.patch("time.sleep")
+def test_create_tags_with_retries_gives_up(m_sleep):
+    conn = mock.Mock()
+    not_found = boto.exception.EC2ResponseError(400, "Bad")
+    not_found.code = "InvalidSpotInstanceRequestID.NotFound"
+    conn.create_tags.side_effect = not_found
+    with pytest.raises(boto.exception.EC2ResponseError):
+        create_tags_with_retries(conn, ["sir-1"], {"t": "v"}, max_tries=3)
+    assert conn.create_tags.call_count == 3
+
+
+def test_plan_spot_price_requests():
+    c1, c2 = mock.Mock(), mock.Mock()
+    rules = [
+        {"instance_type": "t1", "ignored_azs": ["az1", "az2"]},
+        {"instance_type": "t2"},
+        {"instance_type": "t1", "ignored_azs": ["az2", "az3"]},
+    ]
+    assert plan_spot_price_requests([c1, c2], rules) == [
+        (c1, "t1", ["az2"]), (c2, "t1", ["az2"]),
+        (c1, "t2", []), (c2, "t2", []),
+    ]
+
+
+def test_get_current_spot_prices_early_stop(no_price_cache):
+    conn = make_price_connection("r1", ["az1", "az2"], [
+        [("az1", "t1", 0.2, "2014-11-01T01:00:00.000Z"),
+         ("az1", "t1", 0.1, "2014-11-01T02:00:00.000Z"),
+         ("az3", "t1", 0.5, "2014-11-01T03:00:00.000Z")],
+        [("az2", "t1", 0.3, "2014-11-01T01:00:00.000Z")],
+        [("az2", "t1", 0.4, "2014-11-01T00:00:00.000Z")],
+    ])
+    prices = get_current_spot_prices(conn, "Linux/UNIX", instance_type="t1")
+    assert prices == {"r1": {"t1": {"az1": 0.1, "az2": 0.3}}}
+    assert conn.get_spot_price_history.call_count == 2
+    kwargs = conn.get_spot_price_history.call_args[1]
+    assert kwargs["max_results"] == 1000
+    assert kwargs["next_token"] == "token0"
+
+
+@mock.patch("time.sleep")
+def test_get_current_spot_prices_throttled(m_sleep, no_price_cache, request):
+    request.addfinalizer(lambda: set_rate_limits(None))
+    conn = make_price_connection("r1", ["az1"], [
+        [("az1", "t1", 0.1, "2014-11-01T01:00:00.000Z")],
+    ])
+    throttled = boto.exception.EC2ResponseError(400, "Bad")
+    throttled.code = "RequestLimitExceeded"
+    conn.get_all_zones.side_effect = [throttled,
+                                      conn.get_all_zones.return_value]
+    conn.get_spot_price_history.side_effect = \
+        [throttled] + list(conn.get_spot_price_history.side_effect)
+    prices = get_current_spot_prices(conn, "Linux/UNIX", instance_type="t1")
+    assert prices == {"r1": {"t1": {"az1": 0.1}}}
+    assert conn.get_all_zones.call_count == 2
+    assert conn.get_spot_price_history.call_count == 2
+
+
+def test_get_spot_choices(no_price_cache):
+    c1 = make_price_connection("r1", ["az1", "az2"], [
+        [("az1", "t1", 0.1, "2014-11-01T01:00:00.000Z"),
+         ("az2", "t1", 0.9, "2014-11-01T01:00:00.000Z")],
+    ])
+    c2 = make_price_connection("r2", ["az3"], [
+        [("az3", "t1", 0.05, "2014-11-01T01:00:00.000Z")],
+    ])
+    rules = [
+        {"instance_type": "t1", "bid_price": 1, "performance_constant": 1},
+        {"instance_type": "t1", "bid_price": 2, "performance_constant": 2,
+         "ignored_azs": ["az1"]},
+    ]
+    choices = get_spot_choices([c1, c2], rules, "Linux/UNIX")
+    assert [(c.region, c.availability_zone, c.bid_price, c.current_price)
+            for c in choices] == [
+        ("r2", "az3", 2, 0.05),
+        ("r2", "az3", 1, 0.05),
+        ("r1", "az1", 1, 0.1),
+        ("r1", "az2", 2, 0.9),
+    ]
+    # Each region is asked once for the shared instance type
+    assert c1.get_spot_price_history.call_count == 1
+    assert c2.get_spot_price_history.call_count == 1
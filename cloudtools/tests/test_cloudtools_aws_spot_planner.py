@@ -0,0 +1,72 @@
+from cloudtools.aws.spot import Spot
+from cloudtools.aws.spot_planner import FlowNetwork, plan_spot_allocation
+
+
+def make_choice(region, az, price):
+    return Spot(instance_type="c3.xlarge", region=region,
+                availability_zone=az, current_price=price, bid_price=1,
+                performance_constant=1)
+
+
+def summarize(plan):
+    return sorted((e.moz_instance_type, e.choice.availability_zone,
+                   e.subnet_id, e.count) for e in plan)
+
+
+def test_min_cost_max_flow():
+    net = FlowNetwork()
+    net.add_edge("s", "a", 3)
+    net.add_edge("s", "b", 2)
+    cheap = net.add_edge("a", "t", 2, cost=1)
+    expensive = net.add_edge("a", "t", 5, cost=3)
+    shared = net.add_edge("b", "t", 5, cost=2)
+    assert net.min_cost_max_flow("s", "t") == 5
+    assert net.flow(cheap) == 2
+    assert net.flow(expensive) == 1
+    assert net.flow(shared) == 2
+
+
+def test_plan_cheapest_first():
+    c1 = make_choice("r1", "az1", 0.2)
+    c2 = make_choice("r1", "az2", 0.1)
+    plan = plan_spot_allocation(
+        {"t1": 5}, {("t1", "r1"): 10},
+        {"t1": [(c1, ["s1"]), (c2, ["s2"])]},
+        {("r1", "s1"): 10, ("r1", "s2"): 3})
+    assert [(e.subnet_id, e.count) for e in plan] == [("s2", 3), ("s1", 2)]
+    assert all(e.ami is None for e in plan)
+
+
+def test_plan_region_limit():
+    c1 = make_choice("r1", "az1", 0.1)
+    c2 = make_choice("r1", "az2", 0.1)
+    c3 = make_choice("r2", "az3", 0.5)
+    plan = plan_spot_allocation(
+        {"t1": 10}, {("t1", "r1"): 4, ("t1", "r2"): 3},
+        {"t1": [(c1, ["s1"]), (c2, ["s2"]), (c3, ["s3"])]},
+        {("r1", "s1"): 10, ("r1", "s2"): 10, ("r2", "s3"): 10})
+    # The regional limit holds across availability zones
+    assert sum(e.count for e in plan if e.choice.region == "r1") == 4
+    assert sum(e.count for e in plan if e.choice.region == "r2") == 3
+
+
+def test_plan_shared_subnets():
+    shared = make_choice("r1", "az1", 0.1)
+    other = make_choice("r1", "az2", 0.1)
+    # t1 can only use the shared subnet, t2 can use both. Planned one type
+    # at a time, t2 could take the shared subnet and starve t1.
+    plan = plan_spot_allocation(
+        {"t1": 3, "t2": 3}, {("t1", "r1"): 10, ("t2", "r1"): 10},
+        {"t1": [(shared, ["s1"])],
+         "t2": [(shared, ["s1"]), (other, ["s2"])]},
+        {("r1", "s1"): 3, ("r1", "s2"): 3})
+    assert summarize(plan) == [("t1", "az1", "s1", 3), ("t2", "az2", "s2", 3)]
+
+
+def test_plan_not_enough_capacity():
+    c1 = make_choice("r1", "az1", 0.1)
+    plan = plan_spot_allocation(
+        {"t1": 5, "t2": 5}, {("t1", "r1"): 10, ("t2", "r1"): 10},
+        {"t1": [(c1, ["s1"])], "t2": [(c1, ["s1"])]},
+        {("r1", "s1"): 4})
+    assert sum(e.count for e in plan) == 4
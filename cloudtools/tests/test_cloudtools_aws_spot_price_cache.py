@@ -0,0 +1,128 @@
+import mock
+import pytest
+
+import cloudtools.aws.spot
+from cloudtools.aws.spot import get_current_spot_prices, set_spot_price_store
+from cloudtools.aws.spot_price_cache import SpotPriceCache
+
+PRODUCT = "Linux/UNIX (Amazon VPC)"
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return SpotPriceCache(str(tmpdir.join("spot_prices.json")), ttl=300)
+
+
+@pytest.fixture
+def store(request, cache):
+    cloudtools.aws.spot.invalidate_spot_prices_cache()
+    set_spot_price_store(cache)
+
+    def reset():
+        set_spot_price_store(None)
+        cloudtools.aws.spot.invalidate_spot_prices_cache()
+
+    request.addfinalizer(reset)
+    return cache
+
+
+def test_missing_file(cache):
+    assert cache.get("r1", PRODUCT, "m1.medium") == {}
+
+
+def test_corrupted_file(cache):
+    with open(cache.path, "w") as f:
+        f.write("{")
+    assert cache.get("r1", PRODUCT, "m1.medium") == {}
+
+
+def test_update(cache):
+    cache.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.1, "2014-11-01T02:00:00.000Z")}, fetched_at=100)
+    cache.update("r1", PRODUCT, "m1.medium",
+                 {"az2": (0.2, "2014-11-01T03:00:00.000Z")}, fetched_at=200)
+    assert cache.get("r1", PRODUCT, "m1.medium") == {
+        "az1": (0.1, "2014-11-01T02:00:00.000Z", 100),
+        "az2": (0.2, "2014-11-01T03:00:00.000Z", 200),
+    }
+    assert cache.get("r1", PRODUCT, "c3.xlarge") == {}
+
+
+def test_update_keeps_newer(cache):
+    cache.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.1, "2014-11-01T03:00:00.000Z")}, fetched_at=100)
+    cache.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.2, "2014-11-01T02:00:00.000Z")}, fetched_at=200)
+    assert cache.get("r1", PRODUCT, "m1.medium") == {
+        "az1": (0.1, "2014-11-01T03:00:00.000Z", 100)}
+
+
+def test_no_temporary_files_left(cache, tmpdir):
+    cache.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.1, "2014-11-01T03:00:00.000Z")})
+    assert [p.basename for p in tmpdir.listdir()] == ["spot_prices.json"]
+
+
+def test_is_fresh(cache):
+    entries = {"az1": (0.1, "t", 100), "az2": (0.1, "t", 50)}
+    assert cache.is_fresh(entries, set(["az1", "az2"]), now=349)
+    assert not cache.is_fresh(entries, set(["az1", "az2"]), now=350)
+    assert not cache.is_fresh(entries, set(["az1", "az3"]), now=100)
+    assert not cache.is_fresh(entries, set(), now=100)
+
+
+def make_connection(prices):
+    conn = mock.Mock()
+    conn.region.name = "r1"
+    zones = []
+    for name in ["az1", "az2"]:
+        az = mock.Mock()
+        az.name = name
+        zones.append(az)
+    conn.get_all_zones.return_value = zones
+    history = mock.MagicMock()
+    history.__iter__.return_value = iter(prices)
+    history.next_token = None
+    conn.get_spot_price_history.return_value = history
+    return conn
+
+
+def make_price(az, price, timestamp):
+    return mock.Mock(availability_zone=az, price=price, timestamp=timestamp,
+                     instance_type="m1.medium")
+
+
+def test_fresh_store_skips_api(store):
+    store.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.1, "2014-11-01T02:00:00.000Z"),
+                  "az2": (0.2, "2014-11-01T02:00:00.000Z")})
+    conn = make_connection([])
+    assert get_current_spot_prices(conn, PRODUCT,
+                                   instance_type="m1.medium") == \
+        {"r1": {"m1.medium": {"az1": 0.1, "az2": 0.2}}}
+    assert not conn.get_spot_price_history.called
+
+
+def test_stale_store_fetches_newer_points(store):
+    store.update("r1", PRODUCT, "m1.medium",
+                 {"az1": (0.1, "2014-11-01T02:00:00.000Z"),
+                  "az2": (0.2, "2014-11-01T01:00:00.000Z")}, fetched_at=0)
+    conn = make_connection([make_price("az1", 0.3, "2014-11-01T04:00:00.000Z")])
+    assert get_current_spot_prices(conn, PRODUCT,
+                                   instance_type="m1.medium") == \
+        {"r1": {"m1.medium": {"az1": 0.3, "az2": 0.2}}}
+    assert conn.get_spot_price_history.call_args[1]["start_time"] == \
+        "2014-11-01T01:00:00.000Z"
+    stored = store.get("r1", PRODUCT, "m1.medium")
+    assert stored["az1"][:2] == (0.3, "2014-11-01T04:00:00.000Z")
+    assert stored["az2"][:2] == (0.2, "2014-11-01T01:00:00.000Z")
+    assert stored["az2"][2] > 0
+
+
+def test_empty_store_fetches_a_day(store):
+    conn = make_connection([make_price("az1", 0.3, "2014-11-01T04:00:00.000Z"),
+                            make_price("az2", 0.4, "2014-11-01T03:00:00.000Z")])
+    get_current_spot_prices(conn, PRODUCT, instance_type="m1.medium")
+    assert conn.get_spot_price_history.call_args[1]["start_time"] != \
+        "2014-11-01T01:00:00.000Z"
+    assert sorted(store.get("r1", PRODUCT, "m1.medium")) == ["az1", "az2"]
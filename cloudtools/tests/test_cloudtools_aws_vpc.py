@@ -1,6 +1,30 @@
 import mock
+import pytest
 
-from cloudtools.aws.vpc import get_subnet_id, ip_available, get_avail_subnet
+from cloudtools.aws.vpc import get_subnet_id, ip_available, get_avail_subnet, \
+    invalidate_subnets_cache, reset_subnet_ledger, get_subnet_capacity, \
+    allocate_subnet_ip
+
+
+@pytest.fixture(autouse=True)
+def reset_caches(request):
+    invalidate_subnets_cache()
+    request.addfinalizer(invalidate_subnets_cache)
+
+
+def make_subnet(subnet_id, az, count):
+    s = mock.Mock()
+    s.id = subnet_id
+    s.availability_zone = az
+    s.available_ip_address_count = count
+    return s
+
+
+def make_request(subnet_id, state="open"):
+    r = mock.Mock()
+    r.state = state
+    r.launch_specification.subnet_id = subnet_id
+    return r
 
 
 def test_get_subnet_id():
@@ -33,8 +57,9 @@ def test_ip_available(c):
     assert not ip_available("r1", "a3")
 
 
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests", return_value=[])
 @mock.patch("cloudtools.aws.vpc.get_vpc")
-def test_get_avail_subnet(vpc):
+def test_get_avail_subnet(vpc, m_requests):
     s1 = mock.Mock()
     s1.available_ip_address_count = 10
     s1.availability_zone = "az1"
@@ -62,3 +87,72 @@ def test_get_avail_subnet(vpc):
     vpc.return_value.get_all_subnets.assert_called_once_with(
         subnet_ids=("id1", "id2", "id3", "id4"))
     assert get_avail_subnet("r1", ["id44"], "azx") is None
+
+
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests")
+@mock.patch("cloudtools.aws.vpc.get_vpc")
+def test_get_avail_subnet_ledger(vpc, m_requests):
+    vpc.return_value.get_all_subnets.return_value = [
+        make_subnet("id1", "az1", 6), make_subnet("id2", "az1", 7),
+        make_subnet("id3", "az2", 30)]
+    m_requests.return_value = [
+        make_request("id2"), make_request("id2"),
+        make_request("id1", state="active")]
+    # id1: 6 usable, id2: 7 - 2 pending = 5 usable, 2 IPs are kept free
+    allocated = [get_avail_subnet("r1", ["id1", "id2", "id3"], "az1")
+                 for _ in range(9)]
+    assert allocated == ["id1", "id1", "id2", "id1", "id2", "id1", "id2",
+                         None, None]
+    m_requests.assert_called_once_with("r1")
+    vpc.return_value.get_all_subnets.assert_called_once_with(
+        subnet_ids=("id1", "id2", "id3"))
+
+    reset_subnet_ledger()
+    assert get_avail_subnet("r1", ["id1", "id2", "id3"], "az1") == "id1"
+
+
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests", return_value=[])
+@mock.patch("cloudtools.aws.vpc.get_vpc")
+def test_get_avail_subnet_shared_subnets(vpc, m_requests):
+    subnets = {"id1": make_subnet("id1", "az1", 5),
+               "id2": make_subnet("id2", "az1", 4)}
+    vpc.return_value.get_all_subnets.side_effect = \
+        lambda subnet_ids: [subnets[s] for s in subnet_ids]
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id1"
+    assert get_avail_subnet("r1", ["id1"], "az1") == "id1"
+    # id1 has 3 usable IPs left, the other subnet list sees it too
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id2"
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id1"
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id2"
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") is None
+
+
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests", return_value=[])
+@mock.patch("cloudtools.aws.vpc.get_vpc")
+def test_get_subnet_capacity(vpc, m_requests):
+    vpc.return_value.get_all_subnets.return_value = [
+        make_subnet("id1", "az1", 6), make_subnet("id2", "az1", 2),
+        make_subnet("id3", "az2", 30)]
+    assert get_subnet_capacity("r1", ["id1", "id2", "id3"], "az1") == \
+        {"id1": 4}
+    assert get_avail_subnet("r1", ["id1", "id2", "id3"], "az1") == "id1"
+    assert get_subnet_capacity("r1", ["id1", "id2", "id3"], "az1") == \
+        {"id1": 3}
+
+
+@mock.patch("cloudtools.aws.vpc.get_active_spot_requests", return_value=[])
+@mock.patch("cloudtools.aws.vpc.get_vpc")
+def test_allocate_subnet_ip(vpc, m_requests):
+    vpc.return_value.get_all_subnets.return_value = [
+        make_subnet("id1", "az1", 4), make_subnet("id2", "az1", 3)]
+    assert get_subnet_capacity("r1", ["id1", "id2"], "az1") == \
+        {"id1": 2, "id2": 1}
+    assert allocate_subnet_ip("r1", "id2")
+    assert not allocate_subnet_ip("r1", "id2")
+    # Unknown subnets are not looked up
+    assert not allocate_subnet_ip("r1", "id3")
+    assert vpc.return_value.get_all_subnets.call_count == 1
+    # The heap sees the allocations made from a single subnet
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id1"
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") == "id1"
+    assert get_avail_subnet("r1", ["id1", "id2"], "az1") is None
@@ -0,0 +1,221 @@
+import time
+from collections import OrderedDict
+
+import mock
+import pytest
+import sqlalchemy as sa
+
+from sqlalchemy.engine.reflection import Inspector
+
+from cloudtools.buildbot import BuilderClassifier, get_builder_classifier, \
+    map_builders, count_builders, find_pending, PendingQuery, parse_probe, \
+    get_last_activity, get_buildbot_master, probe_command, \
+    graceful_shutdown, ACTIVITY_STOPPED
+from cloudtools.masters import MasterClient
+
+# Relevant parts of the buildbot 0.8 schema
+NEW_SCHEMA = [
+    """CREATE TABLE buildrequests (
+           id INTEGER PRIMARY KEY, buildsetid INTEGER,
+           buildername VARCHAR(256), priority INTEGER DEFAULT 0,
+           complete INTEGER DEFAULT 0, results SMALLINT,
+           submitted_at INTEGER, complete_at INTEGER)""",
+    """CREATE TABLE buildrequest_claims (
+           brid INTEGER NOT NULL, objectid INTEGER,
+           claimed_at INTEGER NOT NULL)""",
+]
+OLD_SCHEMA = [
+    """CREATE TABLE buildrequests (
+           id INTEGER PRIMARY KEY, buildsetid INTEGER,
+           buildername VARCHAR(256), priority INTEGER DEFAULT 0,
+           claimed_at INTEGER DEFAULT 0, claimed_by_name VARCHAR(256),
+           complete INTEGER DEFAULT 0, results SMALLINT,
+           submitted_at INTEGER, complete_at INTEGER)""",
+]
+
+
+def make_db(path, schema, claimed_column):
+    dburl = "sqlite:///%s" % path
+    db = sa.create_engine(dburl)
+    for statement in schema:
+        db.execute(statement)
+    now = time.time()
+    rows = [
+        # id, buildername, complete, submitted_at, claimed
+        (1, "b1", 0, now - 60, False),
+        (2, "b1", 0, now - 120, False),
+        (3, "b2", 0, now - 60, False),
+        (4, "b2", 0, now - 60, True),  # claimed
+        (5, "b3", 1, now - 60, False),  # complete
+        (6, "b3", 0, now - 2 * 86400, False),  # too old
+        (7, "b3", 0, now, False),  # too new
+    ]
+    for brid, buildername, complete, submitted_at, claimed in rows:
+        if claimed_column:
+            db.execute(
+                "INSERT INTO buildrequests (id, buildername, complete, "
+                "submitted_at, claimed_at) VALUES (?, ?, ?, ?, ?)",
+                brid, buildername, complete, submitted_at,
+                now if claimed else 0)
+        else:
+            db.execute(
+                "INSERT INTO buildrequests (id, buildername, complete, "
+                "submitted_at) VALUES (?, ?, ?, ?)",
+                brid, buildername, complete, submitted_at)
+            if claimed:
+                db.execute("INSERT INTO buildrequest_claims VALUES (?, 1, ?)",
+                           brid, now)
+    return dburl
+
+
+@pytest.fixture(params=["new", "old"])
+def buildbot_db(request, tmpdir):
+    if request.param == "new":
+        return make_db(tmpdir.join("new.sqlite"), NEW_SCHEMA, False)
+    return make_db(tmpdir.join("old.sqlite"), OLD_SCHEMA, True)
+
+
+def test_find_pending(buildbot_db):
+    assert sorted(tuple(r) for r in find_pending(buildbot_db)) == \
+        [("b1", 1), ("b1", 2), ("b2", 3)]
+
+
+def test_find_pending_aggregate(buildbot_db):
+    rows = find_pending(buildbot_db, aggregate=True)
+    assert sorted(tuple(r) for r in rows) == [("b1", 2), ("b2", 1)]
+
+
+def test_pending_query_caches_schema(buildbot_db):
+    q = PendingQuery(buildbot_db)
+    with mock.patch("cloudtools.buildbot.Inspector",
+                    wraps=Inspector) as m_inspector:
+        q.fetch()
+        q.fetch(aggregate=True)
+    m_inspector.assert_called_once_with(q.db)
+
+
+def test_find_pending_reuses_engine(buildbot_db):
+    with mock.patch("sqlalchemy.create_engine",
+                    wraps=sa.create_engine) as m_create_engine:
+        find_pending(buildbot_db)
+        find_pending(buildbot_db, aggregate=True)
+    assert m_create_engine.call_count == 1
+
+
+def test_classifier_first_match_wins():
+    c = BuilderClassifier(OrderedDict([
+        ("^Linux try", "try-linux64"),
+        ("^Linux", "bld-linux64"),
+    ]))
+    assert c.classify("Linux try build") == "try-linux64"
+    assert c.classify("Linux mozilla-central build") == "bld-linux64"
+    assert c.classify("WINNT build") is None
+
+
+def test_classifier_memo():
+    c = BuilderClassifier({"^Linux": "bld-linux64"})
+    assert c.classify("Linux build") == "bld-linux64"
+    c.rules = []
+    assert c.classify("Linux build") == "bld-linux64"
+    assert c.classify("Linux opt build") is None
+
+
+def test_get_builder_classifier_reused():
+    builder_map = {"^a": "t1", "^b": "t2"}
+    c = get_builder_classifier(builder_map)
+    assert get_builder_classifier(dict(builder_map)) is c
+    assert get_builder_classifier({"^a": "t1"}) is not c
+
+
+def test_count_builders():
+    pending = [("b1", 1), ("b2", 2), ("b1", 3)]
+    assert count_builders(pending) == {"b1": 2, "b2": 1}
+    assert count_builders(pending, aggregated=True) == {"b1": 4, "b2": 2}
+
+
+def test_map_builders():
+    builder_map = OrderedDict([
+        ("^Linux try", "try-linux64"),
+        ("^Linux", "bld-linux64"),
+        ("^Ubuntu", "tst-linux64"),
+    ])
+    pending = [("Linux try build", 1), ("Linux opt build", 2),
+               ("Linux try build", 3), ("Ubuntu test", 4), ("Android", 5)]
+    assert map_builders(pending, builder_map) == {
+        "try-linux64": 2, "bld-linux64": 1, "tst-linux64": 1}
+
+
+def test_map_builders_aggregated():
+    builder_map = {"^Linux": "bld-linux64"}
+    pending = [("Linux build", 10), ("Linux opt build", 2), ("Android", 5)]
+    assert map_builders(pending, builder_map, aggregated=True) == {
+        "bld-linux64": 12}
+
+
+def make_probe_output(date="20150101120000", uptime="3600.5 7000.1",
+                      tac="buildmaster_host = 'bm1.example.com'",
+                      log_lines=()):
+    return "\n".join(
+        ["--cloudtools-probe-date--", date,
+         "--cloudtools-probe-uptime--", uptime,
+         "--cloudtools-probe-tac--", tac,
+         "--cloudtools-probe-log--", "1234 5678 full"] +
+        list(log_lines)) + "\n"
+
+
+def test_parse_probe():
+    probe = parse_probe(make_probe_output(log_lines=[
+        "2015-01-01 11:50:00+0000 [-] line1", "line2"]))
+    assert probe.slave_time == time.mktime((2015, 1, 1, 12, 0, 0, 0, 0, -1))
+    assert probe.uptime == 3600.5
+    assert probe.master_host == "bm1.example.com"
+    assert probe.activity.last_line == "2015-01-01 11:50:00+0000 [-] line1"
+    assert probe.cursor.inode == "1234"
+    assert probe.cursor.offset == 5678
+
+
+def test_parse_probe_no_tac():
+    probe = parse_probe(make_probe_output(tac=""))
+    assert probe.master_host is None
+    assert probe.activity.event is None
+
+
+def test_get_last_activity_single_round_trip():
+    ssh_client = mock.Mock()
+    ssh_client.get_stdout.return_value = make_probe_output(log_lines=[
+        "2015-01-01 11:50:00+0000 [-] RunProcess._startCommand",
+        "2015-01-01 11:55:00+0000 [-] commandComplete",
+    ])
+    assert get_last_activity(ssh_client) == 300
+    ssh_client.get_stdout.assert_called_once_with(probe_command())
+
+
+def test_get_last_activity_stopped():
+    ssh_client = mock.Mock()
+    ssh_client.get_stdout.return_value = make_probe_output(log_lines=[
+        "2015-01-01 11:55:00+0000 [-] Server Shut Down.",
+    ])
+    assert get_last_activity(ssh_client) == ACTIVITY_STOPPED
+
+
+def test_get_buildbot_master_probed_host():
+    ssh_client = mock.Mock()
+    masters = [{"hostname": "bm1.example.com", "http_port": 8001}]
+    assert get_buildbot_master(ssh_client, masters, "bm1.example.com") == \
+        ("bm1.example.com", 8001)
+    assert not ssh_client.get_stdout.called
+
+
+@mock.patch("cloudtools.masters.request_shutdown")
+def test_graceful_shutdown_reads_tac_once(m_shutdown):
+    ssh_client = mock.Mock()
+    ssh_client.name = "slave1"
+    ssh_client.get_stdout.return_value = \
+        "buildmaster_host = 'bm1.example.com'\n"
+    client = MasterClient([{"hostname": "bm1.example.com",
+                            "http_port": 8001}])
+    graceful_shutdown(ssh_client, None, client=client)
+    graceful_shutdown(ssh_client, None, client=client)
+    assert ssh_client.get_stdout.call_count == 1
+    assert m_shutdown.call_count == 2
+    assert m_shutdown.call_args[0][:3] == ("bm1.example.com", 8001, "slave1")
@@ -0,0 +1,108 @@
+import mock
+
+from cloudtools.drains import DrainLedger, find_drained
+
+
+def make_instance(instance_id, name):
+    i = mock.Mock()
+    i.id = instance_id
+    i.tags = {"Name": name}
+    return i
+
+
+def test_ledger_roundtrip(tmpdir):
+    filename = str(tmpdir.join("drains.json"))
+    ledger = DrainLedger(filename)
+    ledger.record("i-1", "slave1", "bm1")
+    ledger.record("i-2", "slave2")
+    ledger.save()
+    loaded = DrainLedger(filename)
+    assert len(loaded) == 2
+    assert loaded.get("i-1") == ledger.get("i-1")
+    assert loaded.get("i-2").master_host is None
+    loaded.prune(["i-2", "i-3"])
+    assert loaded.get("i-1") is None
+    loaded.forget(["i-2", "i-3"])
+    assert len(loaded) == 0
+
+
+def test_ledger_keeps_first_request():
+    ledger = DrainLedger()
+    with mock.patch("time.time", return_value=1000):
+        ledger.record("i-1", "slave1", "bm1")
+    with mock.patch("time.time", return_value=1600):
+        ledger.record("i-1", "slave1")
+    assert ledger.get("i-1") == ("slave1", "bm1", 1000)
+    # The instance runs another slave now
+    with mock.patch("time.time", return_value=2000):
+        ledger.record("i-1", "slave2", "bm2")
+    assert ledger.get("i-1") == ("slave2", "bm2", 2000)
+
+
+def test_ledger_expire_and_forget_slaves():
+    ledger = DrainLedger()
+    with mock.patch("time.time", return_value=1000):
+        ledger.record("i-1", "slave1", "bm1")
+    with mock.patch("time.time", return_value=5000):
+        ledger.record("i-2", "slave2", "bm1")
+        ledger.record("i-3", "slave3", "bm1")
+    ledger.expire(max_age=3600, now=5500)
+    assert ledger.get("i-1") is None
+    assert ledger.get("i-2")
+    ledger.forget_slaves(["slave2"])
+    assert ledger.get("i-2") is None
+    assert len(ledger) == 1
+
+
+def test_find_drained_forgets_resumed():
+    ledger = DrainLedger()
+    with mock.patch("time.time", return_value=1000):
+        ledger.record("i-1", "slave1", "bm1")
+        ledger.record("i-2", "slave2", "bm1")
+    master_client = mock.Mock()
+    master_client.workers = 2
+    master_client.ports = {"bm1": 8001}
+    statuses = {
+        # Finishing the build it ran when asked to shut down
+        "slave1": {"connected": True,
+                   "runningBuilds": [{"times": [900, None]}]},
+        # Took a new build, the shutdown didn't happen
+        "slave2": {"connected": True,
+                   "runningBuilds": [{"times": [1100, None]}]},
+    }
+    master_client.get_slave.side_effect = lambda host, name: statuses[name]
+    instances = [make_instance("i-1", "slave1"), make_instance("i-2", "slave2")]
+    assert find_drained(ledger, instances, master_client) == []
+    assert ledger.get("i-1")
+    assert ledger.get("i-2") is None
+
+
+def test_ledger_corrupted(tmpdir):
+    filename = tmpdir.join("drains.json")
+    filename.write("[")
+    assert len(DrainLedger(str(filename))) == 0
+
+
+def test_find_drained():
+    ledger = DrainLedger()
+    ledger.record("i-1", "slave1", "bm1")
+    ledger.record("i-2", "slave2", "bm1")
+    ledger.record("i-3", "slave3", "bm2")
+    ledger.record("i-4", "slave4", "unknown")
+    ledger.record("i-5", "slave5", "bm1")
+    master_client = mock.Mock()
+    master_client.workers = 4
+    master_client.ports = {"bm1": 8001, "bm2": 8002}
+
+    def get_slave(host, name):
+        if host == "bm2":
+            raise IOError("master down")
+        return {"connected": name == "slave2"}
+    master_client.get_slave.side_effect = get_slave
+
+    instances = [make_instance("i-%i" % n, "slave%i" % n)
+                 for n in range(1, 7)]
+    drained = find_drained(ledger, instances[:5], master_client)
+    # slave4's master is unknown, it is left to the checks
+    assert [i.id for i in drained] == ["i-1", "i-5"]
+    assert find_drained(DrainLedger(), instances, master_client) == []
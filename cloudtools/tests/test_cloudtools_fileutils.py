@@ -0,0 +1,21 @@
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
+
+
+def test_versioned_json_roundtrip(tmpdir):
+    filename = str(tmpdir.join("state.json"))
+    save_versioned_json(filename, 2, "slaves", {"slave1": [1, 2]})
+    assert load_versioned_json(filename, 2, "slaves") == {"slave1": [1, 2]}
+    assert load_versioned_json(filename, 2, "slaves", len) == 1
+    # Other versions and missing files are ignored
+    assert load_versioned_json(filename, 1, "slaves") is None
+    assert load_versioned_json(filename + ".missing", 2, "slaves") is None
+
+
+def test_versioned_json_corrupted(tmpdir):
+    f = tmpdir.join("state.json")
+    f.write("{not json")
+    assert load_versioned_json(str(f), 1, "slaves") is None
+    f.write('{"version": 1}')
+    assert load_versioned_json(str(f), 1, "slaves") is None
+    f.write('{"version": 1, "slaves": [1]}')
+    assert load_versioned_json(str(f), 1, "slaves", dict) is None
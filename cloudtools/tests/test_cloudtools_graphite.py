@@ -151,3 +151,59 @@ def test_running_only(setup):
         cloudtools.graphite.generate_instance_stats([i1, i2])
         m_l.add.assert_called_once_with("running.r1.m1.i1.spot.v1.d1",
                                         1, collect=True)
+
+
+def test_timings_span():
+    timings = cloudtools.graphite.Timings()
+    with mock.patch("time.time", side_effect=[10, 12, 20, 21]):
+        with timings.span("phase1"):
+            pass
+        with pytest.raises(ValueError):
+            with timings.span("phase1"):
+                raise ValueError()
+    assert timings.seconds == {"phase1": 3}
+    assert timings.counts == {"phase1": 2}
+
+
+def test_timings_timed():
+    timings = cloudtools.graphite.Timings()
+
+    @timings.timed("phase2")
+    def f(x):
+        return x * 2
+
+    assert f(2) == 4
+    assert f.__name__ == "f"
+    assert timings.counts == {"phase2": 1}
+
+
+def test_timings_report(setup):
+    gl = get_graphite_logger()
+    timings = cloudtools.graphite.Timings()
+    timings.add("phase1", 1.5)
+    timings.add("phase1", 0.5)
+    timings.add("phase2", 3)
+    with mock.patch("time.time", return_value=1111):
+        timings.report(gl)
+    assert gl._data == {"timing.phase1.seconds": (2, 1111),
+                        "timing.phase1.count": (2, 1111),
+                        "timing.phase2.seconds": (3, 1111),
+                        "timing.phase2.count": (1, 1111)}
+    lines = timings.summary().splitlines()
+    assert lines[1].split() == ["phase2", "1", "3.000s", "3.000s"]
+    assert lines[2].split() == ["phase1", "2", "2.000s", "1.000s"]
+    timings.reset()
+    assert timings.counts == {}
+
+
+def test_histogram_report(setup):
+    histogram = cloudtools.graphite.Histogram([5, 1])
+    for value in [0.5, 1, 3, 7]:
+        histogram.observe(value)
+    gl = get_graphite_logger()
+    with mock.patch("time.time", return_value=1111):
+        histogram.report(gl, "latency")
+    assert gl._data == {
+        "latency.le_1": (2, 1111), "latency.le_5": (3, 1111),
+        "latency.le_inf": (4, 1111), "latency.count": (4, 1111),
+        "latency.sum": (11.5, 1111), "latency.max": (7, 1111)}
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from cloudtools.heartbeat import Heartbeat, HeartbeatStore, \
+    HeartbeatCollector, heartbeat_activity, load_heartbeats, send_heartbeat, \
+    follow_log, EVENT_BOOT, STALE_AFTER, BOOT_GRACE, TOKEN_HEADER
+from cloudtools.scripts.buildslave_heartbeat import heartbeat_state
+from cloudtools.twistd_log import LogActivity, EVENT_IDLE, EVENT_RUNNING, \
+    EVENT_SHUTDOWN, ACTIVITY_BOOTING, ACTIVITY_STOPPED
+
+TOKEN = "s3kr1t"
+
+
+@pytest.mark.parametrize("event,event_age,received_age,expected", [
+    (EVENT_RUNNING, 3600, 10, 0),
+    (EVENT_IDLE, 600, 10, 600),
+    (EVENT_SHUTDOWN, 600, 10, ACTIVITY_STOPPED),
+    (EVENT_BOOT, 10, 10, ACTIVITY_BOOTING),
+    (EVENT_BOOT, BOOT_GRACE + 600, 10, BOOT_GRACE + 600),
+    (EVENT_IDLE, 600, STALE_AFTER + 1, None),
+])
+def test_heartbeat_activity(event, event_age, received_age, expected):
+    now = 1000000
+    beat = Heartbeat(event, now - event_age, now - received_age, "bm1")
+    assert heartbeat_activity(beat, now) == expected
+
+
+def test_store_roundtrip(tmpdir):
+    filename = str(tmpdir.join("heartbeats.json"))
+    store = HeartbeatStore(filename)
+    store.record("slave1", EVENT_IDLE, 1000, "bm1")
+    store.save()
+    loaded = HeartbeatStore(filename)
+    assert len(loaded) == 1
+    beat = loaded.get("slave1")
+    assert beat.event == EVENT_IDLE
+    assert beat.event_time == 1000
+    assert beat.master_host == "bm1"
+    assert loaded.get("slave2") is None
+
+
+def test_store_corrupted(tmpdir):
+    filename = tmpdir.join("heartbeats.json")
+    filename.write("{")
+    assert len(HeartbeatStore(str(filename))) == 0
+
+
+@pytest.fixture
+def collector():
+    server = HeartbeatCollector(("127.0.0.1", 0), HeartbeatStore(), TOKEN)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={"poll_interval": 0.05})
+    thread.daemon = True
+    thread.start()
+    yield server, "http://127.0.0.1:%i" % server.server_address[1]
+    server.shutdown()
+
+
+def test_collector(collector):
+    server, url = collector
+    send_heartbeat(url, "slave1", EVENT_RUNNING, 1000, "bm1", token=TOKEN)
+    send_heartbeat(url, "slave2", EVENT_SHUTDOWN, token=TOKEN)
+    assert server.store.get("slave1").event == EVENT_RUNNING
+    store = load_heartbeats(url, TOKEN)
+    assert len(store) == 2
+    assert store.get("slave1").master_host == "bm1"
+    assert store.get("slave2").event_time >= store.get("slave1").event_time
+
+
+def test_collector_bad_event(collector):
+    server, url = collector
+    with pytest.raises(requests.HTTPError):
+        send_heartbeat(url, "slave1", "sleeping", token=TOKEN)
+    r = requests.post(url + "/heartbeat/slave1", data="{",
+                      headers={TOKEN_HEADER: TOKEN})
+    assert r.status_code == 400
+    assert len(server.store) == 0
+
+
+def test_collector_needs_token(collector):
+    server, url = collector
+    for token in (None, "wrong"):
+        with pytest.raises(requests.HTTPError):
+            send_heartbeat(url, "slave1", EVENT_SHUTDOWN, token=token)
+        with pytest.raises(requests.HTTPError):
+            load_heartbeats(url, token)
+    assert len(server.store) == 0
+    with pytest.raises(ValueError):
+        HeartbeatCollector(("127.0.0.1", 0), HeartbeatStore(), None)
+
+
+def test_load_heartbeats_file(tmpdir):
+    filename = str(tmpdir.join("heartbeats.json"))
+    store = HeartbeatStore(filename)
+    store.record("slave1", EVENT_IDLE)
+    store.save()
+    assert load_heartbeats(filename).get("slave1").event == EVENT_IDLE
+
+
+def test_follow_log(tmpdir):
+    logfile = tmpdir.join("twistd.log")
+    logfile.write("2015-01-01 00:00:00-0800 [-] idle\n")
+    sent = []
+    rounds = iter([
+        lambda: None,
+        lambda: logfile.write(
+            "2015-01-01 00:00:05-0800 [Broker,client] "
+            "RunProcess._startCommand\n", mode="a"),
+        lambda: None,
+        # Rotated
+        lambda: (logfile.rename(tmpdir.join("twistd.log.1")),
+                 tmpdir.join("twistd.log").write(
+                     "2015-01-01 00:01:00-0800 [-] Server Shut Down.\n")),
+    ])
+
+    def running():
+        step = next(rounds, None)
+        if step is None:
+            return False
+        step()
+        return True
+
+    follow_log(str(logfile), LogActivity(),
+               lambda a: sent.append(a.event), interval=3600, poll=0,
+               running=running)
+    assert sent == [EVENT_IDLE, EVENT_RUNNING, EVENT_SHUTDOWN]
+
+
+def test_heartbeat_state():
+    boot_time = time.time() - 60
+    activity = LogActivity()
+    assert heartbeat_state(activity, boot_time) == (EVENT_BOOT, boot_time)
+    activity.event, activity.event_time = EVENT_SHUTDOWN, boot_time - 10
+    assert heartbeat_state(activity, boot_time) == (EVENT_BOOT, boot_time)
+    activity.event, activity.event_time = EVENT_IDLE, boot_time + 10
+    assert heartbeat_state(activity, boot_time) == (EVENT_IDLE,
+                                                    boot_time + 10)
@@ -0,0 +1,229 @@
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import mock
+import pytest
+import requests
+
+from cloudtools.masters import MasterActivity, MasterClient, \
+    get_master_slaves, request_shutdown
+
+
+class StubMaster(HTTPServer):
+    """A buildbot master serving /json/slaves. A graceful shutdown
+    disconnects the slave."""
+
+    def __init__(self, slaves):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubMasterHandler)
+        self.slaves = slaves
+        self.requests = []
+        self.port = self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def as_master(self, **kwargs):
+        master = {"hostname": "127.0.0.1", "http_port": self.port}
+        master.update(kwargs)
+        return master
+
+
+class StubMasterHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, data=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        if data is not None:
+            self.wfile.write(json.dumps(data))
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        parts = self.path.strip("/").split("/")
+        if parts == ["json", "slaves"]:
+            self.reply(200, self.server.slaves)
+        elif parts[:2] == ["json", "slaves"] and \
+                parts[2] in self.server.slaves:
+            self.reply(200, self.server.slaves[parts[2]])
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "buildslaves" and parts[2] == "shutdown" and \
+                parts[1] in self.server.slaves:
+            self.server.slaves[parts[1]]["connected"] = False
+            self.reply(302)
+        else:
+            self.reply(404)
+
+
+@pytest.fixture
+def stub_master(request):
+    master = StubMaster({
+        "slave1": {"connected": True, "runningBuilds": [{"number": 1}]},
+        "slave2": {"connected": True, "runningBuilds": []},
+        "slave3": {"connected": False, "runningBuilds": []},
+    })
+    master.start()
+    request.addfinalizer(master.shutdown)
+    return master
+
+
+def test_get_master_slaves(stub_master):
+    slaves = get_master_slaves("127.0.0.1", stub_master.port)
+    assert sorted(slaves) == ["slave1", "slave2", "slave3"]
+
+
+def test_request_shutdown(stub_master):
+    request_shutdown("127.0.0.1", stub_master.port, "slave2")
+    assert stub_master.requests == [
+        ("POST", "/buildslaves/slave2/shutdown")]
+    assert not stub_master.slaves["slave2"]["connected"]
+    with pytest.raises(requests.HTTPError):
+        request_shutdown("127.0.0.1", stub_master.port, "slave9")
+
+
+def test_activity(stub_master):
+    activity = MasterActivity([stub_master.as_master()])
+    with mock.patch("time.time", return_value=1000):
+        assert activity.refresh() == 1
+    assert activity.get("slave1").last_activity == 0
+    # Idle since an unknown time, left to SSH
+    assert activity.get("slave2") is None
+    # Not connected, left to SSH
+    assert activity.get("slave3") is None
+    assert activity.get("slave4") is None
+    with mock.patch("time.time", return_value=1600):
+        assert activity.refresh() == 2
+    # Idle since first seen
+    assert activity.get("slave2").last_activity == 600
+    assert activity.get("slave2").master_port == stub_master.port
+
+
+def test_activity_state(stub_master, tmpdir):
+    state_file = str(tmpdir.join("masters.json"))
+    activity = MasterActivity([stub_master.as_master()], state_file)
+    with mock.patch("time.time", return_value=1000):
+        activity.refresh()
+    activity.save()
+    stub_master.slaves["slave2"]["runningBuilds"] = [{"number": 2}]
+    activity = MasterActivity([stub_master.as_master()], state_file)
+    with mock.patch("time.time", return_value=1600):
+        activity.refresh()
+    assert activity.get("slave2").last_activity == 0
+    stub_master.slaves["slave2"]["runningBuilds"] = []
+    with mock.patch("time.time", return_value=2000):
+        activity.refresh()
+    # The idle time starts over after a build
+    assert activity.get("slave2") is None
+    with mock.patch("time.time", return_value=2300):
+        activity.refresh()
+    assert activity.get("slave2").last_activity == 300
+
+
+def test_activity_build_between_sweeps(stub_master):
+    stub_master.slaves["slave2"]["builders"] = {"b1": [1, 2], "b2": []}
+    activity = MasterActivity([stub_master.as_master()])
+    with mock.patch("time.time", return_value=1000):
+        activity.refresh()
+    with mock.patch("time.time", return_value=1600):
+        activity.refresh()
+    assert activity.get("slave2").last_activity == 600
+    # A whole build ran between two sweeps
+    stub_master.slaves["slave2"]["builders"] = {"b1": [1, 2], "b2": [7]}
+    with mock.patch("time.time", return_value=5000):
+        activity.refresh()
+    assert activity.get("slave2") is None
+    with mock.patch("time.time", return_value=5300):
+        activity.refresh()
+    assert activity.get("slave2").last_activity == 300
+
+
+def test_activity_master_hiccup(stub_master):
+    activity = MasterActivity([stub_master.as_master()])
+    with mock.patch("time.time", return_value=1000):
+        activity.refresh()
+    with mock.patch.object(activity.client, "get_slaves",
+                           side_effect=IOError("timed out")):
+        with mock.patch("time.time", return_value=1600):
+            assert activity.refresh() == 0
+    assert activity.get("slave2") is None
+    # The idle clock survived the failed query
+    with mock.patch("time.time", return_value=2000):
+        activity.refresh()
+    assert activity.get("slave2").last_activity == 1000
+
+
+def test_activity_master_down(stub_master):
+    down = {"hostname": "127.0.0.1", "http_port": 1}
+    disabled = stub_master.as_master(enabled=False)
+    activity = MasterActivity([down, disabled, stub_master.as_master()])
+    assert activity.refresh() == 1
+    assert len(activity.masters) == 2
+
+
+def test_shutdown_and_is_connected(stub_master):
+    activity = MasterActivity([stub_master.as_master()])
+    activity.refresh()
+    activity.refresh()
+    report = activity.get("slave2")
+    assert activity.is_connected(report)
+    activity.shutdown(report)
+    assert not activity.is_connected(report)
+
+
+def test_client_master_lookup(stub_master):
+    client = MasterClient([stub_master.as_master(hostname="bm1")])
+    lookup = mock.Mock(return_value="bm1")
+    assert client.get_master("slave1", lookup) == ("bm1", stub_master.port)
+    # Cached
+    assert client.get_master("slave1", lookup) == ("bm1", stub_master.port)
+    assert lookup.call_count == 1
+    with pytest.raises(AssertionError):
+        client.get_master("slave2")
+    client.attach("slave2", "bm2")
+    with pytest.raises(AssertionError):
+        client.get_master("slave2")
+
+
+def test_client_session_per_master(stub_master):
+    client = MasterClient([stub_master.as_master(),
+                           {"hostname": "bm2", "http_port": 8001}])
+    session = client.session("127.0.0.1")
+    assert client.session("127.0.0.1") is session
+    assert client.session("bm2") is not session
+    with mock.patch.object(session, "get", wraps=session.get) as m_get:
+        assert "slave1" in client.get_slaves("127.0.0.1")
+        assert client.get_slave("127.0.0.1", "slave2")["connected"]
+    assert m_get.call_count == 2
+
+
+def test_client_shutdown_many(stub_master):
+    client = MasterClient([stub_master.as_master()])
+    client.attach("slave1", "127.0.0.1")
+    client.attach("slave2", "127.0.0.1")
+    client.defer_shutdown("slave1")
+    client.defer_shutdown("slave2")
+    # Not attached to a known master
+    client.defer_shutdown("slave4")
+    assert client.flush_shutdowns() == ["slave4"]
+    assert sorted(stub_master.requests) == [
+        ("POST", "/buildslaves/slave1/shutdown"),
+        ("POST", "/buildslaves/slave2/shutdown")]
+    assert client.flush_shutdowns() == []
+
+
+def test_activity_attaches_slaves(stub_master):
+    activity = MasterActivity([stub_master.as_master()])
+    activity.refresh()
+    assert activity.client.get_master("slave2") == ("127.0.0.1",
+                                                    stub_master.port)
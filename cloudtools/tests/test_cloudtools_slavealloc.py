@@ -1,6 +1,11 @@
+import json
+import os
+import time
 import pytest
 import mock
-from cloudtools.slavealloc import slave_moz_type, get_classified_slaves
+import cloudtools.slavealloc
+from cloudtools.slavealloc import slave_moz_type, get_classified_slaves, \
+    get_slaves_index, refresh_slaves_json, invalidate_classified_slaves_cache
 
 
 def test_bld_linux64():
@@ -132,16 +137,128 @@ def example_data(request):
     return j
 
 
-@mock.patch("cloudtools.slavealloc.get_slaves_json")
-def test_bld_spot(m, example_data):
+@mock.patch("cloudtools.slavealloc.refresh_slaves_json")
+@mock.patch("cloudtools.slavealloc.read_slaves_json")
+def test_bld_spot(m, refresh, example_data):
     m.return_value = example_data
     slaves = get_classified_slaves(True)
     assert slaves == {'bld-linux64': {'us-west-2': set(['slave-spot-1'])},
                       'tst-emulator64': {'us-west-2': set(['slave-spot-3'])}}
 
 
-@mock.patch("cloudtools.slavealloc.get_slaves_json")
-def test_bld_ondemand(m, example_data):
+@mock.patch("cloudtools.slavealloc.refresh_slaves_json")
+@mock.patch("cloudtools.slavealloc.read_slaves_json")
+def test_bld_ondemand(m, refresh, example_data):
     m.return_value = example_data
     slaves = get_classified_slaves(False)
     assert slaves == {'bld-linux64': {'us-west-2': set(['slave-1'])}}
+
+
+def test_unknown_type():
+    slave = {
+        "name": "av-linux64-spot-001",
+        "bitlength": "64",
+        "environment": "prod",
+        "distro": "centos6-mock",
+        "purpose": "build",
+        "trustlevel": "try"
+    }
+    assert slave_moz_type(slave) == "try-linux64"
+    slave["distro"] = "ubuntu64"
+    assert slave_moz_type(slave) is None
+
+
+@pytest.fixture
+def cache(tmpdir, request):
+    cloudtools.slavealloc.set_cache_dir(str(tmpdir))
+    request.addfinalizer(
+        lambda: cloudtools.slavealloc.set_cache_dir(
+            cloudtools.slavealloc.DEFAULT_CACHE_DIR))
+    return str(tmpdir.join("slaves.json"))
+
+
+def make_response(status_code, content="", headers=None):
+    return mock.Mock(status_code=status_code, content=content,
+                     headers=headers or {})
+
+
+@mock.patch("requests.get")
+def test_refresh_conditional(get, cache):
+    get.return_value = make_response(
+        200, "[]", {"etag": '"v1"',
+                    "last-modified": "Mon, 01 Jun 2015 00:00:00 GMT"})
+    refresh_slaves_json("url", cache)
+    assert open(cache).read() == "[]"
+    assert get.call_args[1]["headers"] == {}
+
+    # Fresh cache, no request
+    refresh_slaves_json("url", cache)
+    assert get.call_count == 1
+
+    meta = json.load(open(cache + ".meta"))
+    meta["meta"]["checked_at"] = 0
+    json.dump(meta, open(cache + ".meta", "w"))
+    get.return_value = make_response(304)
+    refresh_slaves_json("url", cache)
+    assert get.call_args[1]["headers"] == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "Mon, 01 Jun 2015 00:00:00 GMT"}
+    assert open(cache).read() == "[]"
+    assert json.load(open(cache + ".meta"))["meta"]["checked_at"] > 0
+
+
+@mock.patch("requests.get")
+def test_refresh_failure_keeps_file(get, cache):
+    with open(cache, "w") as f:
+        f.write("[]")
+    get.return_value = make_response(500)
+    get.return_value.raise_for_status.side_effect = Exception("boom")
+    refresh_slaves_json("url", cache)
+    assert open(cache).read() == "[]"
+    assert os.listdir(os.path.dirname(cache)) == ["slaves.json"]
+
+
+@mock.patch("cloudtools.slavealloc.refresh_slaves_json")
+def test_index_reused(refresh, cache, example_data):
+    with open(cache, "w") as f:
+        json.dump(example_data, f)
+    index = get_slaves_index("url", cache)
+    assert index["spot"] == {"bld-linux64": {"us-west-2": ["slave-spot-1"]},
+                             "tst-emulator64": {"us-west-2": ["slave-spot-3"]}}
+
+    with mock.patch("cloudtools.slavealloc.read_slaves_json") as read:
+        assert get_slaves_index("url", cache) == index
+        assert not read.called
+
+    # A new slaves.json invalidates the index
+    with open(cache, "w") as f:
+        json.dump(example_data[:1], f)
+    os.utime(cache, (time.time() + 10, time.time() + 10))
+    assert get_slaves_index("url", cache)["ondemand"] == {}
+
+
+@mock.patch("cloudtools.slavealloc.refresh_slaves_json")
+def test_index_rebuilt_on_rules_change(refresh, cache, example_data):
+    with open(cache, "w") as f:
+        json.dump(example_data, f)
+    index = get_slaves_index("url", cache)
+    assert "tst-emulator64" in index["spot"]
+
+    rules = [r for r in cloudtools.slavealloc.SLAVE_MOZ_TYPE_RULES
+             if r[0] != "tst-emulator64"]
+    with mock.patch("cloudtools.slavealloc.SLAVE_MOZ_TYPE_RULES", rules), \
+            mock.patch.dict("cloudtools.slavealloc._candidate_rules", clear=True):
+        assert "tst-emulator64" not in get_slaves_index("url", cache)["spot"]
+
+
+@mock.patch("cloudtools.slavealloc.refresh_slaves_json")
+def test_classified_slaves_cache_dir(refresh, cache, example_data):
+    with open(cache, "w") as f:
+        json.dump(example_data, f)
+    invalidate_classified_slaves_cache()
+    try:
+        assert get_classified_slaves(False) == {
+            "bld-linux64": {"us-west-2": set(["slave-1"])}}
+        assert refresh.call_args[0][1] == cache
+    finally:
+        invalidate_classified_slaves_cache()
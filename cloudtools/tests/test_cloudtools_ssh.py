@@ -30,7 +30,7 @@ def test_get_stdout(m_exec_command):
     stdout.read.return_value = "out1"
     m_exec_command.return_value = stdin, stdout, None
     out = ssh_client.get_stdout("my command")
-    m_exec_command.assert_called_once_with("my command")
+    m_exec_command.assert_called_once_with("my command", timeout=60)
     stdin.close.assert_called_once_with()
     stdout.read.assert_called_once_with()
     assert out == "out1"
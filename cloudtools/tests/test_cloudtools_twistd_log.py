@@ -0,0 +1,146 @@
+import subprocess
+import time
+
+import mock
+import pytest
+
+from cloudtools.twistd_log import LogActivity, LogCursor, LogCursorStore, \
+    read_chunk, update_activity, log_probe_command, get_log_stats, \
+    reset_log_stats, parse_timestamp, EVENT_IDLE, EVENT_RUNNING, \
+    EVENT_SHUTDOWN, ACTIVITY_BOOTING, ACTIVITY_STOPPED
+
+
+@pytest.fixture
+def twistd_log(tmpdir):
+    log_file = tmpdir.join("twistd.log")
+    with mock.patch("cloudtools.twistd_log.TWISTD_LOG", str(log_file)):
+        yield log_file
+
+
+def run_probe(cursor=None):
+    output = subprocess.check_output(["sh", "-c", log_probe_command(cursor)])
+    return read_chunk(output, cursor)
+
+
+def test_activity_feed():
+    activity = LogActivity()
+    activity.feed(["2015-01-01 11:50:00+0000 [-] RunProcess._startCommand"])
+    assert activity.event == EVENT_RUNNING
+    activity.feed(["2015-01-01 11:55:00+0000 [-] commandComplete",
+                   "no timestamp"])
+    assert activity.event == EVENT_IDLE
+    idle_since = activity.event_time
+    activity.feed(["2015-01-01 11:56:00+0000 [-] I have a leftover directory"])
+    assert activity.event_time == idle_since
+    assert activity.last_time == idle_since + 60
+    activity.feed(["2015-01-01 11:57:00+0000 [-] Server Shut Down."])
+    assert activity.event == EVENT_SHUTDOWN
+    assert LogActivity.from_dict(activity.to_dict()).to_dict() == \
+        activity.to_dict()
+
+
+def test_activity_feed_bytes():
+    data = ("2015-01-01 11:50:00+0000 [-] RunProcess._startCommand\n"
+            "2015-01-01 11:55:00+0000 [-] commandComplete\n"
+            "2015-01-01 11:56:00+0000 [-] keepalive")
+    activity = LogActivity()
+    for n in range(0, len(data), 7):
+        activity.feed_bytes(data[n:n + 7])
+    assert activity.event == EVENT_IDLE
+    assert activity.event_time == parse_timestamp("2015-01-01 11:55:00")
+    # The last line is incomplete until close()
+    assert activity.last_line.endswith("commandComplete")
+    activity.close()
+    assert activity.last_line.endswith("keepalive")
+
+
+def test_activity_last_activity():
+    slave_time = parse_timestamp("2015-01-01 12:00:00")
+    activity = LogActivity()
+    assert activity.last_activity(slave_time, 3600) is None
+    activity.feed(["2015-01-01 11:55:00+0000 [-] keepalive"])
+    assert activity.last_activity(slave_time, 3600) == 300
+    activity.feed(["2015-01-01 11:56:00+0000 [-] using PTY: False"])
+    assert activity.last_activity(slave_time, 3600) == 0
+    activity.feed(["2015-01-01 11:57:00+0000 [-] Server Shut Down."])
+    assert activity.last_activity(slave_time, 3600) == ACTIVITY_STOPPED
+    # Shut down before the slave booted
+    assert activity.last_activity(slave_time, 60) == ACTIVITY_BOOTING
+
+
+def test_parse_timestamp():
+    assert parse_timestamp("2015-06-01 10:20:30") == time.mktime(
+        time.strptime("2015-06-01 10:20:30", "%Y-%m-%d %H:%M:%S"))
+
+
+def test_read_chunk_partial_line():
+    chunk = read_chunk("12 30 incremental\nline1\nline2\npart",
+                       LogCursor("12", 100, None))
+    assert chunk.data == "line1\nline2\n"
+    assert chunk.offset == 112
+    assert chunk.incremental
+
+
+def test_read_chunk_missing_log():
+    chunk = read_chunk(" full\n")
+    assert chunk.inode is None
+    assert chunk.offset == 0
+    assert not chunk.incremental
+
+
+def test_probe_incremental(twistd_log):
+    reset_log_stats()
+    twistd_log.write("2015-01-01 11:50:00+0000 [-] RunProcess._startCommand\n")
+    chunk = run_probe()
+    assert not chunk.incremental
+    activity, cursor = update_activity(chunk)
+    assert activity.event == EVENT_RUNNING
+    assert cursor.offset == twistd_log.size()
+
+    # Nothing new
+    chunk = run_probe(cursor)
+    assert chunk.incremental
+    assert chunk.data == ""
+
+    twistd_log.write("2015-01-01 11:55:00+0000 [-] commandComplete\n2015-",
+                     mode="a")
+    chunk = run_probe(cursor)
+    assert chunk.incremental
+    assert chunk.data == "2015-01-01 11:55:00+0000 [-] commandComplete\n"
+    activity, cursor = update_activity(chunk, cursor)
+    assert activity.event == EVENT_IDLE
+    # The partial line is read next time
+    assert cursor.offset == twistd_log.size() - len("2015-")
+    assert get_log_stats()["incremental"] == 2
+
+
+def test_probe_rotated(twistd_log):
+    twistd_log.write("2015-01-01 11:50:00+0000 [-] RunProcess._startCommand\n")
+    _, cursor = update_activity(run_probe())
+    twistd_log.rename(twistd_log.dirpath("twistd.log.1"))
+    twistd_log.write("2015-01-01 11:55:00+0000 [-] commandComplete\n")
+    chunk = run_probe(cursor)
+    assert not chunk.incremental
+    assert chunk.data.count("\n") == 2
+    activity, cursor = update_activity(chunk, cursor)
+    assert activity.event == EVENT_IDLE
+    assert cursor.offset == twistd_log.size()
+
+
+def test_cursor_store(tmpdir):
+    filename = str(tmpdir.join("cursors.json"))
+    store = LogCursorStore(filename)
+    store.set("i-1", LogCursor("12", 100, LogActivity().to_dict()))
+    store.set("i-2", LogCursor("13", 10, None))
+    store.prune(["i-1"])
+    store.save()
+    store = LogCursorStore(filename)
+    assert len(store) == 1
+    assert store.get("i-1") == LogCursor("12", 100, LogActivity().to_dict())
+    assert store.get("i-2") is None
+
+
+def test_cursor_store_corrupted(tmpdir):
+    filename = tmpdir.join("cursors.json")
+    filename.write("{")
+    assert len(LogCursorStore(str(filename))) == 0
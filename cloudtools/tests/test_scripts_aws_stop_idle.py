@@ -0,0 +1,267 @@
+import time
+
+import mock
+
+from cloudtools.drains import DrainLedger
+from cloudtools.graphite import Histogram
+from cloudtools.heartbeat import HeartbeatStore
+from cloudtools.masters import SlaveReport
+from cloudtools.buildbot import ACTIVITY_BOOTING, ACTIVITY_STOPPED
+from cloudtools.scripts.aws_stop_idle import check_instances, \
+    aws_safe_stop_instance, schedule_instances, stop_priority, \
+    get_launch_time
+from cloudtools.twistd_log import EVENT_IDLE, EVENT_SHUTDOWN
+
+
+def make_instance(name):
+    i = mock.Mock()
+    i.tags = {"Name": name}
+    return i
+
+
+def test_check_instances():
+    instances = [make_instance("i%i" % n) for n in range(20)]
+
+    def check(i):
+        if i.tags["Name"] == "i3":
+            raise Exception("ssh failed")
+        return int(i.tags["Name"][1:]) % 2 == 1
+
+    latency = Histogram([1])
+    stopped = check_instances(instances, check, concurrency=4,
+                              latency=latency)
+    assert sorted(i.tags["Name"] for i in stopped) == \
+        sorted("i%i" % n for n in range(1, 20, 2) if n != 3)
+    # Failed checks are timed too
+    assert latency.count == 20
+
+
+def test_check_instances_empty():
+    assert check_instances([], lambda i: True) == []
+
+
+def make_ondemand_instance(name, launched_ago=3600):
+    i = make_instance(name)
+    i.spot_instance_request_id = None
+    i.launch_time = time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                                  time.gmtime(time.time() - launched_ago))
+    return i
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_stop_reported_by_master(m_ssh):
+    i = make_ondemand_instance("slave1")
+    master_activity = mock.Mock()
+    master_activity.get.return_value = SlaveReport("slave1", "bm1", 8001,
+                                                   600)
+    master_activity.is_connected.return_value = False
+    assert aws_safe_stop_instance(i, [], "u", "k", [],
+                                  master_activity=master_activity)
+    master_activity.shutdown.assert_called_once_with(
+        master_activity.get.return_value)
+    i.terminate.assert_called_once_with()
+    assert not m_ssh.called
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_busy_reported_by_master(m_ssh):
+    i = make_ondemand_instance("slave1")
+    master_activity = mock.Mock()
+    master_activity.get.return_value = SlaveReport("slave1", "bm1", 8001, 0)
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity)
+    assert not master_activity.shutdown.called
+    assert not i.terminate.called
+    assert not m_ssh.called
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_not_reported_by_master(m_ssh):
+    i = make_ondemand_instance("slave1")
+    master_activity = mock.Mock()
+    master_activity.get.return_value = None
+    m_ssh.return_value.connect.return_value = None
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity)
+    assert m_ssh.called
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_stop_by_heartbeat(m_ssh):
+    i = make_ondemand_instance("slave1")
+    heartbeats = HeartbeatStore()
+    heartbeats.record("slave1", EVENT_IDLE, time.time() - 7200, "bm1")
+    master_activity = mock.Mock()
+    master_client = mock.Mock()
+    master_client.ports = {"bm1": 8001}
+    master_client.get_slave.return_value = {"connected": False}
+    # The shutdown shows up in a later heartbeat
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client)
+    master_client.attach.assert_called_once_with("slave1", "bm1")
+    master_client.defer_shutdown.assert_called_once_with("slave1")
+    heartbeats.record("slave1", EVENT_SHUTDOWN, None, "bm1")
+    assert aws_safe_stop_instance(i, [], "u", "k", [],
+                                  master_activity=master_activity,
+                                  heartbeats=heartbeats,
+                                  master_client=master_client)
+    i.terminate.assert_called_once_with()
+    # Confirmed with the master
+    master_client.get_slave.assert_called_once_with("bm1", "slave1")
+    assert not master_activity.get.called
+    assert not m_ssh.called
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_unconfirmed_shutdown_heartbeat(m_ssh):
+    i = make_ondemand_instance("slave1")
+    heartbeats = HeartbeatStore()
+    heartbeats.record("slave1", EVENT_SHUTDOWN, None, "bm1")
+    master_activity = mock.Mock()
+    master_activity.get.return_value = SlaveReport("slave1", "bm1", 8001, 0)
+    master_client = mock.Mock()
+    master_client.ports = {"bm1": 8001}
+    master_client.get_slave.return_value = {"connected": True}
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client)
+    assert not i.terminate.called
+    # Left to the master report
+    assert master_activity.get.called
+    # Unknown master
+    heartbeats.record("slave1", EVENT_SHUTDOWN, None, "bm9")
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client)
+    assert not i.terminate.called
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_long_idle_heartbeat_needs_master(m_ssh):
+    i = make_ondemand_instance("slave1")
+    heartbeats = HeartbeatStore()
+    heartbeats.record("slave1", EVENT_IDLE, time.time() - 9 * 3600, "bm1")
+    master_activity = mock.Mock()
+    master_activity.get.return_value = None
+    m_ssh.return_value.connect.return_value = None
+    master_client = mock.Mock()
+    master_client.ports = {"bm1": 8001}
+    master_client.get_slave.return_value = {"connected": True,
+                                            "runningBuilds": [{}]}
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client)
+    assert not i.terminate.called
+    assert not master_client.defer_shutdown.called
+    # Left to the master report and SSH
+    assert master_activity.get.called
+    assert m_ssh.called
+    # Unknown master
+    heartbeats.record("slave1", EVENT_IDLE, time.time() - 9 * 3600, "bm9")
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      heartbeats=heartbeats,
+                                      master_client=master_client)
+    assert not i.terminate.called
+    # Confirmed by the master
+    master_client.get_slave.return_value = {"connected": True,
+                                            "runningBuilds": []}
+    heartbeats.record("slave1", EVENT_IDLE, time.time() - 9 * 3600, "bm1")
+    assert aws_safe_stop_instance(i, [], "u", "k", [],
+                                  master_activity=master_activity,
+                                  heartbeats=heartbeats,
+                                  master_client=master_client)
+    i.terminate.assert_called_once_with()
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_stale_heartbeat(m_ssh):
+    i = make_ondemand_instance("slave1")
+    heartbeats = HeartbeatStore()
+    heartbeats.record("slave1", EVENT_IDLE, None, "bm1")
+    beat = heartbeats.get("slave1")
+    heartbeats._beats["slave1"] = beat._replace(
+        received_at=beat.received_at - 3600)
+    m_ssh.return_value.connect.return_value = None
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      heartbeats=heartbeats)
+    assert m_ssh.called
+
+
+def make_spot_instance(name, minutes_into_hour):
+    i = make_ondemand_instance(name, 3600 + minutes_into_hour * 60 + 30)
+    i.spot_instance_request_id = "sir-%s" % name
+    return i
+
+
+def test_schedule_instances():
+    young = make_ondemand_instance("young", launched_ago=60)
+    spot_early = make_spot_instance("spot_early", 10)
+    spot_46 = make_spot_instance("spot_46", 46)
+    spot_58 = make_spot_instance("spot_58", 58)
+    idle = make_ondemand_instance("idle")
+    busy = make_ondemand_instance("busy")
+    unknown = make_ondemand_instance("unknown")
+    impaired = make_ondemand_instance("impaired", launched_ago=60)
+    impaired.id = "i-impaired"
+    activity = {"idle": 3600, "busy": 0, "spot_46": 3600, "spot_58": 3600}
+    instances = [young, spot_early, busy, unknown, spot_46, idle, spot_58,
+                 impaired]
+    scheduled = schedule_instances(instances, ["i-impaired"], activity.get)
+    assert [i.tags["Name"] for i in scheduled] == [
+        "spot_58", "impaired", "spot_46", "idle", "unknown", "busy"]
+
+
+def test_stop_priority_booting():
+    i = make_ondemand_instance("slave1")
+    assert stop_priority(i, get_launch_time(i), ACTIVITY_BOOTING) is None
+    assert stop_priority(i, get_launch_time(i), ACTIVITY_STOPPED) == 1.0
+
+
+def test_check_instances_deadline():
+    instances = [make_instance("i%i" % n) for n in range(10)]
+    checked = []
+
+    def check(i):
+        checked.append(i.tags["Name"])
+        time.sleep(0.2)
+        return True
+
+    stopped = check_instances(instances, check, concurrency=2,
+                              deadline=time.time() + 0.1)
+    # Started before the deadline, in order
+    assert checked == ["i0", "i1"]
+    assert sorted(i.tags["Name"] for i in stopped) == ["i0", "i1"]
+
+
+@mock.patch("cloudtools.scripts.aws_stop_idle.SSHClient")
+def test_drain_recorded(m_ssh):
+    i = make_ondemand_instance("slave1")
+    i.id = "i-1"
+    master_activity = mock.Mock()
+    master_activity.get.return_value = SlaveReport("slave1", "bm1", 8001,
+                                                   600)
+    master_activity.is_connected.return_value = True
+    master_client = mock.Mock()
+    master_client.get_attached.return_value = "bm1"
+    drains = DrainLedger()
+    terminate = mock.Mock()
+    assert not aws_safe_stop_instance(i, [], "u", "k", [],
+                                      master_activity=master_activity,
+                                      master_client=master_client,
+                                      drains=drains, terminate=terminate)
+    assert drains.get("i-1")[:2] == ("slave1", "bm1")
+    assert not terminate.called
+    # Drained right away
+    master_activity.is_connected.return_value = False
+    assert aws_safe_stop_instance(i, [], "u", "k", [],
+                                  master_activity=master_activity,
+                                  master_client=master_client,
+                                  drains=drains, terminate=terminate)
+    terminate.assert_called_once_with(i)
+    assert not i.terminate.called
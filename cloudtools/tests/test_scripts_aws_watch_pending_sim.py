@@ -0,0 +1,149 @@
+import time
+
+import mock
+
+from cloudtools.aws import load_instance_config
+from cloudtools.aws.fake_ec2 import FakeEC2, format_aws_time
+from cloudtools.aws.inventory import Inventory
+from cloudtools.graphite import Timings
+from cloudtools.scripts import aws_watch_pending
+from cloudtools.scripts.aws_watch_pending_sim import replay_cycle, \
+    record_cycle, replay_environment, RECORDING_VERSION
+
+REGION = "us-east-1"
+CONFIG = {
+    "buildermap": {"^Ubuntu VM 12.04 x64": "tst-linux64"},
+    "region_priorities": {REGION: 1},
+    "spot": {
+        "rules": {"tst-linux64": [{"instance_type": "m1.medium",
+                                   "bid_price": 0.1,
+                                   "performance_constant": 1}]},
+        "limits": {REGION: {"tst-linux64": 10}},
+    },
+    "ondemand": {},
+}
+
+
+def make_recording():
+    now = time.time()
+    subnet_ids = load_instance_config("tst-linux64")[REGION]["subnet_ids"]
+    return {
+        "version": RECORDING_VERSION,
+        "recorded_at": now,
+        "regions": [REGION],
+        "config": CONFIG,
+        "pending": [["Ubuntu VM 12.04 x64 try opt test mochitest-1", 3],
+                    ["WINNT 5.2 try build", 2]],
+        "slaves": [
+            {"name": "tst-linux64-spot-%03i" % i, "datacenter": REGION,
+             "enabled": True, "bitlength": "64", "environment": "prod",
+             "distro": "ubuntu64", "purpose": "tests", "speed": "m1.medium",
+             "trustlevel": "try"}
+            for i in range(5)],
+        "ec2": {REGION: {
+            "zones": ["us-east-1a", "us-east-1c"],
+            "subnets": [
+                {"id": subnet_ids[0], "availability_zone": "us-east-1a",
+                 "available_ip_address_count": 100},
+                {"id": subnet_ids[1], "availability_zone": "us-east-1c",
+                 "available_ip_address_count": 100},
+            ],
+            "images": [
+                {"id": "ami-1", "name": "spot-tst-linux64-1",
+                 "state": "available",
+                 "tags": {"moz-type": "tst-linux64", "moz-created": "1",
+                          "Name": "spot-tst-linux64-1"},
+                 "root_device_type": "ebs", "root_device_name": "/dev/sda1",
+                 "virtualization_type": "hvm",
+                 "block_device_mapping": {"/dev/sda1": {"size": 20}}}],
+            "instances": [],
+            "spot_requests": [],
+            "spot_prices": [
+                {"availability_zone": "us-east-1a",
+                 "instance_type": "m1.medium",
+                 "product_description": "Linux/UNIX (Amazon VPC)",
+                 "price": 0.02, "timestamp": format_aws_time(now - 60)},
+                {"availability_zone": "us-east-1c",
+                 "instance_type": "m1.medium",
+                 "product_description": "Linux/UNIX (Amazon VPC)",
+                 "price": 0.01, "timestamp": format_aws_time(now - 60)},
+            ],
+        }},
+    }
+
+
+def test_replay_cycle():
+    result = replay_cycle(make_recording())
+    decisions = result["decisions"]
+    assert len(decisions) == 3
+    assert set(d["availability_zone"] for d in decisions) == \
+        set(["us-east-1c"])
+    assert set(d["moz_instance_type"] for d in decisions) == \
+        set(["tst-linux64"])
+    assert len(set(d["name"] for d in decisions)) == 3
+    assert result["api_calls"]["us-east-1.request_spot_instances"] == 3
+    assert result["phases"]["plan_spot_launches"]["calls"] == 1
+    assert result["phases"]["execute_spot_plan"]["calls"] == 1
+    assert result["metrics"]["pending"] == 5
+    assert result["metrics"]["timing.find_pending.count"] == 1
+    assert result["metrics"]["timing.launch_spot_instance.count"] == 3
+    # Nothing is throttled, so launching does not sleep
+    assert result["simulated_sleep"] == 0
+
+
+def test_running_ondemand_launch_not_in_flight():
+    recording = make_recording()
+    subnet_ids = load_instance_config("tst-linux64")[REGION]["subnet_ids"]
+    recording["ec2"][REGION]["instances"] = [{
+        "id": "i-ondemand", "state": "running",
+        "tags": {"moz-type": "tst-linux64", "moz-state": "ready",
+                 "Name": "tst-linux64-ec2-001"},
+        "instance_type": "m1.medium", "image_id": "ami-1",
+        "launch_time": format_aws_time(recording["recorded_at"] - 60),
+        "spot_instance_request_id": None, "placement": "us-east-1a",
+        "subnet_id": subnet_ids[0], "private_ip_address": "10.0.0.1",
+        "virtualization_type": "hvm", "root_device_type": "ebs"}]
+    # Launched during the previous cycle and already running
+    inventory = Inventory([REGION])
+    inventory.record_launches("tst-linux64", ["i-ondemand"])
+    ec2 = FakeEC2(recording["ec2"], recorded_at=recording["recorded_at"])
+    with replay_environment(ec2, recording, Timings()):
+        aws_watch_pending.aws_watch_pending(
+            dburl=None, regions=[REGION],
+            builder_map=CONFIG["buildermap"],
+            region_priorities=CONFIG["region_priorities"],
+            spot_config=CONFIG["spot"], ondemand_config=CONFIG["ondemand"],
+            dryrun=False, latest_ami_percentage=100, inventory=inventory)
+    # The running on-demand instance doesn't hold back spot demand
+    assert len(ec2.decisions()) == 3
+
+
+def test_replay_cycle_is_repeatable():
+    recording = make_recording()
+    first = replay_cycle(recording)
+    second = replay_cycle(recording)
+    assert [(d["name"], d["availability_zone"]) for d in first["decisions"]] \
+        == [(d["name"], d["availability_zone"]) for d in second["decisions"]]
+
+
+def test_replay_cycle_dryrun():
+    result = replay_cycle(make_recording(), dryrun=True)
+    assert result["decisions"] == []
+    assert "us-east-1.request_spot_instances" not in result["api_calls"]
+
+
+def test_record_cycle_round_trip():
+    recording = make_recording()
+    replayed = replay_cycle(recording)
+    ec2 = FakeEC2(recording["ec2"], recorded_at=recording["recorded_at"])
+    with replay_environment(ec2, recording, Timings()):
+        with mock.patch(
+                "cloudtools.scripts.aws_watch_pending_sim.find_pending",
+                return_value=recording["pending"]):
+            recorded = record_cycle("sqlite://", [REGION], CONFIG)
+    assert recorded["pending"] == recording["pending"]
+    assert recorded["slaves"] == recording["slaves"]
+    assert len(recorded["ec2"][REGION]["spot_prices"]) == 2
+    assert [(d["name"], d["availability_zone"])
+            for d in replay_cycle(recorded)["decisions"]] == \
+        [(d["name"], d["availability_zone"]) for d in replayed["decisions"]]
@@ -0,0 +1,263 @@
+"""
+Incremental reading of buildbot slave twistd.log files.
+
+Idle checks derive the last activity of a slave from its twistd.log. A
+LogCursor remembers, per instance, the inode and the offset read up to and
+the LogActivity derived so far, so that the next probe only transfers and
+parses the bytes appended since. When the log was rotated or truncated,
+the probe falls back to the tail of twistd.log.1 and twistd.log.
+
+LogActivity is a streaming parser: it takes byte chunks, which may split
+lines, only looks at lines starting with a timestamp and converts each
+distinct timestamp once. See benchmarks/bench_twistd_log.py.
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from cloudtools.fileutils import load_versioned_json, save_versioned_json
+
+log = logging.getLogger(__name__)
+
+TWISTD_LOG = "/builds/slave/twistd.log"
+# Lines of twistd.log.1 and twistd.log read without a usable cursor
+TAIL_LINES = 1000
+# The first output line is "<inode> <size> <incremental|full>". Bytes
+# appended after the stat are left for the next probe.
+LOG_PROBE_COMMAND = (
+    "f={log}; set -- $(stat -c '%i %s' $f 2>/dev/null); "
+    "if [ \"$1\" = '{inode}' ] && [ \"$2\" -ge {offset} ]; then "
+    "echo \"$1 $2 incremental\"; "
+    "tail -c +{start} $f | head -c $(($2 - {offset})); "
+    "else echo \"$1 $2 full\"; tail -n {lines} $f.1 2>/dev/null; "
+    "head -c \"$2\" $f 2>/dev/null | tail -n {lines}; fi")
+CURSORS_VERSION = 1
+
+ACTIVITY_BOOTING, ACTIVITY_STOPPED = ("booting", "stopped")
+EVENT_SHUTDOWN, EVENT_RUNNING, EVENT_IDLE = ("shutdown", "running", "idle")
+# Converted timestamps kept, log lines share a second more often than not
+TIMESTAMP_CACHE_SIZE = 10000
+
+LogCursor = namedtuple("LogCursor", ["inode", "offset", "state"])
+LogChunk = namedtuple("LogChunk", ["data", "inode", "offset", "incremental"])
+
+_timestamp_re = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+_timestamp_cache = {}
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def parse_timestamp(timestamp):
+    """Returns the epoch of a "%Y-%m-%d %H:%M:%S" local time"""
+    try:
+        return _timestamp_cache[timestamp]
+    except KeyError:
+        pass
+    if len(_timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        _timestamp_cache.clear()
+    # Fixed width fields, much cheaper than strptime
+    t = time.mktime((int(timestamp[0:4]), int(timestamp[5:7]),
+                     int(timestamp[8:10]), int(timestamp[11:13]),
+                     int(timestamp[14:16]), int(timestamp[17:19]), 0, 0, -1))
+    _timestamp_cache[timestamp] = t
+    return t
+
+
+def _count(**values):
+    with _stats_lock:
+        _stats.update(values)
+
+
+def get_log_stats():
+    """Returns the number of full and incremental log reads, the bytes
+    transferred and the seconds spent parsing them"""
+    with _stats_lock:
+        rv = dict.fromkeys(["full", "incremental", "bytes", "parse_seconds"],
+                           0)
+        rv.update(_stats)
+        return rv
+
+
+def reset_log_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class LogActivity(object):
+    """The last event seen in twistd.log lines. Lines can be fed in
+    several batches, the state survives between probes as a dict."""
+
+    def __init__(self, running_command=False, event=None, event_time=None,
+                 last_time=None, last_line=""):
+        self.running_command = running_command
+        self.event = event
+        self.event_time = event_time
+        # Time of the last line with a timestamp
+        self.last_time = last_time
+        self.last_line = last_line
+        # Incomplete line at the end of the last chunk
+        self._partial = ""
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(**state)
+
+    def to_dict(self):
+        return dict(running_command=self.running_command, event=self.event,
+                    event_time=self.event_time, last_time=self.last_time,
+                    last_line=self.last_line)
+
+    def feed_bytes(self, chunk):
+        """Feeds a chunk of the log. A line split between chunks is parsed
+        once complete, or by close()."""
+        lines = (self._partial + chunk).split("\n")
+        self._partial = lines.pop()
+        self.feed(lines)
+
+    def close(self):
+        if self._partial:
+            self.feed([self._partial])
+            self._partial = ""
+
+    def feed(self, lines):
+        # The state is kept in locals while looping, this is the hot path
+        # of idle checks
+        timestamp_match = _timestamp_re.match
+        running_command = self.running_command
+        event, event_time = self.event, self.event_time
+        t, last_line = self.last_time, self.last_line
+        timestamp = None
+        for line in lines:
+            m = timestamp_match(line)
+            if not m:
+                # Not sure what to do with this line...
+                continue
+            if m.group() != timestamp:
+                timestamp = m.group()
+                t = parse_timestamp(timestamp)
+            last_line = line
+
+            if "RunProcess._startCommand" in line or "using PTY: " in line:
+                running_command = True
+            elif "commandComplete" in line or "stopCommand" in line:
+                running_command = False
+
+            if "Shut Down" in line:
+                event = EVENT_SHUTDOWN
+            elif "I have a leftover directory" in line:
+                # Ignore this, it doesn't indicate anything
+                continue
+            elif running_command:
+                # We're in the middle of running something
+                event = EVENT_RUNNING
+            else:
+                event = EVENT_IDLE
+            event_time = t
+        self.running_command = running_command
+        self.event, self.event_time = event, event_time
+        self.last_time, self.last_line = t, last_line.strip()
+
+    def last_activity(self, slave_time, uptime):
+        """Returns the number of seconds since the last activity,
+        ACTIVITY_STOPPED, ACTIVITY_BOOTING if the last shutdown happened
+        before the slave booted or None if there was no activity"""
+        if self.event == EVENT_SHUTDOWN:
+            if (slave_time - self.event_time) > uptime:
+                return ACTIVITY_BOOTING
+            return ACTIVITY_STOPPED
+        elif self.event == EVENT_RUNNING:
+            # Running something, so the last activity is now
+            return 0
+        elif self.event == EVENT_IDLE:
+            return slave_time - self.event_time
+        return None
+
+
+def read_chunk(header_and_data, cursor=None):
+    """Parses the output of LOG_PROBE_COMMAND. Only complete lines are
+    returned, the offset points right after the last one."""
+    header, _, data = header_and_data.partition("\n")
+    fields = header.split()
+    incremental = fields[-1:] == ["incremental"]
+    inode, size = None, 0
+    if len(fields) == 3:
+        inode, size = fields[0], int(fields[1])
+    partial = len(data) - (data.rfind("\n") + 1)
+    data = data[:len(data) - partial]
+    if incremental:
+        offset = cursor.offset + len(data)
+    else:
+        offset = max(0, size - partial)
+    _count(bytes=len(header_and_data),
+           **{"incremental" if incremental else "full": 1})
+    return LogChunk(data=data, inode=inode, offset=offset,
+                    incremental=incremental)
+
+
+def log_probe_command(cursor=None):
+    if cursor is None:
+        cursor = LogCursor(inode="none", offset=0, state=None)
+    return LOG_PROBE_COMMAND.format(log=TWISTD_LOG, inode=cursor.inode,
+                                    offset=cursor.offset,
+                                    start=cursor.offset + 1, lines=TAIL_LINES)
+
+
+def update_activity(chunk, cursor=None, name=None):
+    """Returns the LogActivity after the lines of chunk and the cursor to
+    use for the next probe"""
+    start = time.time()
+    if chunk.incremental and cursor.state is not None:
+        activity = LogActivity.from_dict(cursor.state)
+    else:
+        activity = LogActivity()
+    activity.feed_bytes(chunk.data)
+    activity.close()
+    log.debug("%s - %s, running command: %s - %s", name, activity.event,
+              activity.running_command, activity.last_line)
+    _count(parse_seconds=time.time() - start)
+    return activity, LogCursor(chunk.inode, chunk.offset, activity.to_dict())
+
+
+class LogCursorStore(object):
+    """LogCursors by instance id, persisted as JSON"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self.load()
+
+    def load(self):
+        cursors = load_versioned_json(
+            self.filename, CURSORS_VERSION, "cursors",
+            lambda d: dict((instance_id, LogCursor(*c))
+                           for instance_id, c in d.iteritems()))
+        if cursors is not None:
+            self._cursors = cursors
+
+    def save(self):
+        with self._lock:
+            cursors = dict((k, list(v)) for k, v in self._cursors.iteritems())
+        save_versioned_json(self.filename, CURSORS_VERSION, "cursors",
+                            cursors)
+
+    def get(self, instance_id):
+        with self._lock:
+            return self._cursors.get(instance_id)
+
+    def set(self, instance_id, cursor):
+        with self._lock:
+            self._cursors[instance_id] = cursor
+
+    def prune(self, instance_ids):
+        """Forgets the instances not in instance_ids"""
+        instance_ids = set(instance_ids)
+        with self._lock:
+            for instance_id in list(self._cursors):
+                if instance_id not in instance_ids:
+                    del self._cursors[instance_id]
+
+    def __len__(self):
+        return len(self._cursors)
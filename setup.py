@@ -32,7 +32,6 @@ setup(
         'wsgiref==0.1.2',
         'cfn-pyplates>=0.5.0',
         'IPy==0.81',
-        'redo==1.4',
         'boto3==1.4.7',
         'botocore==1.7.7',
         'docutils==0.14',
@@ -69,6 +68,7 @@ setup(
                 'aws_create_win_ami',
                 'aws_deploy_stack',
                 'aws_get_cloudtrail_logs',
+                'aws_heartbeat_collector',
                 'aws_manage_instances',
                 'aws_manage_routingtables',
                 'aws_manage_securitygroups',
@@ -80,6 +80,8 @@ setup(
                 'aws_stop_idle',
                 'aws_terminate_by_ami_id',
                 'aws_watch_pending',
+                'aws_watch_pending_sim',
+                'buildslave_heartbeat',
                 'check_dns',
                 'copy_ami',
                 'delete_old_spot_amis',